@@ -0,0 +1,241 @@
+"""
+Benchmarks the model blocks on synthetic batches.
+
+Times the forward pass, and the forward and backward passes, of each message passing convolution,
+each self-connection block, S2Activation at several grid resolutions, and the full model with
+forces and stress. Runs on the CPU by default, so results are comparable between machines without
+a GPU.
+
+Run with python benchmarks/blocks.py --n_nodes=256 --out=reports/bench_blocks.json, adding
+--baseline=<earlier results> to compare against them. Exits with status 1 if any benchmark is
+slower than the baseline by more than the tolerance.
+"""
+
+import json
+import logging
+import re
+import sys
+from pathlib import Path
+from typing import Optional
+
+import e3nn_jax as e3nn
+import jax
+import jax.numpy as jnp
+import pyrallis
+import rich
+from flax import linen as nn
+
+from facet.benchmark import benchmark_jit, compare_results, results_table, write_results
+from facet.config import field
+from facet.config.common import dataclass
+from facet.config.mace import (
+    GateConfig,
+    MACEConfig,
+    MLPSelfGateConfig,
+    NodeFeatureMLPWeightedConfig,
+    RadialEmbeddingConfig,
+    S2ActivationConfig,
+    S2MLPMixerConfig,
+    SevenNetConvConfig,
+    SimpleMixMessageConfig,
+)
+from facet.config.utils import MLPConfig
+from facet.data.synthetic import synthetic_batch, synthetic_metadata
+from facet.layers import Context, E3Irreps, edge_vecs
+from facet.mace.mace import safe_norm
+from facet.mace.self_connection import EquivariantProductBasisBlock, LinearSelfConnection
+from facet.profiling import block_functions, sum_outputs
+from facet.regression import EFSWrapper
+
+
+@dataclass
+class BlocksConfig:
+    # Batch shape. SimpleMixMLPConv only supports k = 16.
+    n_nodes: int = 256
+    n_graphs: int = 16
+    k: int = 16
+    num_species: int = 8
+    seed: int = 0
+
+    # Node features of the convolutions and self-connections.
+    irreps: str = '128x0e + 64x1e + 32x2e'
+    # Channels of the S2Activation input, with irreps 0e + 1e + 2e.
+    s2_channels: int = 32
+    # Grid resolutions of S2Activation, in the beta axis. The alpha axis has one fewer.
+    s2_res_beta: list[int] = field(default_factory=lambda: [8, 12, 18, 24, 32])
+
+    warmup: int = 2
+    trials: int = 10
+    # Only run benchmarks whose names match this regex.
+    only: Optional[str] = None
+    platform: str = 'cpu'
+
+    out: Path = Path('reports/bench_blocks.json')
+    # Earlier results to compare against.
+    baseline: Optional[Path] = None
+    # Benchmarks slower than the baseline by more than this ratio count as regressions.
+    tolerance: float = 1.1
+
+
+def block_inputs(config: BlocksConfig):
+    """The batch and the inputs the blocks get from the embeddings in the full model."""
+    cg = jax.tree.map(
+        jnp.asarray,
+        synthetic_batch(
+            config.n_nodes, config.k, config.n_graphs, config.num_species, seed=config.seed
+        ),
+    )
+    ctx = Context(training=False)
+    key = jax.random.key(config.seed)
+
+    vecs = e3nn.IrrepsArray('1e', edge_vecs(cg))
+    radial = RadialEmbeddingConfig().build()
+    lengths = safe_norm(vecs.array, axis=-1)
+    radial_embedding = radial.apply(radial.init(key, lengths, ctx), lengths, ctx)
+    return cg, vecs, radial_embedding, ctx, key
+
+
+def conv_benchmarks(config: BlocksConfig) -> dict[str, tuple]:
+    cg, vecs, radial_embedding, ctx, key = block_inputs(config)
+    irreps = E3Irreps(config.irreps)
+    node_feats = e3nn.normal(irreps, key, (config.n_nodes,))
+    avg_num_neighbors = jnp.array([float(config.k)])
+
+    convs = {
+        'sevennet': SevenNetConvConfig(),
+        'node_feature_mlp': NodeFeatureMLPWeightedConfig(
+            node_feature_mlp=MLPConfig(inner_dims=[64])
+        ),
+        'simple_mix_mlp': SimpleMixMessageConfig(),
+    }
+    if config.k != 16:
+        logging.warning('Skipping simple_mix_mlp, which only supports k = 16')
+        convs.pop('simple_mix_mlp')
+
+    benchmarks = {}
+    for name, conv_config in convs.items():
+        conv = conv_config.build().copy(irreps_out=irreps)
+        shs = e3nn.spherical_harmonics(
+            e3nn.Irreps(' + '.join(f'{ell}e' for ell in range(conv.max_ell + 1))), vecs, True
+        )
+        args = (shs, node_feats, radial_embedding, cg.receivers, avg_num_neighbors, ctx)
+        benchmarks[f'conv/{name}'] = (conv, args, {})
+    return benchmarks
+
+
+def self_connection_benchmarks(config: BlocksConfig) -> dict[str, tuple]:
+    cg, _vecs, _radial, ctx, key = block_inputs(config)
+    irreps = E3Irreps(config.irreps)
+    species = cg.nodes.species.astype(jnp.int32)
+    species_embed = jax.random.normal(key, (config.n_nodes, 64))
+
+    blocks = {
+        's2_mlp_mixer': S2MLPMixerConfig().build(),
+        'mlp_gate': MLPSelfGateConfig().build(),
+        'gate': GateConfig().build(),
+        'linear': LinearSelfConnection(irreps_out=None),
+        'product_basis': EquivariantProductBasisBlock(
+            irreps_out=None, correlation=3, num_species=config.num_species
+        ),
+    }
+
+    benchmarks = {}
+    for name, block in blocks.items():
+        block = block.copy(irreps_out=irreps)
+        node_feats = e3nn.normal(block.irreps_in(), key, (config.n_nodes,))
+        # the product basis embeds the species itself
+        embed = None if name == 'product_basis' else species_embed
+        benchmarks[f'self_connection/{name}'] = (block, (node_feats, species, embed, ctx), {})
+    return benchmarks
+
+
+def s2_benchmarks(config: BlocksConfig) -> dict[str, tuple]:
+    key = jax.random.key(config.seed)
+    x = e3nn.normal('0e + 1e + 2e', key, (config.n_nodes, config.s2_channels))
+    benchmarks = {}
+    for res_beta in config.s2_res_beta:
+        act = S2ActivationConfig(res_beta=res_beta, res_alpha=res_beta - 1).build()
+        benchmarks[f's2_activation/{res_beta}x{res_beta - 1}'] = (act, (x, Context(False)), {})
+    return benchmarks
+
+
+def run_block(name: str, module: nn.Module, args, kwargs, config: BlocksConfig) -> list[dict]:
+    variables = module.init(jax.random.key(config.seed), *args, **kwargs)
+    results = []
+    for pass_name, (fn, fn_args) in block_functions(module, variables, args, kwargs).items():
+        logging.info('Running %s/%s', name, pass_name)
+        results.append(
+            {
+                'name': f'{name}/{pass_name}',
+                **benchmark_jit(fn, fn_args, config.warmup, config.trials),
+            }
+        )
+    return results
+
+
+def model_benchmarks(config: BlocksConfig) -> list[dict]:
+    """The default model, predicting energy, forces, and stress, and its gradient with respect to
+    the parameters as in training."""
+    cg = jax.tree.map(
+        jnp.asarray,
+        synthetic_batch(
+            config.n_nodes, config.k, config.n_graphs, config.num_species, seed=config.seed
+        ),
+    )
+    metadata = synthetic_metadata(config.num_species, config.k, config.n_nodes, config.n_graphs)
+    mod = MACEConfig().build(metadata, 'f32')
+    ctx = Context(training=False)
+    params = mod.init(jax.random.key(config.seed), cg, ctx=ctx)
+    efs = EFSWrapper()
+
+    def forward(params, cg):
+        return efs(mod.apply, params, cg, ctx=ctx)
+
+    def forward_backward(params, cg):
+        return jax.grad(lambda params: sum_outputs(forward(params, cg)))(params)
+
+    results = []
+    for pass_name, fn in (('forward', forward), ('backward', forward_backward)):
+        name = f'model/efs/{pass_name}'
+        if config.only is None or re.search(config.only, name):
+            logging.info('Running %s', name)
+            results.append(
+                {
+                    'name': name,
+                    **benchmark_jit(fn, (params, cg), config.warmup, config.trials),
+                }
+            )
+    return results
+
+
+@pyrallis.wrap()
+def main(config: BlocksConfig):
+    logging.basicConfig(level=logging.INFO)
+    jax.config.update('jax_platform_name', config.platform)
+
+    blocks = {
+        **conv_benchmarks(config),
+        **self_connection_benchmarks(config),
+        **s2_benchmarks(config),
+    }
+    results = []
+    for name, (module, args, kwargs) in blocks.items():
+        if config.only is None or re.search(config.only, name):
+            results.extend(run_block(name, module, args, kwargs, config))
+    results.extend(model_benchmarks(config))
+
+    write_results(config.out, 'blocks', pyrallis.encode(config), results)
+    rich.print(results_table(results, f'Blocks, {config.n_nodes} nodes, k = {config.k}'))
+
+    if config.baseline is not None:
+        with open(config.baseline) as f:
+            baseline = json.load(f)['results']
+        table, regressions = compare_results(results, baseline, config.tolerance)
+        rich.print(table)
+        if regressions:
+            logging.error('Slower than the baseline: %s', ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
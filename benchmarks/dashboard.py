@@ -0,0 +1,178 @@
+"""
+Benchmarks the cost of the training dashboard to the training loop.
+
+Runs a stand-in training step, logging a row of metrics every log_every steps like TrainingRun,
+with the dashboard's data handling in a UI thread:
+- off: no dashboard.
+- feed: the UI polls a DashboardFeed updates_per_s times per second, as the dashboard does.
+- per_step: the training thread hands the UI the whole history every step and waits for it to be
+  shown, as the dashboard used to with call_from_thread.
+
+The history starts with history_rows rows, as if the run had been going a while. Reports the time
+per training step, which should be the same with the feed as with no dashboard.
+
+This only emulates the UI: the Textual app in facet.dashboard is never started, so the time it
+spends drawing plots and tables, and how that interacts with training, isn't measured. The results
+have not been checked against training with the real dashboard.
+
+Run with python benchmarks/dashboard.py --out=reports/bench_dashboard.json, adding
+--baseline=<earlier results> to compare against them.
+"""
+
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Optional
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pandas as pd
+import pyrallis
+import rich
+from rich import box
+from rich.table import Table
+
+from facet.benchmark import compare_results, write_results
+from facet.config.common import dataclass
+from facet.dashboard_feed import DashboardFeed, plot_range
+from facet.utils import format_scalar
+
+
+@dataclass
+class DashboardBenchConfig:
+    # Size of the matrices the stand-in training step multiplies.
+    step_size: int = 256
+    num_steps: int = 2000
+    log_every: int = 10
+    num_metrics: int = 30
+    # Rows already in the history when the benchmark starts.
+    history_rows: int = 5000
+    updates_per_s: float = 2
+
+    out: Path = Path('reports/bench_dashboard.json')
+    # Earlier results to compare against.
+    baseline: Optional[Path] = None
+    # Benchmarks slower than the baseline by more than this ratio count as regressions.
+    tolerance: float = 1.2
+
+
+PLOT_COLS = ('tr', 'te', 'epoch')
+
+
+def render(data: dict[str, list], rows: pd.DataFrame):
+    """What the dashboard computes to show the data: the plot range, the clipped series, and the
+    formatted table."""
+    plotted = {k: v for k, v in data.items() if k.startswith(PLOT_COLS)}
+    _x_end, ymax = plot_range(plotted)
+    for values in plotted.values():
+        [min(ymax * 1.09, y) for y in values]
+    return rows.map(format_scalar).values
+
+
+def log_row(history: dict[str, list], config: DashboardBenchConfig, step: int):
+    epoch = step / 1000
+    history['epoch'].append(epoch)
+    history['step'].append(step)
+    for i in range(config.num_metrics):
+        prefix = ('tr', 'te', 'ev')[i % 3]
+        history[f'{prefix}_m{i}_loss'].append(1 / (1 + epoch) + 0.01 * i)
+
+
+def run(config: DashboardBenchConfig, mode: str) -> np.ndarray:
+    """Milliseconds per training step."""
+    history: dict[str, list] = defaultdict(list)
+    first_step = config.history_rows * config.log_every
+    for step in range(0, first_step, config.log_every):
+        log_row(history, config, step)
+
+    x = jnp.ones((config.step_size, config.step_size)) / config.step_size
+    train_step = jax.jit(lambda x: jnp.tanh(x @ x))
+    jax.block_until_ready(train_step(x))
+
+    done = threading.Event()
+    requests: queue.Queue = queue.Queue()
+
+    def feed_ui():
+        feed = DashboardFeed(history)
+        while not done.wait(1 / config.updates_per_s):
+            if feed.poll():
+                render(feed.plot_data(), pd.DataFrame(feed.table_data()))
+
+    def per_step_ui():
+        while (data := requests.get()) is not None:
+            render(data, pd.DataFrame(data).iloc[-15:])
+            requests.task_done()
+
+    ui = {'feed': feed_ui, 'per_step': per_step_ui}.get(mode)
+    thread = threading.Thread(target=ui, daemon=True) if ui is not None else None
+    if thread is not None:
+        thread.start()
+
+    times = []
+    for step in range(first_step, first_step + config.num_steps):
+        start = time.perf_counter()
+        x = jax.block_until_ready(train_step(x))
+        if step % config.log_every == 0:
+            log_row(history, config, step)
+        if mode == 'per_step':
+            requests.put(history)
+            requests.join()
+        times.append(time.perf_counter() - start)
+
+    done.set()
+    requests.put(None)
+    if thread is not None:
+        thread.join()
+    return np.array(times) * 1000
+
+
+@pyrallis.wrap()
+def main(config: DashboardBenchConfig):
+    logging.basicConfig(level=logging.INFO)
+
+    results = []
+    for mode in ('off', 'feed', 'per_step'):
+        logging.info('Running %s', mode)
+        times = run(config, mode)
+        results.append(
+            {
+                'name': mode,
+                'median_ms': float(np.median(times)),
+                'mean_ms': float(np.mean(times)),
+                'steps_per_s': float(1000 / np.mean(times)),
+            }
+        )
+
+    write_results(config.out, 'dashboard', pyrallis.encode(config), results)
+    off = results[0]['mean_ms']
+    table = Table(title='Training step with the dashboard', box=box.SIMPLE)
+    for column in ('Dashboard', 'Median ms', 'Mean ms', 'Steps/s', 'vs. off'):
+        table.add_column(column, justify='left' if column == 'Dashboard' else 'right')
+    for r in results:
+        table.add_row(
+            r['name'],
+            f'{r["median_ms"]:.3f}',
+            f'{r["mean_ms"]:.3f}',
+            f'{r["steps_per_s"]:.0f}',
+            f'{r["mean_ms"] / off:.2f}x',
+        )
+    rich.print(table)
+
+    if config.baseline is not None:
+        with open(config.baseline) as f:
+            baseline = json.load(f)['results']
+        table, regressions = compare_results(results, baseline, config.tolerance)
+        rich.print(table)
+        if regressions:
+            logging.error('Slower than the baseline: %s', ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Benchmarks the data pipeline on a synthetic dataset.
+
+Writes a synthetic dataset laid out like the preprocessed ones, if it isn't there already, and
+measures how fast each stage produces batches: loading single files from each storage backend,
+collating them, stacking the collated batches, and the full dataloader for each batch size and
+stack size. Reports batches/s and MB/s of files read. Runs offline, on the CPU.
+
+Run with python benchmarks/loader.py --out=reports/bench_loader.json, adding
+--baseline=<earlier results> to compare against them. Exits with status 1 if any benchmark is
+slower than the baseline by more than the tolerance.
+"""
+
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import chex
+import jax
+import numpy as np
+import pyrallis
+import rich
+from rich import box
+from rich.table import Table
+
+from facet.benchmark import compare_results, write_results
+from facet.config import DataConfig, DeviceConfig, LogConfig, MainConfig, field
+from facet.config.common import dataclass
+from facet.data.databatch import collate
+from facet.data.dataset import (
+    dataloader,
+    load_file,
+    load_file_zarr,
+    num_stacked,
+    stack_trees,
+)
+from facet.data.synthetic import write_dataset
+
+BACKENDS = {'mpk': (load_file, '.mpk'), 'zarr': (load_file_zarr, '.zip')}
+
+
+@dataclass
+class LoaderConfig:
+    # Synthetic dataset to read, in data_folder/dataset_name. Written if it doesn't exist.
+    data_folder: Path = Path('/tmp/facet_bench/')
+    dataset_name: str = 'synthetic'
+    num_groups: int = 36
+    batches_per_group: int = 4
+    batch_num_graphs: int = 32
+    batch_num_atoms: int = 32
+    k: int = 16
+    seed: int = 0
+
+    backends: list[str] = field(default_factory=lambda: ['mpk', 'zarr'])
+    # Loader configurations: training batch sizes, in graphs, and stack sizes.
+    batch_sizes: list[int] = field(default_factory=lambda: [32, 64, 128])
+    stack_sizes: list[int] = field(default_factory=lambda: [1, 2])
+
+    # Timed files or batches for each benchmark, after one untimed warmup.
+    trials: int = 20
+
+    out: Path = Path('reports/bench_loader.json')
+    # Earlier results to compare against.
+    baseline: Optional[Path] = None
+    # Benchmarks slower than the baseline by more than this ratio count as regressions.
+    tolerance: float = 1.2
+
+    @property
+    def dataset_folder(self) -> Path:
+        return self.data_folder / self.dataset_name
+
+
+def main_config(config: LoaderConfig, batch_size: int, stack_size: int) -> MainConfig:
+    return MainConfig(
+        batch_size=batch_size,
+        stack_size=stack_size,
+        data=DataConfig(data_folder=config.data_folder, dataset_name=config.dataset_name),
+        device=DeviceConfig(device='cpu'),
+        log=LogConfig(log_dir=config.data_folder),
+    )
+
+
+def file_paths(config: LoaderConfig, suffix: str) -> list[tuple[int, int, Path]]:
+    """Group number, file number, and path of every batch file with the suffix."""
+    return [
+        (int(group.stem.removeprefix('group_')), int(path.stem), path)
+        for group in sorted((config.dataset_folder / 'batches').glob('group_*'))
+        for path in sorted(group.glob(f'*{suffix}'))
+    ]
+
+
+def summarize(name: str, times: list[float], num_bytes: float, num_graphs: float) -> dict:
+    """Throughput over the trials, given the average bytes read and real graphs per trial."""
+    times = np.array(times)
+    total = np.sum(times)
+    return {
+        'name': name,
+        'median_ms': float(np.median(times) * 1000),
+        'min_ms': float(np.min(times) * 1000),
+        'std_ms': float(np.std(times) * 1000),
+        'batches_per_s': len(times) / total,
+        'mb_per_s': len(times) * num_bytes / total / 1e6,
+        'graphs_per_s': len(times) * num_graphs / total,
+        'trials': len(times),
+    }
+
+
+def time_each(fn: Callable, inputs: list) -> list[float]:
+    """Times fn on each input, after an untimed call on the first to compile."""
+    jax.block_until_ready(fn(inputs[0]))
+    times = []
+    for x in inputs:
+        start = time.perf_counter()
+        jax.block_until_ready(fn(x))
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def stage_benchmarks(config: LoaderConfig) -> list[dict]:
+    """Loading single files with each backend, then collating and stacking them."""
+    run = main_config(config, config.batch_num_graphs, 1)
+    results = []
+    batches = []
+    for backend in config.backends:
+        load_fn, suffix = BACKENDS[backend]
+        paths = file_paths(config, suffix)[: config.trials]
+        num_bytes = np.mean([path.stat().st_size for _g, _f, path in paths])
+        batches = [load_fn(run, g, f) for g, f, _path in paths]
+        num_graphs = np.mean([np.sum(cg.padding_mask) for cg in batches])
+        times = time_each(lambda x: load_fn(run, x[0], x[1]), paths)
+        results.append(summarize(f'load_file/{backend}', times, num_bytes, num_graphs))
+
+    num_graphs = np.mean([np.sum(cg.padding_mask) for cg in batches])
+    for multiple in sorted({bs // config.batch_num_graphs for bs in config.batch_sizes}):
+        groups = [batches[i : i + multiple] for i in range(0, len(batches) - multiple + 1)]
+        times = time_each(collate, groups)
+        results.append(summarize(f'collate/{multiple}', times, 0, multiple * num_graphs))
+
+    for stack_size in config.stack_sizes:
+        # each stack size is a new shape, which stack_trees only expects a couple of in training
+        chex.clear_trace_counter()
+        groups = [batches[i : i + stack_size] for i in range(0, len(batches) - stack_size + 1)]
+        times = time_each(stack_trees, groups)
+        results.append(summarize(f'stack_trees/{stack_size}', times, 0, stack_size * num_graphs))
+    return results
+
+
+def loader_benchmarks(config: LoaderConfig) -> list[dict]:
+    """The full dataloader, reading every file from disk in its first epoch."""
+    results = []
+    for backend in config.backends:
+        _load_fn, suffix = BACKENDS[backend]
+        file_bytes = np.mean([path.stat().st_size for _g, _f, path in file_paths(config, suffix)])
+        for batch_size in config.batch_sizes:
+            for stack_size in config.stack_sizes:
+                run = main_config(config, batch_size, stack_size)
+                chex.clear_trace_counter()
+                steps, dl = dataloader(run, split='train', use_zarr=backend == 'zarr')
+                # the first batch compiles stack_trees
+                jax.block_until_ready(next(dl))
+                times = []
+                # steps counts unstacked batches, and the epoch yields them in stacks
+                for _ in range(min(config.trials, steps // num_stacked(run) - 1)):
+                    start = time.perf_counter()
+                    jax.block_until_ready(next(dl))
+                    times.append(time.perf_counter() - start)
+
+                files = run.train_batch_multiple * stack_size
+                name = f'dataloader/{backend}/bs{batch_size}x{stack_size}'
+                logging.info('Ran %s', name)
+                results.append(
+                    summarize(name, times, files * file_bytes, files * config.batch_num_graphs)
+                )
+    return results
+
+
+def results_table(results: list[dict]) -> Table:
+    table = Table(title='Data pipeline', box=box.SIMPLE)
+    table.add_column('Benchmark')
+    for column in ('Median ms', 'Batches/s', 'MB/s', 'Graphs/s'):
+        table.add_column(column, justify='right')
+    for r in results:
+        table.add_row(
+            r['name'],
+            f'{r["median_ms"]:.3f}',
+            f'{r["batches_per_s"]:.1f}',
+            f'{r["mb_per_s"]:.1f}',
+            f'{r["graphs_per_s"]:.0f}',
+        )
+    return table
+
+
+@pyrallis.wrap()
+def main(config: LoaderConfig):
+    logging.basicConfig(level=logging.INFO)
+    jax.config.update('jax_platform_name', 'cpu')
+
+    if not (config.dataset_folder / 'metadata.mpk').exists():
+        logging.info('Writing synthetic dataset to %s', config.dataset_folder)
+        write_dataset(
+            config.dataset_folder,
+            num_groups=config.num_groups,
+            batches_per_group=config.batches_per_group,
+            batch_num_graphs=config.batch_num_graphs,
+            batch_num_atoms=config.batch_num_atoms,
+            k=config.k,
+            use_zarr='zarr' in config.backends,
+            seed=config.seed,
+        )
+
+    results = stage_benchmarks(config) + loader_benchmarks(config)
+    write_results(config.out, 'loader', pyrallis.encode(config), results)
+    rich.print(results_table(results))
+
+    if config.baseline is not None:
+        with open(config.baseline) as f:
+            baseline = json.load(f)['results']
+        table, regressions = compare_results(results, baseline, config.tolerance)
+        rich.print(table)
+        if regressions:
+            logging.error('Slower than the baseline: %s', ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
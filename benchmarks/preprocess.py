@@ -0,0 +1,136 @@
+"""
+Benchmarks the statistics collected while preprocessing datasets.
+
+Feeds synthetic structures to the collectors in facet.data.dataset_generation the way
+BatchProcessor does: the species, energy and neighbor distances of each structure, and each padded
+batch. Reports structures/s for each collector, to compare against the rate the graphs themselves
+are built at.
+
+Run with python benchmarks/preprocess.py --out=reports/bench_preprocess.json, adding
+--baseline=<earlier results> to compare against them.
+"""
+
+import json
+import logging
+import sys
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pyrallis
+import rich
+from rich import box
+from rich.table import Table
+
+from facet.benchmark import compare_results, time_trials, write_results
+from facet.config.common import dataclass
+from facet.data.dataset_generation import BatchMetadataTracker, GraphSummarizer, RMaxBinner
+from facet.data.synthetic import random_structure, structure_sizes, synthetic_batch
+from facet.layers import edge_vecs
+
+
+@dataclass
+class PreprocessConfig:
+    num_structures: int = 2000
+    k: int = 16
+    num_species: int = 89
+    median_atoms: float = 16
+    sigma_atoms: float = 0.8
+    # Padded batches of batch_num_graphs graphs and batch_num_graphs * batch_num_atoms nodes.
+    num_batches: int = 64
+    batch_num_graphs: int = 32
+    batch_num_atoms: int = 32
+    seed: int = 0
+
+    warmup: int = 1
+    trials: int = 5
+
+    out: Path = Path('reports/bench_preprocess.json')
+    # Earlier results to compare against.
+    baseline: Optional[Path] = None
+    # Benchmarks slower than the baseline by more than this ratio count as regressions.
+    tolerance: float = 1.2
+
+
+def structure_inputs(config: PreprocessConfig):
+    """The species, energy and neighbor distances of each structure, as BatchProcessor has them."""
+    rng = np.random.default_rng(config.seed)
+    sizes = structure_sizes(
+        rng, config.num_structures, config.median_atoms, config.sigma_atoms, 8 * config.k
+    )
+    inputs = []
+    for size in sizes:
+        cg = random_structure(rng, int(size), config.k, config.num_species)
+        dists = np.sqrt(np.sum(np.square(edge_vecs(cg)), axis=-1) + 1e-6)
+        inputs.append(([int(s) for s in cg.nodes.species], float(cg.e_form[0]), dists))
+    return inputs
+
+
+def run_binner(inputs):
+    binner = RMaxBinner((np.arange(5, 121, 5) / 10).tolist())
+    for _species, _energy, dists in inputs:
+        binner.update(dists)
+    return binner.counts
+
+
+def run_summarizer(inputs):
+    summarizer = GraphSummarizer()
+    for species, energy, _dists in inputs:
+        summarizer.update(species, energy)
+    return summarizer.to_df()
+
+
+def run_tracker(batches):
+    tracker = BatchMetadataTracker()
+    tracker.new_group()
+    for batch in batches:
+        tracker.update(batch)
+    return tracker.node_pad_fracs
+
+
+@pyrallis.wrap()
+def main(config: PreprocessConfig):
+    logging.basicConfig(level=logging.INFO)
+
+    inputs = structure_inputs(config)
+    batches = [
+        synthetic_batch(
+            config.batch_num_graphs * config.batch_num_atoms,
+            config.k,
+            config.batch_num_graphs,
+            config.num_species,
+            seed=config.seed + i,
+        )
+        for i in range(config.num_batches)
+    ]
+
+    results = []
+    for name, fn, args, num in (
+        ('binner', run_binner, inputs, len(inputs)),
+        ('summarizer', run_summarizer, inputs, len(inputs)),
+        ('tracker', run_tracker, batches, len(batches)),
+    ):
+        logging.info('Running %s', name)
+        timing = time_trials(fn, (args,), config.warmup, config.trials)
+        results.append({'name': name, **timing, 'per_s': num / timing['median_ms'] * 1000})
+
+    write_results(config.out, 'preprocess', pyrallis.encode(config), results)
+    table = Table(title='Preprocessing statistics', box=box.SIMPLE)
+    for column in ('Collector', 'Median ms', 'Inputs/s'):
+        table.add_column(column, justify='left' if column == 'Collector' else 'right')
+    for r in results:
+        table.add_row(r['name'], f'{r["median_ms"]:.2f}', f'{r["per_s"]:.0f}')
+    rich.print(table)
+
+    if config.baseline is not None:
+        with open(config.baseline) as f:
+            baseline = json.load(f)['results']
+        table, regressions = compare_results(results, baseline, config.tolerance)
+        rich.print(table)
+        if regressions:
+            logging.error('Slower than the baseline: %s', ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
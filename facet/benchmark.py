@@ -0,0 +1,144 @@
+"""
+Timing harness for the suites in benchmarks/.
+
+Each benchmark compiles a function once, runs it a few times to warm up, and then times repeated
+trials. Results are written as JSON with the environment they were measured in, and can be compared
+against an earlier file to catch regressions.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+import jax
+import jaxlib
+import numpy as np
+from rich import box
+from rich.table import Table
+
+from facet.profiling import cost_analysis
+
+RESULTS_VERSION = 1
+
+
+def time_trials(fn: Callable, args, warmup: int, trials: int) -> dict[str, float]:
+    """Statistics of the run time of fn(*args) over the trials, in milliseconds."""
+    for _ in range(warmup):
+        jax.block_until_ready(fn(*args))
+    times = []
+    for _ in range(trials):
+        start = time.perf_counter()
+        jax.block_until_ready(fn(*args))
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return {
+        'median_ms': float(np.median(times)),
+        'min_ms': float(np.min(times)),
+        'mean_ms': float(np.mean(times)),
+        'std_ms': float(np.std(times)),
+        'trials': trials,
+    }
+
+
+def benchmark_jit(fn: Callable, args, warmup: int, trials: int) -> dict[str, float]:
+    """Compiles fn for args and times it, with XLA's cost analysis and the compile time."""
+    start = time.perf_counter()
+    compiled = jax.jit(fn).lower(*args).compile()
+    compile_s = time.perf_counter() - start
+    return {
+        **time_trials(compiled, args, warmup, trials),
+        **cost_analysis(compiled),
+        'compile_s': compile_s,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, timeout=10
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment() -> dict:
+    """What the timings depend on, besides the code."""
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'jax': jax.__version__,
+        'jaxlib': jaxlib.__version__,
+        'backend': jax.default_backend(),
+        'device': jax.devices()[0].device_kind,
+        'num_devices': jax.device_count(),
+        'cpu': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def write_results(path: Path, suite: str, config: dict, results: list[dict]):
+    """Writes the results of a suite, which have a 'name' and the keys from benchmark_jit."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(
+            {
+                'version': RESULTS_VERSION,
+                'suite': suite,
+                'environment': environment(),
+                'config': config,
+                'results': results,
+            },
+            f,
+            indent=2,
+        )
+
+
+def compare_results(
+    results: list[dict], baseline: list[dict], tolerance: float
+) -> tuple[Table, list[str]]:
+    """Table of the median times against the baseline results with the same names, and the names
+    of those that are slower than the baseline by more than the tolerance, as a ratio."""
+    base = {r['name']: r for r in baseline}
+    table = Table(title='Change from baseline', box=box.SIMPLE)
+    for column in ('Benchmark', 'Baseline ms', 'ms', 'Ratio'):
+        table.add_column(column, justify='left' if column == 'Benchmark' else 'right')
+
+    regressions = []
+    for result in results:
+        if result['name'] not in base:
+            table.add_row(result['name'], '-', f'{result["median_ms"]:.3f}', '-')
+            continue
+        base_ms = base[result['name']]['median_ms']
+        ratio = result['median_ms'] / base_ms
+        if ratio > tolerance:
+            regressions.append(result['name'])
+        color = 'red' if ratio > tolerance else 'green' if ratio < 1 / tolerance else 'default'
+        table.add_row(
+            result['name'], f'{base_ms:.3f}', f'{result["median_ms"]:.3f}', f'[{color}]{ratio:.2f}x'
+        )
+    return table, regressions
+
+
+def results_table(results: list[dict], title: str) -> Table:
+    table = Table(title=title, box=box.SIMPLE)
+    table.add_column('Benchmark')
+    for column in ('Median ms', 'Min ms', 'Std ms', 'GFLOP', 'MB accessed', 'Compile s'):
+        table.add_column(column, justify='right')
+    for r in results:
+        table.add_row(
+            r['name'],
+            f'{r["median_ms"]:.3f}',
+            f'{r["min_ms"]:.3f}',
+            f'{r["std_ms"]:.3f}',
+            f'{r["flops"] / 1e9:.3f}',
+            f'{r["bytes_accessed"] / 1e6:.1f}',
+            f'{r["compile_s"]:.2f}',
+        )
+    return table
@@ -0,0 +1,170 @@
+"""ASE calculator for trained models, with batched inference over many structures."""
+
+from os import PathLike
+from typing import Optional, Sequence
+
+import jax
+import numpy as np
+from ase import Atoms
+from ase.calculators.calculator import Calculator, all_changes
+from jaxtyping import Array, Float
+
+from facet.checkpointing import best_ckpt, ckpt_params, run_config
+from facet.config import MainConfig
+from facet.data.databatch import CrystalData, CrystalGraphs, NodeData, TargetInfo, collate
+from facet.data.neighbors import knn_graph
+from facet.frozen import split_results
+from facet.layers import Context
+from facet.quantize import QuantDtype, dequantize_params, quantize_params
+from facet.regression import EFSOutput, EFSWrapper
+
+
+def structure_arrays(structure) -> tuple[Float[Array, '3 3'], Float[Array, 'nodes 3'], np.ndarray]:
+    """Lattice, Cartesian coordinates, and atomic numbers of an ASE Atoms or pymatgen Structure."""
+    if isinstance(structure, Atoms):
+        if not structure.pbc.all():
+            raise ValueError('Only structures periodic in all three directions are supported')
+        return structure.cell.array, structure.positions, structure.numbers
+    else:
+        return (
+            structure.lattice.matrix,
+            structure.cart_coords,
+            np.array(structure.atomic_numbers),
+        )
+
+
+class FacetCalculator(Calculator):
+    """Computes energy, forces, and stress with a trained model.
+
+    Structures are padded into a few static batch sizes, so screening many structures with
+    predict() only needs one compiled executable per size. Each batch fits up to max_graphs
+    structures, and the batch sizes are given by node_buckets: structures that don't fit the
+    largest bucket get their own batch, padded to the next power of two.
+    """
+
+    implemented_properties = ['energy', 'free_energy', 'forces', 'stress']
+
+    def __init__(
+        self,
+        config: MainConfig,
+        params,
+        node_buckets: Sequence[int] = (64, 128, 256, 512, 1024),
+        max_graphs: int = 32,
+        quantize: Optional[QuantDtype] = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.config = config
+        # quantized weights are dequantized inside the compiled model
+        self.params = params if quantize is None else quantize_params(params, quantize)
+        self.node_buckets = sorted(node_buckets)
+        self.max_graphs = max_graphs
+
+        metadata = config.data.metadata
+        self.k = int(metadata.nearest_k)
+        self.species_index = np.full(int(np.max(metadata.atomic_numbers)) + 1, -1, dtype=np.int16)
+        self.species_index[np.array(metadata.atomic_numbers)] = np.arange(
+            len(metadata.atomic_numbers)
+        )
+
+        self.mod = config.build_regressor()
+        self.efs = EFSWrapper(grad_mode=config.train.loss.grad_mode)
+        # compiled executables, by number of nodes and graphs
+        self.executables = {}
+
+    @classmethod
+    def from_run(cls, run_dir: PathLike, use_ema: bool = True, **kwargs) -> 'FacetCalculator':
+        """Loads the best checkpoint of a training run."""
+        config = run_config(run_dir)
+        params = ckpt_params(best_ckpt(run_dir), use_ema=use_ema)
+        return cls(config, params, **kwargs)
+
+    def graph(self, structure) -> CrystalGraphs:
+        """Converts a single structure into an unpadded graph."""
+        lat, cart, numbers = structure_arrays(structure)
+        lat = np.asarray(lat, dtype=np.float64)
+        if np.max(numbers) >= len(self.species_index) or np.any(self.species_index[numbers] < 0):
+            raise ValueError(f'Structure has elements the model was not trained on: {numbers}')
+
+        num_sites = len(numbers)
+        nodes = NodeData(
+            species=self.species_index[numbers],
+            cart=np.asarray(cart, dtype=np.float64),
+            graph_i=np.zeros((num_sites,), dtype=np.int16),
+        )
+
+        return CrystalGraphs(
+            nodes,
+            knn_graph(lat, cart, self.k),
+            n_node=np.array([num_sites], dtype=np.int32),
+            padding_mask=np.ones((1,), dtype=np.bool_),
+            graph_data=CrystalData.from_lattice(lat, dtype=np.float64),
+            target_data=TargetInfo.new_empty(1, num_sites),
+        )
+
+    def example(self) -> CrystalGraphs:
+        """Graph with a single atom, for compiling batch shapes, which don't depend on the atoms."""
+        number = int(np.flatnonzero(self.species_index >= 0)[-1])
+        return self.graph(Atoms([number], cell=np.eye(3) * 3, pbc=True))
+
+    def bucket(self, n_node: int) -> int:
+        """Number of nodes to pad a batch with n_node real nodes to. There must be at least one
+        padding node."""
+        for size in self.node_buckets:
+            if n_node < size:
+                return size
+        return 1 << n_node.bit_length()
+
+    def batches(self, sizes: Sequence[int]) -> list[list[int]]:
+        """Groups the structures with the given numbers of atoms into batches, largest first. Each
+        batch fits in the largest bucket or is a single structure."""
+        batches = []
+        curr, curr_size = [], 0
+        for i in np.argsort(-np.array(sizes), kind='stable'):
+            size = sizes[i]
+            if curr and (curr_size + size >= self.node_buckets[-1] or len(curr) == self.max_graphs):
+                batches.append(curr)
+                curr, curr_size = [], 0
+            curr.append(int(i))
+            curr_size += size
+        if curr:
+            batches.append(curr)
+        return batches
+
+    def executable(self, cg: CrystalGraphs):
+        """Compiled model for batches with the shape of cg."""
+        key = (cg.n_total_nodes, cg.n_total_graphs)
+        if key not in self.executables:
+
+            def efs_fn(params, cg):
+                params = dequantize_params(params)
+                return self.efs(self.mod.apply, params, cg, ctx=Context(training=False))
+
+            self.executables[key] = jax.jit(efs_fn).lower(self.params, cg).compile()
+        return self.executables[key]
+
+    def predict(self, structures: Sequence) -> list[dict[str, np.ndarray | float]]:
+        """Computes the results for every structure, in ASE units: eV for energy, eV/Å for forces,
+        and eV/Å^3 Voigt stress with ASE's sign convention."""
+        graphs = [self.graph(s) for s in structures]
+        results: list[dict] = [{} for _ in structures]
+        for batch in self.batches([cg.n_total_nodes for cg in graphs]):
+            n_node = sum(graphs[i].n_total_nodes for i in batch)
+            cg = collate([graphs[i] for i in batch]).padded(
+                self.bucket(n_node), self.k, self.max_graphs + 1
+            )
+            out = jax.device_get(self.executable(cg)(self.params, cg))
+            batch_results = self.split_results(out, [graphs[i].n_total_nodes for i in batch])
+            for i, result in zip(batch, batch_results):
+                results[i] = result
+
+        return results
+
+    def split_results(self, out: EFSOutput, sizes: Sequence[int]) -> list[dict]:
+        """Splits the output for a batch into the results for the first len(sizes) structures, which
+        have the given numbers of atoms, in ASE units."""
+        return split_results(out.energy, out.force, out.stress, sizes)
+
+    def calculate(self, atoms=None, properties=('energy',), system_changes=all_changes):
+        super().calculate(atoms, properties, system_changes)
+        self.results = self.predict([self.atoms])[0]
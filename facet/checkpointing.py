@@ -1,8 +1,14 @@
 """Checkpointing utils."""
 
+import logging
+import time
+from datetime import timedelta
 from os import PathLike
 from pathlib import Path
+from typing import Any, Optional
 
+import jax
+import numpy as np
 import orbax.checkpoint as ocp
 import pyrallis
 
@@ -15,9 +21,13 @@ def run_config(run_dir: PathLike):
     return config
 
 
-def best_ckpt(run_dir: PathLike):
-    mngr = ocp.CheckpointManager(
-        Path(run_dir).absolute() / 'final_ckpt' / 'ckpts',
+def ckpt_dir(run_dir: PathLike) -> Path:
+    return Path(run_dir).absolute() / 'final_ckpt' / 'ckpts'
+
+
+def ckpt_manager(run_dir: PathLike) -> ocp.CheckpointManager:
+    return ocp.CheckpointManager(
+        ckpt_dir(run_dir),
         ocp.StandardCheckpointer(),
         options=ocp.CheckpointManagerOptions(
             enable_async_checkpointing=False,
@@ -27,5 +37,150 @@ def best_ckpt(run_dir: PathLike):
         ),
     )
 
+
+def best_ckpt(run_dir: PathLike):
+    mngr = ckpt_manager(run_dir)
     model = mngr.restore(mngr.best_step())
     return model
+
+
+def latest_ckpt(run_dir: PathLike):
+    mngr = ckpt_manager(run_dir)
+    return mngr.restore(mngr.latest_step())
+
+
+def ckpt_params(ckpt, use_ema: bool = True):
+    """Gets the parameters from a restored checkpoint. If use_ema, returns the EMA parameters used
+    for evaluation, which are in the state of the last optimizer transform."""
+    state = ckpt['state']
+    if not use_ema:
+        return state['params']
+
+    opt_state = state['opt_state']
+    if isinstance(opt_state, dict):
+        # sequences restored without a target have string indices as keys
+        opt_state = [opt_state[i] for i in sorted(opt_state, key=int)]
+    ema_state = opt_state[-1]
+    return ema_state['ema'] if isinstance(ema_state, dict) else ema_state[0]
+
+
+def dir_bytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+
+def restore_args(template):
+    """Restores the arrays with the shardings, shapes and types of the template's, and anything
+    else as NumPy arrays."""
+
+    def leaf_args(x):
+        if isinstance(x, jax.Array):
+            return ocp.ArrayRestoreArgs(sharding=x.sharding, global_shape=x.shape, dtype=x.dtype)
+        return ocp.RestoreArgs(restore_type=np.ndarray)
+
+    return jax.tree.map(leaf_args, template)
+
+
+class RunCheckpointer:
+    """Writes the checkpoints of a training run to its folder as it trains, and restores them to
+    resume it.
+
+    Saves are asynchronous: save only blocks while the arrays are copied off the devices, and the
+    files are written in the background. poll returns the statistics of each save once it's
+    written: the seconds the step loop was blocked, the total seconds, and the bytes written."""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.mngr = ocp.CheckpointManager(
+            directory,
+            options=ocp.CheckpointManagerOptions(
+                save_interval_steps=1,
+                best_fn=lambda metrics: metrics['te_loss'],
+                best_mode='min',
+                max_to_keep=4,
+                enable_async_checkpointing=True,
+                keep_time_interval=timedelta(minutes=30),
+            ),
+            item_handlers=ocp.PyTreeCheckpointHandler(),
+        )
+        # step, start time, and seconds blocked of the save being written
+        self.pending: Optional[tuple[int, float, float]] = None
+
+    def poll(self, wait: bool = False) -> list[dict[str, float]]:
+        """The statistics of the last save, if it's been written since the last poll. If wait,
+        waits for it to be written."""
+        if self.pending is None:
+            return []
+        if wait:
+            self.mngr.wait_until_finished()
+        elif self.mngr.is_saving_in_progress():
+            return []
+
+        step, start, blocked = self.pending
+        self.pending = None
+        step_dir = self.directory / str(step)
+        stats = {
+            'step': step,
+            'save_s': time.monotonic() - start,
+            'save_blocked_s': blocked,
+            'save_bytes': dir_bytes(step_dir) if step_dir.exists() else 0,
+        }
+        logging.info(
+            'Saved checkpoint %d: %.2f s, %.2f s blocking, %.1f MB',
+            step,
+            stats['save_s'],
+            blocked,
+            stats['save_bytes'] / 1e6,
+        )
+        return [stats]
+
+    def save(self, step: int, ckpt, metrics: dict[str, float]) -> list[dict[str, float]]:
+        """Starts saving the checkpoint, after the previous save is written. Returns the
+        statistics of the previous save, if poll hasn't."""
+        stats = self.poll(wait=True)
+        start = time.monotonic()
+        self.mngr.save(step, args=ocp.args.PyTreeSave(ckpt), metrics=metrics)
+        self.pending = (step, start, time.monotonic() - start)
+        return stats
+
+    def latest_step(self) -> Optional[int]:
+        return self.mngr.latest_step()
+
+    def restore_info(self, step: int) -> dict[str, Any]:
+        """Everything in the checkpoint but the training state, which needs a template to be
+        restored to the right devices. Entries older checkpoints lack are left out."""
+        tree = self.mngr.item_metadata(step).tree
+        keys = ('seed', 'curr_epoch', 'loader', 'metrics_history')
+        item = {k: tree[k] for k in keys if k in tree}
+        item = jax.tree.map(lambda _: 0, item, is_leaf=lambda x: not isinstance(x, (dict, list)))
+        args = jax.tree.map(lambda _: ocp.RestoreArgs(restore_type=np.ndarray), item)
+        return self.mngr.restore(
+            step, args=ocp.args.PyTreeRestore(item=item, restore_args=args, partial_restore=True)
+        )
+
+    def restore_state(self, step: int, template) -> tuple[Any, dict[str, float]]:
+        """Restores the training state of the checkpoint to the shardings of the template. Also
+        returns how long it took and how large the checkpoint is."""
+        start = time.monotonic()
+        restored = self.mngr.restore(
+            step,
+            args=ocp.args.PyTreeRestore(
+                item={'state': template},
+                restore_args={'state': restore_args(template)},
+                partial_restore=True,
+            ),
+        )
+        stats = {
+            'step': step,
+            'restore_s': time.monotonic() - start,
+            'restore_bytes': dir_bytes(self.directory / str(step)),
+        }
+        logging.info(
+            'Restored checkpoint %d: %.2f s, %.1f MB',
+            step,
+            stats['restore_s'],
+            stats['restore_bytes'] / 1e6,
+        )
+        return restored['state'], stats
+
+    def wait(self) -> list[dict[str, float]]:
+        return self.poll(wait=True)
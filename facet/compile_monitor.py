@@ -0,0 +1,216 @@
+"""
+Telemetry of tracing and compilation, to see when and why jitted functions recompile.
+
+JAX reports every trace and compile through jax.monitoring, by function name, with how long it
+took, and whether the compile was a hit or a miss in the persistent compilation cache. MONITOR
+listens for those events for every function, so it costs nothing between compiles.
+
+Functions decorated with watch_traces, under jax.jit like chex.assert_max_traces, also record the
+abstract signature they were traced with: the shape and dtype of every array argument, and the
+value of every other argument. Each retrace is logged with what changed from the previous one, like
+a batch with fewer graphs or a new static config.
+
+TrainingRun logs the totals as metrics, and a summary by function at the end of the run.
+"""
+
+import functools as ft
+import inspect
+import logging
+import threading
+from collections import defaultdict
+from typing import Callable, NamedTuple, Optional
+
+import jax
+from jax import monitoring
+from rich import box
+from rich.table import Table
+
+TRACE_EVENT = '/jax/core/compile/jaxpr_trace_duration'
+COMPILE_EVENT = '/jax/core/compile/backend_compile_duration'
+CACHE_EVENTS = {
+    '/jax/compilation_cache/cache_hits': 'hit',
+    '/jax/compilation_cache/cache_misses': 'miss',
+}
+
+# changes shown for each retrace
+MAX_CHANGES = 5
+
+
+class TraceRecord(NamedTuple):
+    name: str
+    trace_s: float
+    # What differs from the previous trace of a watched function, empty otherwise.
+    changes: tuple[str, ...] = ()
+
+
+class CompileRecord(NamedTuple):
+    name: str
+    compile_s: float
+    # 'hit' or 'miss' in the persistent compilation cache, or None if the cache wasn't used.
+    cache: Optional[str] = None
+
+
+def fun_name(name: str) -> str:
+    """The function name, without the jit(...) JAX puts around it."""
+    while name.startswith('jit(') and name.endswith(')'):
+        name = name[4:-1]
+    return name
+
+
+def describe(value) -> str:
+    """Describes an argument the way tracing sees it: the abstract value of arrays, and the value of
+    anything else."""
+    if hasattr(value, 'shape') and hasattr(value, 'dtype'):
+        kind = value.dtype.name.replace('float', 'f').replace('uint', 'u').replace('int', 'i')
+        weak = '(weak)' if getattr(getattr(value, 'aval', None), 'weak_type', False) else ''
+        return f'{kind}{list(value.shape)}{weak}'
+
+    desc = repr(value)
+    if len(desc) > 40:
+        try:
+            key = hash(value)
+        except TypeError:
+            key = id(value)
+        desc = f'{type(value).__name__}#{key & 0xFFFFFF:06x}'
+    return desc
+
+
+def abstract_signature(fun_signature: inspect.Signature, args, kwargs) -> dict[str, str]:
+    """The description of every leaf of the arguments, by path."""
+    bound = fun_signature.bind(*args, **kwargs)
+    leaves, _ = jax.tree_util.tree_flatten_with_path(dict(bound.arguments))
+    return {jax.tree_util.keystr(path): describe(leaf) for path, leaf in leaves}
+
+
+def signature_diff(old: dict[str, str], new: dict[str, str]) -> tuple[str, ...]:
+    changes = []
+    for path in new:
+        if path not in old:
+            changes.append(f'{path}: new {new[path]}')
+        elif old[path] != new[path]:
+            changes.append(f'{path}: {old[path]} -> {new[path]}')
+    changes.extend(f'{path}: removed' for path in old if path not in new)
+    if len(changes) > MAX_CHANGES:
+        changes = changes[:MAX_CHANGES] + [f'and {len(changes) - MAX_CHANGES} more']
+    return tuple(changes)
+
+
+class CompileMonitor:
+    """Records the traces and compiles of every jitted function."""
+
+    def __init__(self):
+        self.traces: list[TraceRecord] = []
+        self.compiles: list[CompileRecord] = []
+        self.signatures: dict[str, dict[str, str]] = {}
+        # changes of watched functions, waiting for the trace event they belong to
+        self.pending_changes: dict[str, tuple[str, ...]] = {}
+        self.lock = threading.Lock()
+        # the cache event of a compile comes before the compile event, on the same thread
+        self.local = threading.local()
+
+        monitoring.register_event_listener(self.on_event)
+        monitoring.register_event_duration_secs_listener(self.on_duration)
+
+    def on_event(self, event: str, **kwargs):
+        if event in CACHE_EVENTS:
+            self.local.cache = CACHE_EVENTS[event]
+
+    def on_duration(self, event: str, duration_s: float, **kwargs):
+        if event == TRACE_EVENT:
+            name = fun_name(kwargs.get('fun_name', '?'))
+            with self.lock:
+                changes = self.pending_changes.pop(name, ())
+                self.traces.append(TraceRecord(name, duration_s, changes))
+        elif event == COMPILE_EVENT:
+            name = fun_name(kwargs.get('fun_name', '?'))
+            cache = getattr(self.local, 'cache', None)
+            self.local.cache = None
+            with self.lock:
+                self.compiles.append(CompileRecord(name, duration_s, cache))
+
+    def watch(self, fun: Callable) -> Callable:
+        """Records the signature fun is traced with, and logs what changed when it's retraced.
+        Goes under jax.jit, so it only runs when tracing."""
+        name = fun.__name__
+        fun_signature = inspect.signature(fun)
+
+        @ft.wraps(fun)
+        def wrapped(*args, **kwargs):
+            new = abstract_signature(fun_signature, args, kwargs)
+            with self.lock:
+                old = self.signatures.get(name)
+                self.signatures[name] = new
+                if old is not None:
+                    changes = signature_diff(old, new) or ('same signature',)
+                    self.pending_changes[name] = changes
+
+            if old is None:
+                logging.debug(f'Tracing {name}')
+            else:
+                logging.warning(f'Retracing {name}: {"; ".join(changes)}')
+            return fun(*args, **kwargs)
+
+        return wrapped
+
+    def totals(self) -> dict[str, float]:
+        with self.lock:
+            return {
+                'traces': len(self.traces),
+                'compiles': len(self.compiles),
+                'compile_s': sum(c.compile_s for c in self.compiles),
+                'cache_hits': sum(c.cache == 'hit' for c in self.compiles),
+                'cache_misses': sum(c.cache == 'miss' for c in self.compiles),
+            }
+
+    def summary(self) -> dict[str, dict]:
+        """Traces and compiles by function, the most time spent compiling first. Watched functions
+        also have the changes that caused their last retrace."""
+        by_name: dict[str, dict] = defaultdict(
+            lambda: {
+                'traces': 0,
+                'trace_s': 0.0,
+                'compiles': 0,
+                'compile_s': 0.0,
+                'cache_hits': 0,
+                'cache_misses': 0,
+            }
+        )
+        with self.lock:
+            for trace in self.traces:
+                stats = by_name[trace.name]
+                stats['traces'] += 1
+                stats['trace_s'] += trace.trace_s
+                if trace.changes:
+                    stats['last_retrace'] = '; '.join(trace.changes)
+            for record in self.compiles:
+                stats = by_name[record.name]
+                stats['compiles'] += 1
+                stats['compile_s'] += record.compile_s
+                stats['cache_hits'] += record.cache == 'hit'
+                stats['cache_misses'] += record.cache == 'miss'
+
+        return dict(sorted(by_name.items(), key=lambda kv: -kv[1]['compile_s']))
+
+    def table(self, max_rows: int = 15) -> Table:
+        """The summary, as a table of the functions that took longest to compile."""
+        summary = self.summary()
+        table = Table(title='Tracing and compilation', box=box.SIMPLE)
+        for column in ('Function', 'Traces', 'Compiles', 'Compile s', 'Cache hit/miss'):
+            table.add_column(column, justify='left' if column == 'Function' else 'right')
+        table.add_column('Last retrace', overflow='fold')
+        for name, stats in list(summary.items())[:max_rows]:
+            table.add_row(
+                name,
+                str(stats['traces']),
+                str(stats['compiles']),
+                f'{stats["compile_s"]:.2f}',
+                f'{stats["cache_hits"]}/{stats["cache_misses"]}',
+                stats.get('last_retrace', ''),
+            )
+        if len(summary) > max_rows:
+            table.caption = f'and {len(summary) - max_rows} more functions'
+        return table
+
+
+MONITOR = CompileMonitor()
+watch_traces = MONITOR.watch
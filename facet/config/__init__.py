@@ -41,6 +41,18 @@ class LogConfig:
     # Test every n epochs:
     epochs_per_valid: float = 0.5
 
+    # Run validation in the background, logging the results once they're ready.
+    async_valid: bool = False
+
+    # Where to send metrics: 'jsonl' appends them to metrics.jsonl in the run folder, and
+    # 'neptune' logs them to Neptune.
+    sinks: list[str] = field(default_factory=lambda: ['jsonl', 'neptune'])
+
+    # Debug probes to enable: names of probes, or of the modules they're in, like
+    # 'facet.mace.message_passing'. Probes that aren't enabled aren't compiled in. Training runs
+    # enable them when they start.
+    probes: list[str] = field(default_factory=list)
+
     # Neptune tags.
     tags: list[str] = field(default_factory=list)
 
@@ -219,6 +231,10 @@ class DeviceConfig:
     # IDs of GPUs to use.
     gpu_ids: list[int] = field(default_factory=list)
 
+    # Index of a spare device to run validation on. None means validation uses the training
+    # devices.
+    valid_device: Optional[int] = None
+
     def devices(self):
         devs = jax.devices(self.device)
         if self.device == 'gpu' and self.max_gpus != 0:
@@ -230,6 +246,12 @@ class DeviceConfig:
 
         return devs
 
+    def validation_device(self) -> Optional[jax.Device]:
+        if self.valid_device is None:
+            return None
+        else:
+            return jax.devices(self.device)[self.valid_device]
+
     def jax_device(self):
         devs = self.devices()
 
@@ -257,13 +279,20 @@ class LossConfig:
     force_weight: float = 0
     stress_weight: float = 0
 
+    # What to differentiate to get forces and stress: 'positions' or 'edges'. Both give the same
+    # results: see EFSWrapper.
+    grad_mode: str = 'positions'
+
     def regression_loss(self, preds, targets, mask):
         return self.reg_loss.regression_loss(preds, targets, mask)
 
     @property
     def efs_wrapper(self) -> EFSWrapper:
-        compute_fs = not (self.force_weight == 0 and self.stress_weight == 0)
-        return EFSWrapper(compute_fs=compute_fs)
+        return EFSWrapper(
+            compute_force=self.force_weight != 0,
+            compute_stress=self.stress_weight != 0,
+            grad_mode=self.grad_mode,
+        )
 
     @property
     def efs_loss(self) -> EFSLoss:
@@ -510,6 +539,11 @@ class MainConfig:
     # Folder to initialize all parameters from, if the folder exists.
     restart_from: Optional[Path] = None
 
+    # If restarting, resume restart_from's run from its last checkpoint, in the same folder: the
+    # parameters, optimizer and EMA state, step, metrics and data order all continue. Otherwise,
+    # a new run starts with the parameters of restart_from's best checkpoint.
+    resume: bool = False
+
     # Precision: 'f32' or 'bf16'.
     precision: str = 'f32'
 
@@ -18,6 +18,7 @@ from textual.worker import get_current_worker
 from textual_plotext import PlotextPlot
 
 from facet.config import MainConfig
+from facet.dashboard_feed import DashboardFeed, plot_range
 from facet.training_state import TrainingRun
 from facet.utils import format_scalar
 
@@ -62,28 +63,14 @@ class Losses(PlotextPlot):
             nvals = len((list(self._data.values()) + [[0]])[0])
             self.plt.ylabel(self._unit)
             # step = np.arange(len(next(iter(self._data))))
-            max_data = 0
             if 'epoch' in self._data:
                 xx = self._data['epoch']
             else:
                 xx = np.arange(nvals)
 
-            x_end = max(xx, default=1)
+            x_end, ymax = plot_range(self._data)
             self.plt.xlim(0, x_end * 1.01)
 
-            # cut off everything before a certain value on the x-axis
-            # when computing y-axis
-            cutoff = max(0, np.sqrt(x_end) - 2)
-
-            losses = [k for k in self._data if k.endswith('_loss')]
-            ymax = max(
-                [
-                    max([y for x, y in zip(xx, self._data[k]) if x >= cutoff], default=10)
-                    for k in losses
-                ],
-                default=10,
-            )
-
             plotted = []
 
             for name, color in zip(self._data, cycle(self._colors)):
@@ -95,13 +82,6 @@ class Losses(PlotextPlot):
                 if min(yvals) < 0 or max(yvals) > 20:
                     continue
 
-                max_data = max(
-                    max_data,
-                    max(
-                        [y for x, y in zip(xx, yvals) if x >= cutoff and y <= ymax * 1.1], default=1
-                    ),
-                )
-
                 self.plt.plot(xx, [min(ymax * 1.09, y) for y in yvals], color=color, label=name)
                 if self._plotted is None:
                     plotted.append(name)
@@ -157,12 +137,12 @@ class Info(Widget):
     def __init__(self, dataa={}):
         super().__init__()
 
-    def update_data(self, dataa):
+    def update_data(self, rows: list[dict[str, Any]]):
         tab = self.widget
         tab.clear(columns=True)
-        df = pd.DataFrame(dataa)
+        df = pd.DataFrame(rows)
         tab.add_columns(*df.columns)
-        tab.add_rows(df.map(format_scalar).values[-15:])
+        tab.add_rows(df.map(format_scalar).values)
 
     def compose(self):
         self.widget = DataTable(show_cursor=False, zebra_stripes=True)
@@ -198,22 +178,29 @@ class Dashboard(App):
         ('q', 'app.quit', 'Quit training'),
     ]
 
-    data = reactive({})
     colors = reactive(lambda: rp.matplotlib.DARK_COLORS)
 
     def __init__(
-        self, run: TrainingRun, config: MainConfig, plot_cols=('tr', 'te', 'epoch')
+        self,
+        run: TrainingRun,
+        config: MainConfig,
+        plot_cols=('tr', 'te', 'epoch'),
+        updates_per_s: float = 2,
     ) -> None:
-        """Initialise the application."""
+        """Initialise the application. The display is updated at most updates_per_s times per
+        second, from the app's own thread, so training never waits on it."""
         super().__init__()
         self._run: TrainingRun = run
         self._plot_cols = plot_cols
         self._config = config
+        self._updates_per_s = updates_per_s
+        self.feed = DashboardFeed(run.metrics_history)
         self.info = Info()
         self.progress = ProgressBar(total=(run.num_epochs - 1) * run.steps_in_epoch, id='bar')
 
     def on_mount(self):
         self.log(self._run)
+        self.set_interval(1 / self._updates_per_s, self.update_data)
         self.run_worker(lambda: self.stream_data(self._run), thread=True)
 
     def compose(self) -> ComposeResult:
@@ -225,21 +212,20 @@ class Dashboard(App):
             yield Center(self.progress)
         yield Footer()
 
-    def update_data(self, data):
-        self.data = data
-        self.watch_data()
+    def update_data(self) -> None:
+        """Shows the metrics logged since the last update, if there are any."""
+        if not self.feed.poll():
+            return
 
-    def watch_data(self) -> None:
+        data = self.feed.plot_data()
         filtered_data = {
-            k: v
-            for k, v in self.data.items()
-            if any(k.startswith(pref) for pref in self._plot_cols)
+            k: v for k, v in data.items() if any(k.startswith(pref) for pref in self._plot_cols)
         }
         for plot in self.query(Losses).results(Losses):
             plot.update_data(filtered_data)
 
-        self.info.update_data(self.data)
-        steps = max(self.data['step']) if 'step' in self.data else 1
+        self.info.update_data(self.feed.table_data())
+        steps = self.feed.recent[-1].get('step', 1)
 
         if steps > self._run.steps_in_epoch:
             self.progress.update(progress=steps - self._run.steps_in_epoch)
@@ -250,17 +236,14 @@ class Dashboard(App):
             plot.update_colors(self.colors)
 
     def stream_data(self, run_state: TrainingRun):
+        """Trains in the worker thread. The display reads the metrics on its own schedule."""
         worker = get_current_worker()
-        update_every_step = 1
         for state in run_state.step_until_done():
-            if not worker.is_cancelled and state is not None:
-                if state.curr_step % update_every_step == 0:
-                    self.call_from_thread(self.update_data, state.metrics_history)
-            else:
+            if worker.is_cancelled or state is None:
                 break
 
-        self.call_from_thread(self.update_data, state.metrics_history)
-        self.call_from_thread(self.finish, state)
+        self.call_from_thread(self.update_data)
+        self.call_from_thread(self.finish, run_state)
 
     def watch_dark(self, dark: bool) -> None:
         self.colors = rp.matplotlib.DARK_COLORS if dark else rp.matplotlib.LIGHT_COLORS
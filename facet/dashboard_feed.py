@@ -0,0 +1,82 @@
+"""
+The data the training dashboard shows, read from a run at a bounded rate.
+
+The training thread doesn't send the dashboard anything: the dashboard polls the feed from its own
+event loop a few times a second. Each poll reads only the rows of the metrics history logged since
+the last one. It adds them to series downsampled to a bounded number of points, and keeps the last
+few rows for the table. Updates cost the same however long the run has been going, and the training
+thread never waits on the UI.
+"""
+
+from collections import deque
+from typing import Any, Mapping, Sequence
+
+import numpy as np
+
+
+class DashboardFeed:
+    """Incremental, downsampled view of a metrics history that another thread appends rows to.
+
+    A row is complete once every metric has a value for it. Every stride-th row is kept, and the
+    stride doubles whenever more than max_points rows would be kept, so the series always cover the
+    whole run."""
+
+    def __init__(
+        self, history: Mapping[str, Sequence], max_points: int = 512, num_recent: int = 15
+    ):
+        self.history = history
+        self.max_points = max_points
+        self.num_read = 0
+        self.stride = 1
+        self.series: dict[str, list] = {}
+        self.recent: deque[dict[str, Any]] = deque(maxlen=num_recent)
+
+    def poll(self) -> bool:
+        """Reads the rows logged since the last poll. Returns whether there were any."""
+        # a shallow copy, so metrics added meanwhile don't change the dictionary being read
+        history = dict(self.history)
+        num_rows = min((len(values) for values in history.values()), default=0)
+        if num_rows <= self.num_read:
+            return False
+
+        for i in range(self.num_read, num_rows):
+            row = {k: values[i] for k, values in history.items()}
+            self.recent.append(row)
+            if i % self.stride == 0:
+                for k, v in row.items():
+                    self.series.setdefault(k, []).append(v)
+        self.num_read = num_rows
+
+        while len(next(iter(self.series.values()))) > self.max_points:
+            self.series = {k: values[::2] for k, values in self.series.items()}
+            self.stride *= 2
+        return True
+
+    def plot_data(self) -> dict[str, list]:
+        """The downsampled series, ending with the latest row."""
+        if not self.recent or (self.num_read - 1) % self.stride == 0:
+            return self.series
+        last = self.recent[-1]
+        return {k: [*values, last[k]] for k, values in self.series.items()}
+
+    def table_data(self) -> list[dict[str, Any]]:
+        return list(self.recent)
+
+
+def plot_range(data: Mapping[str, Sequence[float]]) -> tuple[float, float]:
+    """The end of the x-axis and the top of the y-axis for plotting the losses. Values before the
+    square root of the epoch, less 2, are left out of the y-axis, so it isn't dominated by the first
+    few epochs."""
+    if 'epoch' in data:
+        xx = np.asarray(data['epoch'])
+    else:
+        xx = np.arange(len(next(iter(data.values()), [])))
+
+    x_end = float(np.max(xx)) if len(xx) else 1
+    cutoff = max(0, np.sqrt(x_end) - 2)
+
+    def loss_max(values) -> float:
+        shown = np.asarray(values)[xx >= cutoff]
+        return float(np.max(shown)) if len(shown) else 10
+
+    return x_end, max((loss_max(v) for k, v in data.items() if k.endswith('_loss')), default=10)
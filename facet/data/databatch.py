@@ -1,7 +1,6 @@
 from typing import Sequence
 from flax import struct
 from jaxtyping import Float, Array, Int, Bool
-import e3nn_jax as e3nn
 import jax
 
 import jax.numpy as jnp
@@ -19,9 +18,9 @@ class NodeData(struct.PyTreeNode):
     @classmethod
     def new_empty(cls, nodes: int) -> 'NodeData':
         return cls(
-            species=empty(nodes, dtype=np.int16),
-            cart=empty((nodes, 3)),
-            graph_i=empty(nodes, dtype=np.int16),
+            species=empty(nodes, dtype=np.uint8),
+            cart=empty((nodes, 3), dtype=np.float32),
+            graph_i=empty(nodes, dtype=np.uint16),
         )
 
 
@@ -33,7 +32,7 @@ class EdgeData(struct.PyTreeNode):
     def new_empty(cls, nodes: int, k: int) -> 'EdgeData':
         return cls(
             to_jimage=empty((nodes, k, 3), dtype=np.int8),
-            receiver=empty((nodes, k), dtype=np.uint32),
+            receiver=empty((nodes, k), dtype=np.uint16),
         )
 
 
@@ -42,14 +41,41 @@ class CrystalData(struct.PyTreeNode):
     abc: Float[Array, 'graphs 3']
     angles_rad: Float[Array, 'graphs 3']
     lat: Float[Array, 'graphs 3 3']
+    # cell volume (Å^3) and its inverse, both 0 for padding
+    volume: Float[Array, 'graphs']
+    inv_volume: Float[Array, 'graphs']
 
     @classmethod
     def new_empty(cls, graphs: int) -> 'CrystalData':
         return cls(
-            abc=empty((graphs, 3)),
-            angles_rad=empty((graphs, 3)),
-            lat=empty((graphs, 3, 3)),
-            dataset_id=empty(graphs, dtype=np.int32),
+            abc=empty((graphs, 3), dtype=np.float32),
+            angles_rad=empty((graphs, 3), dtype=np.float32),
+            lat=empty((graphs, 3, 3), dtype=np.float32),
+            volume=empty((graphs,), dtype=np.float32),
+            inv_volume=empty((graphs,), dtype=np.float32),
+            dataset_id=empty(graphs, dtype=np.uint32),
+        )
+
+    @classmethod
+    def from_lattice(cls, lat, dataset_id: int = 0, dtype=np.float32) -> 'CrystalData':
+        """The data of a single structure with lattice vectors lat (rows, Å). The geometry is
+        computed in double precision and stored as dtype: single precision, like the stored
+        datasets, unless the structure is going to be simulated in 64 bits."""
+        lat = np.asarray(lat, dtype=np.float64)
+        abc = np.linalg.norm(lat, axis=1)
+        cos_angles = [
+            lat[1] @ lat[2] / (abc[1] * abc[2]),
+            lat[0] @ lat[2] / (abc[0] * abc[2]),
+            lat[0] @ lat[1] / (abc[0] * abc[1]),
+        ]
+        volume = abs(np.linalg.det(lat))
+        return cls(
+            dataset_id=narrow([dataset_id], np.uint32),
+            abc=abc[None].astype(dtype),
+            angles_rad=np.arccos(np.array([cos_angles])).astype(dtype),
+            lat=lat[None].astype(dtype),
+            volume=np.array([volume], dtype=dtype),
+            inv_volume=np.array([1 / volume], dtype=dtype),
         )
 
 
@@ -66,9 +92,9 @@ class TargetInfo(struct.PyTreeNode):
     @classmethod
     def new_empty(cls, graphs: int, nodes: int) -> 'TargetInfo':
         return cls(
-            e_form=empty((graphs,)),
-            force=empty((nodes, 3)),
-            stress=empty((graphs, 3, 3)) + np.eye(3),
+            e_form=empty((graphs,), dtype=np.float32),
+            force=empty((nodes, 3), dtype=np.float32),
+            stress=empty((graphs, 3, 3), dtype=np.float32) + np.eye(3, dtype=np.float32),
         )
 
 
@@ -116,7 +142,14 @@ class CrystalGraphs(struct.PyTreeNode):
         return self.target_data.e_form
 
     def __add__(self, other: 'CrystalGraphs') -> 'CrystalGraphs':
-        """Collates both objects together, taking care to deal with index offsets."""
+        """Collates both objects together, taking care to deal with index offsets. Raises
+        OverflowError if the combined indices don't fit in their types."""
+        for name, index, total in (
+            ('graph_i', self.nodes.graph_i, self.n_total_graphs + other.n_total_graphs),
+            ('receiver', self.edges.receiver, self.n_total_nodes + other.n_total_nodes),
+        ):
+            if np.issubdtype(index.dtype, np.integer) and total - 1 > np.iinfo(index.dtype).max:
+                raise OverflowError(f'{total} indices do not fit in {name}, of type {index.dtype}')
         other_nodes = other.nodes.replace(
             graph_i=other.nodes.graph_i + self.n_total_graphs,
         )
@@ -156,9 +189,32 @@ class CrystalGraphs(struct.PyTreeNode):
             padding_mask=empty(graphs, dtype=np.bool_),
         )
 
+    def to_storage(self, target_dtype=np.float32) -> 'CrystalGraphs':
+        """Converts to NumPy arrays of the storage types, for writing to disk and moving to the
+        device."""
+        return jax.tree.map(narrow, self, storage_dtypes(target_dtype))
+
+    def to_compute(self, dtype=jnp.float32) -> 'CrystalGraphs':
+        """Upcasts from the storage types: floats to dtype, and unsigned indices narrower than 32
+        bits to int32, so arithmetic on them can't wrap around. Run this on the device, so only the
+        compact types are transferred."""
+
+        def upcast(x):
+            if jnp.issubdtype(x.dtype, jnp.floating):
+                return x.astype(dtype)
+            elif jnp.issubdtype(x.dtype, jnp.unsignedinteger) and x.dtype.itemsize < 4:
+                return x.astype(jnp.int32)
+            else:
+                return x
+
+        return jax.tree.map(upcast, self)
+
     def rotate(self, seed: int) -> tuple['CrystalGraphs', Float[Array, 'n_graph 3 3']]:
         """Rotate the coordinates using random rotation matrices. Returns the rotated outputs and
         the matrices."""
+        # importing e3nn is slow, and nothing else here needs it
+        import e3nn_jax as e3nn
+
         rots = e3nn.rand_matrix(jax.random.key(seed), shape=(self.n_total_graphs,))
         lat_rot_m = jnp.einsum('bij,bjk->bik', self.globals.lat, rots)
         new_carts = jnp.einsum('bik,bi->bk', lat_rot_m[self.nodes.graph_i], self.frac)
@@ -173,6 +229,44 @@ class CrystalGraphs(struct.PyTreeNode):
         yield 'graphs', self.globals.dataset_id.shape
 
 
+def storage_dtypes(target_dtype=np.float32) -> CrystalGraphs:
+    """The type of every field when stored or transferred. Indices are as narrow as the batch
+    shapes allow, and floats are single precision, which is all the model computes in. The
+    targets can be stored as float16 to save more space."""
+    f32 = np.dtype(np.float32)
+    target = np.dtype(target_dtype)
+    return CrystalGraphs(
+        nodes=NodeData(species=np.dtype(np.uint8), cart=f32, graph_i=np.dtype(np.uint16)),
+        edges=EdgeData(to_jimage=np.dtype(np.int8), receiver=np.dtype(np.uint16)),
+        n_node=np.dtype(np.uint16),
+        padding_mask=np.dtype(np.bool_),
+        graph_data=CrystalData(
+            dataset_id=np.dtype(np.uint32),
+            abc=f32,
+            angles_rad=f32,
+            lat=f32,
+            volume=f32,
+            inv_volume=f32,
+        ),
+        target_data=TargetInfo(e_form=target, force=target, stress=target),
+    )
+
+
+def narrow(x, dtype) -> np.ndarray:
+    """Converts x to a NumPy array of dtype, raising OverflowError if any value of an integer
+    dtype is out of its range, instead of silently wrapping around."""
+    x = np.asarray(x)
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer) and x.size > 0:
+        info = np.iinfo(dtype)
+        if x.min() < info.min or x.max() > info.max:
+            raise OverflowError(
+                f'Values from {x.min()} to {x.max()} do not fit in {dtype}, which holds '
+                f'{info.min} to {info.max}'
+            )
+    return x.astype(dtype)
+
+
 def collate(graphs: Sequence[CrystalGraphs]) -> CrystalGraphs:
     """Collates the batches into a new Graphs object."""
     return sum(graphs[1:], start=graphs[0])
@@ -1,8 +1,10 @@
 """Code to load the processed data."""
 
-import functools as ft
-from collections.abc import Sequence
+import queue
+import threading
+from collections.abc import Iterator, Sequence
 from itertools import batched, cycle
+from pathlib import Path
 from typing import Generator, Literal
 from warnings import filterwarnings
 
@@ -13,9 +15,12 @@ import numpy as np
 import pyrallis
 import zarr  # type: ignore
 from beartype.roar import BeartypeDecorHintPep585DeprecationWarning
+from flax import struct
 from flax.serialization import from_state_dict, to_state_dict
 
+from facet.compile_monitor import watch_traces
 from facet.data.databatch import CrystalGraphs, collate
+from facet.stress import cell_volume, inverse_volume
 from facet.utils import debug_structure, load_pytree
 
 filterwarnings('ignore', category=BeartypeDecorHintPep585DeprecationWarning)
@@ -29,19 +34,25 @@ def load_raw(config: 'MainConfig', group_num=0, file_num=0):
     return load_pytree(fn)
 
 
-@ft.partial(jax.jit)
 def process_raw(raw_data) -> CrystalGraphs:
+    """Converts a loaded file to CrystalGraphs with the storage types, on the host. Older files
+    with wider types are narrowed, so batches are transferred to the device compactly."""
     nodes, k = raw_data['edges']['receiver'].shape
     graphs = raw_data['padding_mask'].shape[0]
+    graph_data = raw_data['graph_data']
+    if graph_data.get('volume') is None:
+        # older files don't store the volume
+        volume = cell_volume(np.asarray(graph_data['lat']))
+        graph_data = {**graph_data, 'volume': volume, 'inv_volume': inverse_volume(volume)}
+        raw_data = {**raw_data, 'graph_data': graph_data}
     # debug_structure(raw_data=raw_data, templ=CrystalGraphs.new_empty(nodes, k, graphs))
     # raw_data['n_node'] = raw_data['n_node'][:graphs]
     data: CrystalGraphs = from_state_dict(
         CrystalGraphs.new_empty(nodes, k, graphs),
         raw_data,
     )  # type: ignore
-    # data = jax.tree.map(jnp.array, data)
 
-    return data
+    return data.to_storage()
 
 
 def load_file(config: 'MainConfig', group_num=0, file_num=0) -> CrystalGraphs:
@@ -81,25 +92,25 @@ def load_file_zarr(config: 'MainConfig', group_num=0, file_num=0):
 
 
 @jax.jit
+def to_compute(cg: CrystalGraphs) -> CrystalGraphs:
+    return cg.to_compute()
+
+
+@jax.jit
+@watch_traces
 @chex.assert_max_traces(2)
 def stack_trees(cgs: Sequence[CrystalGraphs]) -> CrystalGraphs:
     return jax.tree.map(lambda *args: jnp.stack(args), *cgs)
 
 
-def dataloader_base(
-    config: 'MainConfig',
-    split: Literal['train', 'test', 'valid'] = 'train',
-    infinite: bool = False,
-    use_zarr: bool = False,
-    allow_padding: bool = True,
-):
-    """Returns a generator that produces batches to train on. If infinite, repeats forever:
-    otherwise, stops when all data has been yielded."""
-    file_load_fn = load_file_zarr if use_zarr else load_file
-    data_folder = config.data.dataset_folder
-    groups = sorted((data_folder / 'batches').glob('group_*'))
+def groups_in_split(
+    data_config: 'DataConfig', split: Literal['train', 'test', 'valid']
+) -> list[Path]:
+    """The group folders in the split, in the order the data loader reads them. The groups are
+    shuffled, and then assigned to the splits in proportion to their sizes."""
+    groups = sorted((data_config.dataset_folder / 'batches').glob('group_*'))
 
-    splits = np.cumsum([config.data.train_split, config.data.valid_split, config.data.test_split])
+    splits = np.cumsum([data_config.train_split, data_config.valid_split, data_config.test_split])
     total = splits[-1]
     split_inds = np.zeros(total)
     split_inds[: splits[0]] = 0
@@ -108,22 +119,64 @@ def dataloader_base(
 
     split_i = ['train', 'valid', 'test'].index(split)
 
-    shuffle_rng = np.random.default_rng(config.data.shuffle_seed)
+    shuffle_rng = np.random.default_rng(data_config.shuffle_seed)
 
     split_idx = shuffle_rng.permutation(len(groups))
     split_idx = split_idx[split_inds[np.arange(len(split_idx)) % total] == split_i]
+    return [groups[i] for i in split_idx]
+
+
+@struct.dataclass
+class LoaderState:
+    """Position of the training data loader: the seed of its shuffles, the epoch, and the number
+    of stacked batches already yielded in the epoch. Stored in checkpoints, so a restarted run can
+    continue with exactly the batches it would have seen."""
 
-    # print(split_idx)
+    seed: int
+    epoch: int = 0
+    cursor: int = 0
 
-    shuffle_rng = np.random.default_rng(config.data.shuffle_seed)
+    def advance(self, batches_per_epoch: int, num_batches: int = 1) -> 'LoaderState':
+        epochs, cursor = divmod(self.cursor + num_batches, batches_per_epoch)
+        return self.replace(epoch=self.epoch + epochs, cursor=cursor)
 
-    device = config.device.jax_device()
+
+def num_stacked(config: 'MainConfig', device=None) -> int:
+    """Number of training batches stacked into each batch the data loader yields."""
+    if device is None:
+        device = config.device.jax_device()
     if isinstance(device, jax.sharding.Sharding):
-        stack_total = len(device.addressable_devices) * config.stack_size
+        return len(device.addressable_devices) * config.stack_size
     else:
-        stack_total = config.stack_size
+        return config.stack_size
 
-    split_groups = [groups[i] for i in split_idx]
+
+def dataloader_base(
+    config: 'MainConfig',
+    split: Literal['train', 'test', 'valid'] = 'train',
+    infinite: bool = False,
+    use_zarr: bool = False,
+    allow_padding: bool = True,
+    device=None,
+    start: LoaderState | None = None,
+):
+    """Returns a generator that produces batches to train on. If infinite, repeats forever:
+    otherwise, stops when all data has been yielded. If device is given, batches are put there
+    instead of the configured training devices.
+
+    If start is given, the generator begins at that position. The shuffles of the earlier epochs
+    are replayed without loading anything, so only the files that are yielded are read."""
+    file_load_fn = load_file_zarr if use_zarr else load_file
+
+    if start is None:
+        start = LoaderState(seed=config.data.shuffle_seed)
+    shuffle_rng = np.random.default_rng(start.seed)
+
+    if device is None:
+        device = config.device.jax_device()
+    stack_total = num_stacked(config, device)
+
+    split_groups = groups_in_split(config.data, split)
 
     group_files = []
 
@@ -139,56 +192,44 @@ def dataloader_base(
 
     split_idx = np.arange(len(group_files))
 
-    shuffle = shuffle_rng.permutation(split_idx)
-
     add_length = -len(group_files) % (config.train_batch_multiple * stack_total)
     if add_length != 0 and not allow_padding:
         raise ValueError(
             f'{len(group_files)} does not evenly divide {config.train_batch_multiple} * {stack_total // config.stack_size} * {config.stack_size}'
         )
 
-    shuffle = np.hstack((shuffle, shuffle[:add_length]))
-
-    batch_inds = np.split(
-        shuffle,
-        len(shuffle) // config.train_batch_multiple,
-    )
+    num_batches = (len(group_files) + add_length) // config.train_batch_multiple
+    yield num_batches
 
-    yield len(batch_inds)
+    # the padding makes the stacked batches divide every epoch evenly
+    stacks_per_epoch = num_batches // stack_total
+    epoch, cursor = divmod(start.epoch * stacks_per_epoch + start.cursor, stacks_per_epoch)
+    for _ in range(epoch):
+        shuffle_rng.permutation(split_idx)
 
+    # files are loaded the first time they're needed, and kept for later epochs
     split_files = {}
 
-    # assert len(batch_inds) % num_devices == 0, f'{len(batch_inds)} % {num_devices} != 0'
-
-    # file_data = list(map(functools.partial(load_raw, config), split_idx))
-    # byte_data = dict(zip(split_idx, file_data))
-
-    for batches in batched(batch_inds, stack_total):
-        for device_batch in batches:
-            for i in device_batch:
-                # print(group_files[i])
-                split_files[i] = file_load_fn(config, *group_files[i])
-        collated = [collate([split_files[i] for i in batch]) for batch in batches]
-        # debug_structure(collated)
-        stacked = stack_trees(collated)
-        yield jax.device_put(stacked, device)
-
-    # for i in shuffle[trunc_length:]:
-    #     split_files[i] = file_load_fn(config, *group_files[i])
-
-    while infinite:
+    while True:
         shuffle = shuffle_rng.permutation(split_idx)
         shuffle = np.hstack((shuffle, shuffle[:add_length]))
 
-        batch_inds = np.split(
-            shuffle,
-            len(shuffle) // config.train_batch_multiple,
-        )
+        batch_inds = np.split(shuffle, num_batches)
 
-        for batches in batched(batch_inds, stack_total):
+        for batches in list(batched(batch_inds, stack_total))[cursor:]:
+            for device_batch in batches:
+                for i in device_batch:
+                    if i not in split_files:
+                        split_files[i] = file_load_fn(config, *group_files[i])
             collated = [collate([split_files[i] for i in batch]) for batch in batches]
+            # debug_structure(collated)
             stacked = stack_trees(collated)
-            yield jax.device_put(stacked, device)
+            # the storage types are upcast after the transfer
+            yield to_compute(jax.device_put(stacked, device))
+
+        cursor = 0
+        if not infinite:
+            return
 
 
 def dataloader(
@@ -196,12 +237,54 @@ def dataloader(
     split: Literal['train', 'test', 'valid'] = 'train',
     infinite: bool = False,
     use_zarr: bool = False,
+    device=None,
+    start: LoaderState | None = None,
 ) -> tuple[int, Generator[CrystalGraphs, CrystalGraphs, None]]:
-    dl = dataloader_base(config, split, infinite, use_zarr)
+    dl = dataloader_base(config, split, infinite, use_zarr, device=device, start=start)
     steps_per_epoch = next(dl)
     return (steps_per_epoch, dl)  # type: ignore
 
 
+def prefetch(iterator: Iterator, size: int = 2) -> Generator:
+    """Loads the next size elements of the iterator in a background thread, so loading and
+    transfers overlap with computation. The thread stops once the generator is closed."""
+    buffer: queue.Queue = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        """Waits for room in the buffer, giving up if the consumer has stopped."""
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+        except Exception as e:  # noqa: BLE001
+            put(e)
+        put(done)
+
+    threading.Thread(target=producer, daemon=True).start()
+
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            elif isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
 if __name__ == '__main__':
     import numpy as np
 
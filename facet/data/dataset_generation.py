@@ -1,6 +1,5 @@
 """Code to generate datasets."""
 
-from collections import Counter
 from functools import cache
 import json
 import logging
@@ -17,6 +16,8 @@ from pathlib import Path
 import pickle
 import multiprocessing
 
+from facet.data.knn_store import KNNStore
+from facet.data.neighbors import knn_graph
 from facet.layers import edge_vecs
 from facet.utils import debug_structure, save_pytree
 
@@ -69,6 +70,12 @@ class KNN:
         structure, used for precomputed lookup."""
         raise NotImplementedError
 
+    def knn_graphs(
+        self, structs: Sequence[Structure], k: int, struct_ids: Sequence[int]
+    ) -> list[EdgeData]:
+        """Computes the k-NN graphs of several structures, such as those in a batch."""
+        return [self.knn_graph(struct, k, i) for struct, i in zip(structs, struct_ids)]
+
 
 class NaiveKNN(KNN):
     """
@@ -105,6 +112,16 @@ class NaiveKNN(KNN):
         return self._knn_graph_helper(struct, k=k, r_max=r_max)
 
 
+class FastKNN(KNN):
+    """
+    KNN graph creator using the vectorized search in facet.data.neighbors. Exact, and much faster
+    than NaiveKNN.
+    """
+
+    def knn_graph(self, struct: Structure, k: int, struct_id: int | None = None) -> EdgeData:
+        return knn_graph(struct.lattice.matrix, struct.cart_coords, k)
+
+
 class PrecomputedKNN(KNN):
     """
     KNN graph creator that uses precomputed graph files.
@@ -126,6 +143,37 @@ class PrecomputedKNN(KNN):
         return EdgeData(to_jimage=np.array(graph_data['ims']), receiver=np.array(graph_data['ijs']))
 
 
+class StoredKNN(KNN):
+    """
+    KNN graph creator that looks up graphs in a KNNStore, without unpickling anything. The store
+    is in the folder of graphs_path, and its name batch_{name}.pkl selects the raw batch, so the
+    store can replace the folder of pickles PrecomputedKNN reads.
+    """
+
+    def __init__(self, graphs_path: Path):
+        super().__init__(graphs_path=graphs_path)
+        self.store = KNNStore(graphs_path.parent)
+        self.batch_name = graphs_path.stem.removeprefix('batch_')
+
+    def knn_graph(self, struct: Structure, k: int, struct_id: int | None = None) -> EdgeData:
+        if struct_id is None:
+            raise ValueError('Stored k-NN only works if struct_id is passed')
+
+        return self.store.get(self.store.batch_ids(self.batch_name, [struct_id])[0])
+
+    def knn_graphs(
+        self, structs: Sequence[Structure], k: int, struct_ids: Sequence[int]
+    ) -> list[EdgeData]:
+        edges, n_node = self.store.lookup(self.store.batch_ids(self.batch_name, struct_ids))
+        splits = np.cumsum(n_node)[:-1]
+        return [
+            EdgeData(to_jimage=ims, receiver=ijs)
+            for ims, ijs in zip(
+                np.split(edges.to_jimage, splits), np.split(edges.receiver, splits)
+            )
+        ]
+
+
 def make_data_id_mp2022(df):
     base_id = (
         df['dataset-id']
@@ -193,49 +241,84 @@ class RMaxBinner:
     def __init__(self, bins: Sequence[float]):
         """Bins is a list of r_max values for binning."""
         self.bins = np.array(bins)
+        # counts[i, j] is the number of nodes with j neighbors within bins[i]
         self.counts: np.ndarray | None = None
 
     def update(self, dists: Float[Array, ' nodes k']):
+        dists = np.asarray(dists)
+        k = dists.shape[-1]
         if self.counts is None:
-            self.counts = np.zeros((len(self.bins), dists.shape[-1] + 1))
-        dists_in_range = dists[..., None] < self.bins[None, None, :]  # nodes k bins
+            self.counts = np.zeros((len(self.bins), k + 1), dtype=np.int64)
 
-        num_in_range = dists_in_range.sum(axis=1).T  # k[bins nodes]
+        num_in_range = (dists[..., None] < self.bins).sum(axis=1)  # nodes bins
+        # histogram every bin at once, by offsetting each bin's counts into its own row
+        flat_i = num_in_range + np.arange(len(self.bins)) * (k + 1)
+        self.counts += np.bincount(flat_i.ravel(), minlength=self.counts.size).reshape(
+            self.counts.shape
+        )
 
-        for i, counts in enumerate(num_in_range):
-            # counts: k[nodes]
-            uniq, uniq_counts = np.unique(counts, return_counts=True)
-            self.counts[i][uniq] += uniq_counts
+    def merge(self, other: 'RMaxBinner') -> 'RMaxBinner':
+        """Adds the counts of another binner with the same bins, from another worker."""
+        if not np.array_equal(self.bins, other.bins):
+            raise ValueError(f'Cannot merge binners with different bins: {self.bins}, {other.bins}')
+        if other.counts is not None:
+            self.counts = other.counts.copy() if self.counts is None else self.counts + other.counts
+        return self
 
 
 class GraphSummarizer:
     """Summarizes graph-level data into a DataFrame that can be processed separately."""
 
-    def __init__(self):
-        self.max_species = 0
-        self.species = []
-        self.total_energies = []
-        self.energies = []
+    def __init__(self, capacity: int = 1024):
+        """Capacity is the initial number of graphs to allocate space for: the buffers double in
+        size when they fill up."""
+        self.num_graphs = 0
+        # species_counts[i, j] is the number of atoms of species j in graph i
+        self.species_counts = np.zeros((capacity, 1), dtype=np.int32)
+        self.energies = np.zeros(capacity)
+
+    @property
+    def max_species(self) -> int:
+        return self.species_counts.shape[1] - 1
+
+    def reserve(self, num_graphs: int, num_species: int):
+        """Grows the buffers to fit the given number of graphs and species."""
+        capacity, width = self.species_counts.shape
+        if num_graphs <= capacity and num_species <= width:
+            return
+        if num_graphs > capacity:
+            capacity = max(num_graphs, 2 * capacity)
+        counts = np.zeros((capacity, max(num_species, width)), dtype=self.species_counts.dtype)
+        counts[: self.num_graphs, :width] = self.species_counts[: self.num_graphs]
+        energies = np.zeros(capacity)
+        energies[: self.num_graphs] = self.energies[: self.num_graphs]
+        self.species_counts, self.energies = counts, energies
 
     def update(self, species, energy):
-        self.max_species = max(self.max_species, max(species))
-        self.energies.append(energy)
-        self.total_energies.append(energy * len(species))
-        self.species.append(Counter(species))
+        species = np.asarray(species)
+        self.reserve(self.num_graphs + 1, species.max() + 1)
+        self.species_counts[self.num_graphs] = np.bincount(
+            species, minlength=self.species_counts.shape[1]
+        )
+        self.energies[self.num_graphs] = energy
+        self.num_graphs += 1
+
+    def merge(self, other: 'GraphSummarizer') -> 'GraphSummarizer':
+        """Appends the graphs of another summarizer, from another worker."""
+        n, m = self.num_graphs, other.num_graphs
+        self.reserve(n + m, other.species_counts.shape[1])
+        self.species_counts[n : n + m, : other.species_counts.shape[1]] = other.species_counts[:m]
+        self.energies[n : n + m] = other.energies[:m]
+        self.num_graphs += m
+        return self
 
     def to_df(self):
-        data = np.zeros((len(self.energies), self.max_species + 3))
-        for i, (species, energy, total_energy) in enumerate(
-            zip(self.species, self.energies, self.total_energies)
-        ):
-            for k, v in species.items():
-                data[i][k] = v
-
-            data[i][-2] = energy
-            data[i][-1] = total_energy
-
+        counts = self.species_counts[: self.num_graphs]
+        energies = self.energies[: self.num_graphs]
+        data = np.column_stack((counts, energies, energies * counts.sum(axis=1)))
         return pd.DataFrame(
-            data, columns=[*map(str, range(self.max_species + 1)), 'energy', 'total_energy']
+            data.astype(np.float64),
+            columns=[*map(str, range(self.max_species + 1)), 'energy', 'total_energy'],
         )
 
 
@@ -251,9 +334,47 @@ class BatchMetadataTracker:
         self.batches_per_group.append(0)
 
     def update(self, batch: CrystalGraphs):
+        padding_mask = np.asarray(batch.padding_mask)
         self.batches_per_group[-1] += 1
-        self.node_pad_fracs.append(batch.padding_mask[batch.nodes.graph_i].sum().item())
-        self.graph_pad_fracs.append(batch.padding_mask.sum().item())
+        self.node_pad_fracs.append(int(np.asarray(batch.n_node)[padding_mask].sum()))
+        self.graph_pad_fracs.append(int(padding_mask.sum()))
+
+    def merge(self, other: 'BatchMetadataTracker') -> 'BatchMetadataTracker':
+        """Appends the groups of another tracker, from another worker."""
+        self.batches_per_group.extend(other.batches_per_group)
+        self.node_pad_fracs.extend(other.node_pad_fracs)
+        self.graph_pad_fracs.extend(other.graph_pad_fracs)
+        return self
+
+
+def save_raw_metadata(
+    data_folder: Path,
+    indexer: ElementIndexer,
+    binner: RMaxBinner,
+    summarizer: GraphSummarizer,
+    tracker: BatchMetadataTracker,
+    num_batch: int,
+    num_atoms: int,
+    k: int,
+) -> dict:
+    """Writes the collected statistics to raw_metadata.json and energy_data.feather in
+    data_folder. Returns the raw metadata."""
+    raw_metadata = {
+        'r_max_bins': binner.bins.tolist(),
+        'r_max_counts': binner.counts.tolist(),
+        'atomic_numbers': indexer.numbers,
+        'batches_per_group': tracker.batches_per_group,
+        'node_pad_frac': tracker.node_pad_fracs,
+        'graph_pad_frac': tracker.graph_pad_fracs,
+        'num_batch': num_batch,
+        'num_atoms': num_atoms,
+        'k': k,
+    }
+    with open(data_folder / 'raw_metadata.json', 'w') as f:
+        json.dump(raw_metadata, f)
+
+    summarizer.to_df().to_feather(data_folder / 'energy_data.feather')
+    return raw_metadata
 
 
 @dataclass
@@ -286,6 +407,8 @@ class BatchProcessor:
             abc=np.array([struct.lattice.abc]),
             angles_rad=np.deg2rad(np.array([struct.lattice.angles])),
             lat=np.array([struct.lattice.matrix]),
+            volume=np.array([struct.volume]),
+            inv_volume=np.array([1 / struct.volume]),
         )
 
         if 'force' in row:
@@ -308,7 +431,7 @@ class BatchProcessor:
             nodes,
             edges,
             n_node=np.array([struct.num_sites], dtype=np.uint16),
-            padding_mask=jnp.ones((1,), dtype=np.bool_),
+            padding_mask=np.ones((1,), dtype=np.bool_),
             graph_data=data,
             target_data=target,
         )
@@ -323,22 +446,17 @@ class BatchProcessor:
         return cg
 
     def save_raw_metadata(self):
-        raw_metadata = {
-            'r_max_bins': self.binner.bins.tolist(),
-            'r_max_counts': self.binner.counts.tolist(),
-            'atomic_numbers': self.indexer.numbers,
-            'batches_per_group': self.tracker.batches_per_group,
-            'node_pad_frac': self.tracker.node_pad_fracs,
-            'graph_pad_frac': self.tracker.graph_pad_fracs,
-            'num_batch': self.num_batch,
-            'num_atoms': self.num_atoms,
-            'k': self.k,
-        }
+        raw_metadata = save_raw_metadata(
+            self.data_folder,
+            self.indexer,
+            self.binner,
+            self.summarizer,
+            self.tracker,
+            num_batch=self.num_batch,
+            num_atoms=self.num_atoms,
+            k=self.k,
+        )
         print(raw_metadata)
-        with open(self.data_folder / 'raw_metadata.json', 'w') as f:
-            json.dump(raw_metadata, f)
-
-        self.summarizer.to_df().to_feather(self.data_folder / 'energy_data.feather')
 
     def process_batch(self, batch_name, overwrite: bool = False, max_batches: int = 0):
         path = self.data_folder / 'raw' / f'batch_{batch_name}.pkl'
@@ -371,19 +489,16 @@ class BatchProcessor:
                 logging.info(f'Skipping {out_fn}: already exists')
                 continue
 
-            cgs = []
-            for i in partition:
-                if i >= orig_size:
-                    # empty pad
-                    continue
-
-                row = df.iloc[i]
-                edges = knn.knn_graph(row['structure'], self.k, i)
-
-                cgs.append(self.create_graph(row, data_id.iloc[i], edges))
+            # the rest are empty padding
+            rows = [i for i in partition if i < orig_size]
+            edges = knn.knn_graphs([df['structure'].iloc[i] for i in rows], self.k, rows)
+            cgs = [
+                self.create_graph(df.iloc[i], data_id.iloc[i], graph_edges)
+                for i, graph_edges in zip(rows, edges)
+            ]
 
             cg: CrystalGraphs = sum(cgs[1:], start=cgs[0])  # type: ignore
-            cg = cg.padded(self.num_batch * self.num_atoms, self.k, self.num_batch)
+            cg = cg.padded(self.num_batch * self.num_atoms, self.k, self.num_batch).to_storage()
             self.tracker.update(cg)
             assert len(cg.n_node) == self.num_batch
             save_pytree(cg, out_fn)
@@ -0,0 +1,250 @@
+"""
+Streaming ingestion of MPtrj, from the raw JSON straight to batch files.
+
+The JSON is parsed incrementally into lightweight records of plain arrays, without building
+pymatgen Structures or writing intermediate DataFrames. Every materials_per_group materials form a
+group, which a pool of worker processes turns into k-NN graphs, packs into padded batches, and
+writes to batches/group_XXXX/NNNNN.mpk, as BatchProcessor.process_batch does. Only a bounded
+number of groups is in memory at once, so the whole 10+ GB file never is.
+
+Run python -m facet.data.ingest --json_path=data/MPtrj_2022.9_full.json
+--data_folder=precomputed/mptrj. The statistics are written to raw_metadata.json and
+energy_data.feather in the data folder, like the other preprocessing scripts.
+"""
+
+import logging
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import cache
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pyrallis
+from pymatgen.core import Element
+
+from facet.config import field
+from facet.config.common import dataclass
+from facet.data.databatch import CrystalData, CrystalGraphs, NodeData, TargetInfo, collate
+from facet.data.dataset_generation import (
+    BatchMetadataTracker,
+    ElementIndexer,
+    GraphSummarizer,
+    RMaxBinner,
+    padded_parts,
+    save_raw_metadata,
+)
+from facet.data.neighbors import knn_graph
+from facet.layers import edge_vecs
+from facet.utils import save_pytree
+
+
+class FrameRecord(NamedTuple):
+    """A single MPtrj frame, as the arrays the batches need."""
+
+    data_id: int
+    # species indices from the ElementIndexer, not atomic numbers
+    species: np.ndarray
+    lat: np.ndarray
+    cart: np.ndarray
+    # total energy (eV)
+    energy: float
+    # forces (eV/Å)
+    force: np.ndarray
+    # stress tensor (kbar)
+    stress: np.ndarray
+
+
+@cache
+def atomic_number(symbol: str) -> int:
+    return Element(symbol).Z
+
+
+def mptrj_data_id(mp_id: str, calc: int, step: int) -> int:
+    """The same ID as make_data_id_mptrj, for a single frame."""
+    return int(mp_id.replace('mp-', '1').replace('mvc-', '2')) * 1000 + calc * 2 + step
+
+
+def parse_frame(
+    mp_id: str, frame_id: str, frame: dict, indexer: ElementIndexer, energy_key: str
+) -> FrameRecord:
+    """Reads a frame from the dictionary the JSON has for it."""
+    _task, calc, step = frame_id.rsplit('-', maxsplit=2)
+    structure = frame['structure']
+    lat = np.array(structure['lattice']['matrix'])
+    sites = structure['sites']
+    # MPtrj doesn't keep every site inside the cell
+    frac = np.array([site['abc'] for site in sites]) % 1.0
+    species = [indexer.get(atomic_number(site['species'][0]['element'])) for site in sites]
+    return FrameRecord(
+        data_id=mptrj_data_id(mp_id, int(calc), int(step)),
+        species=np.array(species, dtype=np.uint8),
+        lat=lat,
+        cart=frac @ lat,
+        energy=frame[energy_key],
+        force=np.array(frame['force']),
+        stress=np.array(frame['stress']),
+    )
+
+
+def stream_groups(
+    json_path: Path,
+    indexer: ElementIndexer,
+    materials_per_group: int,
+    energy_key: str = 'corrected_total_energy',
+    max_groups: int = 0,
+) -> Iterator[list[FrameRecord]]:
+    """Yields the frames of every materials_per_group materials in the JSON, reading it
+    incrementally. Stops after max_groups groups, if it isn't 0."""
+    import ijson  # type: ignore
+
+    group: list[FrameRecord] = []
+    num_groups = 0
+    num_materials = 0
+    with open(json_path, 'rb') as f:
+        for mp_id, frames in ijson.kvitems(f, '', use_float=True):
+            for frame_id, frame in frames.items():
+                group.append(parse_frame(mp_id, frame_id, frame, indexer, energy_key))
+            num_materials += 1
+            if num_materials % materials_per_group == 0:
+                yield group
+                group = []
+                num_groups += 1
+                if num_groups == max_groups:
+                    return
+
+    if group:
+        yield group
+
+
+def frame_graph(frame: FrameRecord, k: int) -> CrystalGraphs:
+    """The unpadded graph of a frame, with the same types as BatchProcessor.create_graph."""
+    num_atoms = len(frame.species)
+    return CrystalGraphs(
+        nodes=NodeData(
+            species=frame.species,
+            cart=frame.cart.astype(np.float32),
+            graph_i=np.zeros((num_atoms,), dtype=np.uint16),
+        ),
+        edges=knn_graph(frame.lat, frame.cart, k),
+        n_node=np.array([num_atoms], dtype=np.uint16),
+        padding_mask=np.ones((1,), dtype=np.bool_),
+        graph_data=CrystalData.from_lattice(frame.lat, frame.data_id),
+        target_data=TargetInfo(
+            e_form=np.array([frame.energy]) / num_atoms,
+            force=frame.force,
+            stress=frame.stress[None],
+        ),
+    )
+
+
+@dataclass
+class IngestConfig:
+    # MPtrj JSON file.
+    json_path: Path = Path('data/MPtrj_2022.9_full.json')
+    # Folder to write batches/ and the raw metadata to.
+    data_folder: Path = Path('precomputed/mptrj')
+    energy_key: str = 'corrected_total_energy'
+
+    # Materials in each group of batch files.
+    materials_per_group: int = 4096
+    # Stops after this many groups, if not 0.
+    max_groups: int = 0
+
+    num_batch: int = 32
+    num_atoms: int = 32
+    k: int = 16
+    r_max_bins: list[float] = field(default_factory=lambda: (np.arange(5, 121, 5) / 10).tolist())
+
+    # Worker processes computing the graphs and writing the batches.
+    num_workers: int = 4
+    # Groups read ahead of the oldest unfinished one. Bounds memory use.
+    max_pending: int = 8
+
+
+def write_group(
+    config: IngestConfig, group_num: int, frames: list[FrameRecord]
+) -> tuple[RMaxBinner, GraphSummarizer, BatchMetadataTracker]:
+    """Computes the graphs of a group, packs them into padded batches, and writes them. Returns
+    the statistics of the group, to merge with the others."""
+    binner = RMaxBinner(config.r_max_bins)
+    summarizer = GraphSummarizer()
+    tracker = BatchMetadataTracker()
+    tracker.new_group()
+
+    graphs = []
+    for frame in frames:
+        cg = frame_graph(frame, config.k)
+        summarizer.update(frame.species, cg.e_form[0])
+        binner.update(np.sqrt(np.sum(np.square(edge_vecs(cg)), axis=-1) + 1e-6))
+        graphs.append(cg)
+
+    out_path = config.data_folder / 'batches' / f'group_{group_num:04}'
+    out_path.mkdir(exist_ok=True, parents=True)
+    sizes = [len(frame.species) for frame in frames]
+    n_node = config.num_batch * config.num_atoms
+    parts, _part_sizes = padded_parts(sizes, config.num_batch, n_node - 1)
+    for partition in parts.T:
+        cgs = [graphs[i] for i in partition if i < len(graphs)]
+        if not cgs:
+            continue
+        cg = collate(cgs).padded(n_node, config.k, config.num_batch).to_storage()
+        file_num = tracker.batches_per_group[-1]
+        tracker.update(cg)
+        save_pytree(cg, out_path / f'{file_num:05}.mpk')
+
+    return binner, summarizer, tracker
+
+
+def ingest(config: IngestConfig):
+    """Writes the batches and raw metadata. The JSON is read in this process while the workers
+    handle earlier groups, and their statistics are merged in group order."""
+    indexer = ElementIndexer()
+    binner = RMaxBinner(config.r_max_bins)
+    summarizer = GraphSummarizer()
+    tracker = BatchMetadataTracker()
+
+    def merge(future: Future):
+        group_binner, group_summarizer, group_tracker = future.result()
+        binner.merge(group_binner)
+        summarizer.merge(group_summarizer)
+        tracker.merge(group_tracker)
+        logging.info('Wrote group %d', len(tracker.batches_per_group) - 1)
+
+    groups = stream_groups(
+        config.json_path,
+        indexer,
+        config.materials_per_group,
+        config.energy_key,
+        config.max_groups,
+    )
+    with ProcessPoolExecutor(config.num_workers) as pool:
+        pending: deque[Future] = deque()
+        for group_num, frames in enumerate(groups):
+            pending.append(pool.submit(write_group, config, group_num, frames))
+            if len(pending) >= config.max_pending:
+                merge(pending.popleft())
+        while pending:
+            merge(pending.popleft())
+
+    save_raw_metadata(
+        config.data_folder,
+        indexer,
+        binner,
+        summarizer,
+        tracker,
+        num_batch=config.num_batch,
+        num_atoms=config.num_atoms,
+        k=config.k,
+    )
+
+
+@pyrallis.wrap()
+def main(config: IngestConfig):
+    logging.basicConfig(level=logging.INFO)
+    ingest(config)
+
+
+if __name__ == '__main__':
+    main()
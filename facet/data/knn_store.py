@@ -0,0 +1,129 @@
+"""
+Precomputed k-NN graphs for a whole dataset, stored as flat memory-mapped arrays.
+
+The receivers and images of every node of every structure are stored back to back in ijs.bin and
+ims.bin, and offsets.npy has the index of the first node of each structure. index.json records k
+and where each raw batch's structures start, so structures can be looked up by their index in the
+batch, as BatchProcessor does. Nothing is read until it's looked up, and a whole partition is
+looked up at once.
+
+Convert the mat-graph pickles with python -m facet.data.knn_store --graphs_folder=<pickles>
+--out=<store>.
+"""
+
+import json
+import logging
+import pickle
+from collections.abc import Iterable, Mapping, Sequence
+from pathlib import Path
+
+import numpy as np
+import pyrallis
+
+from facet.config.common import dataclass
+from facet.data.databatch import EdgeData
+
+
+class KNNStore:
+    """Read-only view of a store written by write_knn_store."""
+
+    def __init__(self, folder: Path):
+        with open(folder / 'index.json') as f:
+            index = json.load(f)
+        self.k: int = index['k']
+        # batch name -> index of its first structure, number of structures
+        self.batches: dict[str, tuple[int, int]] = {
+            name: tuple(span) for name, span in index['batches'].items()
+        }
+        self.offsets = np.load(folder / 'offsets.npy', mmap_mode='r')
+        num_nodes = int(self.offsets[-1])
+        self.ijs = np.memmap(
+            folder / 'ijs.bin', dtype=np.uint16, mode='r', shape=(num_nodes, self.k)
+        )
+        self.ims = np.memmap(
+            folder / 'ims.bin', dtype=np.int8, mode='r', shape=(num_nodes, self.k, 3)
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def batch_ids(self, batch_name: str, struct_ids) -> np.ndarray:
+        """Converts indices of structures within a raw batch to indices in the store."""
+        start, num = self.batches[batch_name]
+        struct_ids = np.asarray(struct_ids, dtype=np.int64)
+        if np.any((struct_ids < 0) | (struct_ids >= num)):
+            raise IndexError(f'Batch {batch_name} has {num} structures, got {struct_ids}')
+        return start + struct_ids
+
+    def lookup(self, ids) -> tuple[EdgeData, np.ndarray]:
+        """The edges of the structures, concatenated in the given order, and the number of nodes
+        in each."""
+        ids = np.asarray(ids, dtype=np.int64)
+        starts = np.asarray(self.offsets[ids])
+        n_node = np.asarray(self.offsets[ids + 1]) - starts
+        # index of every node: the start of its structure plus its index within it
+        first = np.cumsum(n_node) - n_node
+        node_i = np.repeat(starts - first, n_node) + np.arange(n_node.sum())
+        return EdgeData(to_jimage=self.ims[node_i], receiver=self.ijs[node_i]), n_node
+
+    def get(self, i: int) -> EdgeData:
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return EdgeData(
+            to_jimage=np.asarray(self.ims[start:end]), receiver=np.asarray(self.ijs[start:end])
+        )
+
+
+def write_knn_store(folder: Path, batches: Iterable[tuple[str, Sequence[dict]]]):
+    """Writes a store from the neighbor lists of each raw batch, in mat-graph's format: one dict
+    per structure, with the receivers under 'ijs' and the images under 'ims'. The arrays are
+    appended to as the batches are read, so they don't need to fit in memory."""
+    folder.mkdir(parents=True, exist_ok=True)
+    k = None
+    offsets = [0]
+    index = {}
+    with open(folder / 'ijs.bin', 'wb') as ijs_file, open(folder / 'ims.bin', 'wb') as ims_file:
+        for name, graphs in batches:
+            index[name] = [len(offsets) - 1, len(graphs)]
+            for graph in graphs:
+                ijs = np.asarray(graph['ijs'], dtype=np.uint16)
+                ims = np.asarray(graph['ims'], dtype=np.int8)
+                if k is None:
+                    k = ijs.shape[1]
+                elif ijs.shape[1] != k:
+                    raise ValueError(f'Batch {name} has {ijs.shape[1]} neighbors, not {k}')
+                ijs_file.write(ijs.tobytes())
+                ims_file.write(ims.reshape(-1, k, 3).tobytes())
+                offsets.append(offsets[-1] + len(ijs))
+            logging.info('Wrote batch %s: %d structures', name, len(graphs))
+
+    np.save(folder / 'offsets.npy', np.array(offsets, dtype=np.int64))
+    with open(folder / 'index.json', 'w') as f:
+        json.dump({'k': k, 'batches': index}, f)
+
+
+def read_pickles(graphs_folder: Path) -> Iterable[tuple[str, Sequence[dict]]]:
+    """The neighbor lists of each batch_{name}.pkl in the folder, one batch at a time."""
+    for path in sorted(graphs_folder.glob('batch_*.pkl')):
+        with open(path, 'rb') as f:
+            graphs = pickle.load(f)
+        if isinstance(graphs, Mapping):
+            graphs = [graphs[i] for i in range(len(graphs))]
+        yield path.stem.removeprefix('batch_'), graphs
+
+
+@dataclass
+class KNNStoreConfig:
+    # Folder of mat-graph's batch_{name}.pkl neighbor lists.
+    graphs_folder: Path = Path('knns/')
+    # Folder to write the store to.
+    out: Path = Path('precomputed/mptrj/knn_store')
+
+
+@pyrallis.wrap()
+def main(config: KNNStoreConfig):
+    logging.basicConfig(level=logging.INFO)
+    write_knn_store(config.out, read_pickles(config.graphs_folder))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,15 @@ scale/shift for species, and average number of neighbors. This should be precomp
 a representation of that metadata to save and load from memory.
 """
 
+import dataclasses
+import os
+from pathlib import Path
+
 from flax.struct import dataclass
 from jaxtyping import ArrayLike, Float, Array, Int, UInt
 import jax.numpy as jnp
 
-from facet.utils import debug_structure
+from facet.utils import debug_structure, save_pytree
 
 
 @dataclass
@@ -81,6 +85,14 @@ class DatasetMetadata:
         )
 
 
+def save_metadata(metadata: DatasetMetadata, path: Path):
+    """Saves the metadata to a temporary file that then replaces path, so a reader never sees a
+    partially written file."""
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    save_pytree(dataclasses.asdict(metadata), tmp_path)
+    os.replace(tmp_path, path)
+
+
 if __name__ == '__main__':
     from facet.utils import load_pytree
 
@@ -0,0 +1,255 @@
+"""
+Builds a dataset's metadata.mpk from its batch files, in a single pass.
+
+Worker processes each summarize some of the groups into statistics that merge by addition and
+concatenation: histograms of the number of neighbors within each r_max, the number of atoms of
+each species in each graph, and the energies. The species-wise energy model is fit to the merged
+statistics at the end, so every file is read once. It has the form MACE's energy scaling uses:
+the shifts are fit by least squares on the total energies, and the scales by maximizing the
+Laplace likelihood of what the shifts leave over.
+
+Run python -m facet.data.metadata_builder --dataset_folder=precomputed/mptrj. The atomic numbers
+of the species are read from the raw_metadata.json that preprocessing writes, unless given.
+"""
+
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import Optional, Sequence
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+import pyrallis
+from scipy import sparse
+
+from facet.config import field
+from facet.config.common import dataclass
+from facet.data.databatch import CrystalGraphs
+from facet.data.dataset_generation import RMaxBinner
+from facet.data.metadata import DatasetMetadata, save_metadata
+from facet.layers import edge_vecs
+from facet.utils import load_pytree
+
+# species are stored as uint8
+MAX_SPECIES = 256
+
+# the transform MACE applies to the scale parameters, which is 1 at 0
+SOFTPLUS_INTERCEPT = np.log(np.e - 1)
+
+
+def scale_transform(x):
+    return jax.nn.softplus(x + SOFTPLUS_INTERCEPT)
+
+
+def inverse_scale_transform(y):
+    return np.log(np.expm1(y)) - SOFTPLUS_INTERCEPT
+
+
+class MetadataStats:
+    """Statistics of a set of batch files, which can be merged with those of other files."""
+
+    def __init__(self, r_max_bins: Sequence[float]):
+        self.binner = RMaxBinner(r_max_bins)
+        # number of atoms of each species
+        self.species_totals = np.zeros(MAX_SPECIES, dtype=np.int64)
+        # shapes of the batches: nodes, k, graphs
+        self.shapes: set[tuple[int, int, int]] = set()
+        self.has_force = False
+        self.has_stress = False
+        # for each batch: graph, species, and count of each species in each real graph, then the
+        # energy per atom and number of atoms of each real graph
+        self.batches: list[tuple[np.ndarray, ...]] = []
+
+    def update(self, cg: CrystalGraphs):
+        padding_mask = np.asarray(cg.padding_mask)
+        graph_i = np.asarray(cg.nodes.graph_i)
+        node_mask = padding_mask[graph_i]
+        self.shapes.add((len(graph_i), cg.edges.receiver.shape[1], len(padding_mask)))
+
+        vecs = np.asarray(edge_vecs(cg))[node_mask]
+        self.binner.update(np.sqrt(np.sum(np.square(vecs), axis=-1) + 1e-6))
+
+        # number the real graphs consecutively
+        real_i = (np.cumsum(padding_mask) - 1)[graph_i[node_mask]]
+        species = np.asarray(cg.nodes.species)[node_mask].astype(np.int64)
+        self.species_totals += np.bincount(species, minlength=MAX_SPECIES)
+        keys, counts = np.unique(real_i * MAX_SPECIES + species, return_counts=True)
+        self.batches.append(
+            (
+                keys // MAX_SPECIES,
+                keys % MAX_SPECIES,
+                counts,
+                np.asarray(cg.e_form)[padding_mask],
+                np.asarray(cg.n_node)[padding_mask].astype(np.int64),
+            )
+        )
+
+        self.has_force |= bool(np.any(np.asarray(cg.target_data.force)[node_mask] != 0))
+        self.has_stress |= bool(np.any(np.asarray(cg.target_data.stress)[padding_mask] != 0))
+
+    def merge(self, other: 'MetadataStats') -> 'MetadataStats':
+        self.binner.merge(other.binner)
+        self.species_totals += other.species_totals
+        self.shapes |= other.shapes
+        self.has_force |= other.has_force
+        self.has_stress |= other.has_stress
+        self.batches.extend(other.batches)
+        return self
+
+    def graph_species(self) -> tuple[sparse.csr_matrix, np.ndarray, np.ndarray]:
+        """The number of atoms of each species in each graph, as a sparse graphs x species
+        matrix, and the energy per atom and number of atoms of each graph."""
+        num_graphs = np.array([len(batch[3]) for batch in self.batches])
+        offsets = np.cumsum(num_graphs) - num_graphs
+        rows = np.concatenate([batch[0] + offset for batch, offset in zip(self.batches, offsets)])
+        cols, counts, e_form, n_node = (
+            np.concatenate([batch[i] for batch in self.batches]) for i in range(1, 5)
+        )
+        counts_matrix = sparse.csr_matrix(
+            (counts.astype(np.float64), (rows, cols)), shape=(num_graphs.sum(), MAX_SPECIES)
+        )
+        return counts_matrix, e_form.astype(np.float64), n_node
+
+
+def fit_shifts(
+    counts: sparse.csr_matrix, e_form: np.ndarray, n_node: np.ndarray, ridge: float = 1e-6
+) -> np.ndarray:
+    """Energy per atom of each species, by least squares on the total energies."""
+    gram = (counts.T @ counts).toarray()
+    gram += ridge * np.mean(np.diag(gram)) * np.eye(len(gram))
+    return np.linalg.solve(gram, counts.T @ (e_form * n_node))
+
+
+def fit_scales(
+    counts: sparse.csr_matrix,
+    resid: np.ndarray,
+    n_node: np.ndarray,
+    steps: int = 500,
+    learning_rate: float = 0.05,
+    l2: float = 1e-6,
+) -> tuple[float, np.ndarray]:
+    """The global and species-wise scale parameters that maximize the Laplace likelihood of the
+    residual energies per atom, with MACE's scale for each graph: the transformed sum of its
+    species' parameters, over the number of atoms, times the transformed global parameter."""
+    coo = counts.tocoo()
+    graph_i, species, num = (jnp.asarray(x) for x in (coo.row, coo.col, coo.data))
+    abs_resid, n_node = jnp.asarray(np.abs(resid)), jnp.asarray(n_node)
+    num_graphs = counts.shape[0]
+
+    def loss(params):
+        total = jax.ops.segment_sum(params['species'][species] * num, graph_i, num_graphs)
+        scale = scale_transform(total) / n_node * scale_transform(params['global'])
+        nll = jnp.mean(jnp.log(2 * scale) + abs_resid / scale)
+        return nll + l2 * jnp.sum(jnp.square(params['species']))
+
+    tx = optax.adam(learning_rate)
+
+    @jax.jit
+    def step(params, opt_state):
+        grads = jax.grad(loss)(params)
+        updates, opt_state = tx.update(grads, opt_state)
+        return optax.apply_updates(params, updates), opt_state
+
+    # with the species parameters at 0, the best global scale is the mean total absolute error
+    params = {
+        'global': jnp.asarray(inverse_scale_transform(np.mean(np.abs(resid) * n_node))),
+        'species': jnp.zeros(counts.shape[1]),
+    }
+    opt_state = tx.init(params)
+    for _ in range(steps):
+        params, opt_state = step(params, opt_state)
+    logging.info('Energy scale NLL: %.4f', loss(params))
+    return float(params['global']), np.asarray(params['species'])
+
+
+def group_stats(files: Sequence[Path], r_max_bins: Sequence[float]) -> MetadataStats:
+    # the data pipeline is only needed here, and is slow to import
+    from facet.data.dataset import process_raw
+
+    stats = MetadataStats(r_max_bins)
+    for path in files:
+        stats.update(process_raw(load_pytree(path)))
+    return stats
+
+
+@dataclass
+class MetadataBuilderConfig:
+    # Folder with the batches/ of the dataset. The metadata is written here.
+    dataset_folder: Path = Path('precomputed/mptrj')
+    # The r_max values to count neighbors within.
+    r_max_bins: list[float] = field(default_factory=lambda: (np.arange(5, 121, 5) / 10).tolist())
+    # Atomic number of each species index. Read from raw_metadata.json if not given.
+    atomic_numbers: Optional[list[int]] = None
+
+    num_workers: int = 4
+    # Optimization steps of the species-wise energy scales.
+    fit_steps: int = 500
+
+
+def build_metadata(config: MetadataBuilderConfig) -> DatasetMetadata:
+    """Reads every batch file once and computes the metadata."""
+    if config.atomic_numbers is None:
+        with open(config.dataset_folder / 'raw_metadata.json') as f:
+            atomic_numbers = np.array(json.load(f)['atomic_numbers'])
+    else:
+        atomic_numbers = np.array(config.atomic_numbers)
+    num_elements = len(atomic_numbers)
+
+    groups = sorted((config.dataset_folder / 'batches').glob('group_*'))
+    group_files = [sorted(group.glob('*.mpk')) for group in groups]
+
+    stats = MetadataStats(config.r_max_bins)
+    with ProcessPoolExecutor(config.num_workers) as pool:
+        for i, group in enumerate(pool.map(group_stats, group_files, repeat(config.r_max_bins))):
+            stats.merge(group)
+            logging.info('Read group %d of %d', i + 1, len(groups))
+
+    if len(stats.shapes) != 1:
+        raise ValueError(f'Batches have different shapes (nodes, k, graphs): {stats.shapes}')
+    [(nodes, k, graphs)] = stats.shapes
+    if np.any(stats.species_totals[num_elements:]):
+        raise ValueError(f'Batches have species beyond the {num_elements} atomic numbers')
+
+    counts, e_form, n_node = stats.graph_species()
+    counts = counts[:, :num_elements]
+    present = stats.species_totals[:num_elements] > 0
+    species_energy = fit_shifts(counts, e_form, n_node)
+    resid = e_form - (counts @ species_energy) / n_node
+    scale_energy, atomwise_scale = fit_scales(counts, resid, n_node, steps=config.fit_steps)
+
+    # the model's shift for a graph is the global shift plus the mean of its species' shifts,
+    # so the least squares fit is split into those parts
+    shift_energy = float(np.median(e_form))
+    targets = ['energy'] + ['force'] * stats.has_force + ['stress'] * stats.has_stress
+    r_max_counts = stats.binner.counts
+    return DatasetMetadata(
+        dataset_name=config.dataset_folder.name,
+        supported_targets=tuple(targets),
+        batches_per_group=np.array([len(files) for files in group_files], dtype=np.uint32),
+        batch_num_atoms=nodes // graphs,
+        nearest_k=k,
+        batch_num_graphs=graphs,
+        shift_energy=shift_energy,
+        scale_energy=scale_energy,
+        atomic_numbers=atomic_numbers.astype(np.uint8),
+        atomwise_shift_energy=np.where(present, species_energy - shift_energy, 0),
+        atomwise_scale_energy=np.where(present, atomwise_scale, 0),
+        r_max_quantile_r=stats.binner.bins,
+        r_max_quantile_k=r_max_counts / r_max_counts.sum(axis=-1, keepdims=True),
+    )
+
+
+@pyrallis.wrap()
+def main(config: MetadataBuilderConfig):
+    logging.basicConfig(level=logging.INFO)
+    metadata = build_metadata(config)
+    save_metadata(metadata, config.dataset_folder / 'metadata.mpk')
+    logging.info('Wrote %s', config.dataset_folder / 'metadata.mpk')
+
+
+if __name__ == '__main__':
+    main()
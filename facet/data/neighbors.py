@@ -0,0 +1,280 @@
+"""
+Fast periodic k-nearest-neighbor graphs.
+
+knn_graph computes exact graphs on the host with vectorized NumPy. For simulations that move atoms
+on device, NeighborCandidates keeps a list of candidate neighbors that is refreshed on device only
+when the atoms or cell have moved far enough that the k nearest might have changed.
+"""
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from flax import struct
+from jaxtyping import Array, Bool, Float, Int
+
+from facet.data.databatch import CrystalGraphs, EdgeData, narrow
+
+
+def image_offsets(lat: Float[Array, '3 3'], r_max: float) -> Int[Array, 'images 3']:
+    """All lattice translations that can put an atom within r_max of any atom in the cell.
+
+    The distance between the lattice planes spanned by the other two vectors is 1 / |b_i|, where b
+    is the reciprocal basis without the 2π, so this many translations along each axis cover a
+    sphere of radius r_max around any point in the cell."""
+    recip = np.linalg.inv(lat).T
+    n_max = np.ceil(r_max * np.linalg.norm(recip, axis=1)).astype(int)
+    ranges = [np.arange(-n, n + 1) for n in n_max]
+    return np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def knn_arrays(
+    lat: Float[Array, '3 3'], cart: Float[Array, 'nodes 3'], k: int, r_max: float | None = None
+) -> tuple[Int[Array, 'nodes k 3'], Int[Array, 'nodes k'], Float[Array, 'nodes k']]:
+    """Finds the k nearest neighbors of each atom, excluding the atom itself. Returns the images,
+    receiver indices, and distances, sorted by distance.
+
+    All images within a cutoff are checked at once, and the cutoff is doubled until every atom has
+    k neighbors inside it, so the result is exact. The atoms don't need to be inside the unit cell:
+    the search is done on the wrapped positions, and the images returned are for the positions
+    given."""
+    lat = np.asarray(lat, dtype=np.float64)
+    cart = np.asarray(cart, dtype=np.float64)
+    n = cart.shape[0]
+
+    # image_offsets only covers every neighbor of atoms inside the cell
+    frac = cart @ np.linalg.inv(lat)
+    shift = np.floor(frac)
+    cart = (frac - shift) @ lat
+    if r_max is None:
+        # start with a reasonable guess for the r_max based on lattice and occupancy
+        volume = abs(np.linalg.det(lat))
+        r_max = 1.5 * np.cbrt(3 * volume * (k + 1) / (4 * np.pi * n))
+
+    while True:
+        ims = image_offsets(lat, r_max)
+        # nodes images nodes 3
+        vecs = (cart[None, None, :, :] + (ims @ lat)[None, :, None, :]) - cart[:, None, None, :]
+        dists = np.linalg.norm(vecs, axis=-1)
+        # remove self-edges
+        zero_im = np.all(ims == 0, axis=-1)
+        dists[np.arange(n), np.flatnonzero(zero_im)[0], np.arange(n)] = np.inf
+        dists = dists.reshape(n, -1)
+
+        if k >= dists.shape[1]:
+            r_max *= 2
+            continue
+
+        chosen = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        chosen_dists = np.take_along_axis(dists, chosen, axis=1)
+        if np.max(chosen_dists) > r_max:
+            # some neighbors might be outside the images checked
+            r_max *= 2
+            continue
+
+        order = np.argsort(chosen_dists, axis=1, kind='stable')
+        chosen = np.take_along_axis(chosen, order, axis=1)
+        chosen_dists = np.take_along_axis(chosen_dists, order, axis=1)
+        im_i, recv = np.divmod(chosen, n)
+        # the edge from i to j in image m of the wrapped cell is in image m + s_i - s_j of the
+        # positions given, where s is how many cells each atom was moved by
+        images = ims[im_i] + (shift[:, None, :] - shift[recv]).astype(int)
+        return images, recv, chosen_dists
+
+
+def knn_graph(lat: Float[Array, '3 3'], cart: Float[Array, 'nodes 3'], k: int) -> EdgeData:
+    """k-NN graph for a single structure, in the format stored in the datasets."""
+    ims, recv, _dists = knn_arrays(lat, cart, k)
+    return EdgeData(to_jimage=narrow(ims, np.int8), receiver=narrow(recv, np.uint16))
+
+
+def num_images(cg: CrystalGraphs, num_candidates: int) -> int:
+    """Number of lattice translations along each axis build_candidates needs to check to find
+    num_candidates neighbors for every atom in cg, with some room for the atoms to move. Computed
+    on the host."""
+    n_max = 1
+    cart = np.asarray(cg.nodes.cart)
+    graph_i = np.asarray(cg.nodes.graph_i)
+    for g in np.flatnonzero(np.asarray(cg.padding_mask)):
+        lat = np.asarray(cg.graph_data.lat[g], dtype=np.float64)
+        _ims, _recv, dists = knn_arrays(lat, cart[graph_i == g], num_candidates + 1)
+        recip_norm = np.linalg.norm(np.linalg.inv(lat).T, axis=1)
+        n_max = max(n_max, int(np.ceil(1.25 * dists.max() * recip_norm.max())))
+    return n_max
+
+
+class NeighborCandidates(struct.PyTreeNode):
+    """Candidate neighbors of each atom, which contain the k nearest neighbors until the atoms or
+    cell move too far from where they were when the list was built.
+
+    The skin of each graph is half the smallest gap between the distance of an atom's k-th neighbor
+    and that of the first atom left out of its candidates. While every distance has changed by less
+    than the skin, the k nearest are still candidates. For a fixed cell, that holds while no atom
+    has moved by more than half the skin, like a Verlet list.
+    """
+
+    to_jimage: Int[Array, 'nodes c 3']
+    receiver: Int[Array, 'nodes c']
+    # fractional coordinates and lattice when the list was built
+    ref_frac: Float[Array, 'nodes 3']
+    ref_lat: Float[Array, 'graphs 3 3']
+    skin: Float[Array, ' graphs']
+    # upper bound on the length of the edges that matter, which sets how much strain can move them
+    reach: Float[Array, ' graphs']
+
+    def is_valid(self, cg: CrystalGraphs) -> Bool[Array, ' graphs']:
+        """Whether the k nearest neighbors of every atom in each graph are still candidates.
+
+        An edge r = (f_j + n - f_i) L changes by (δf_j - δf_i) L' + r L^-1 ΔL, so its length
+        changes by at most twice the largest atom displacement plus |r| times the strain."""
+        lat = cg.graph_data.lat
+        frac = to_frac(cg)
+        disp = jnp.linalg.norm(
+            jnp.einsum('ni,nij->nj', frac - self.ref_frac, lat[cg.nodes.graph_i]), axis=-1
+        )
+        max_disp = jax.ops.segment_max(disp, cg.nodes.graph_i, num_segments=cg.n_total_graphs)
+        strain = jnp.linalg.norm(
+            jnp.einsum('gij,gjk->gik', safe_inv_lat(self.ref_lat, cg), lat) - jnp.eye(3),
+            axis=(-2, -1),
+        )
+        return (2 * max_disp + self.reach * strain < self.skin) | ~cg.padding_mask
+
+    @property
+    def ok(self) -> Bool[Array, '']:
+        """Whether the list could be built with a positive skin. If not, build_candidates needs more
+        candidates or images."""
+        return jnp.all(self.skin > 0)
+
+
+def safe_inv_lat(lat: Float[Array, 'graphs 3 3'], cg: CrystalGraphs) -> Float[Array, 'graphs 3 3']:
+    """Inverse of the lattice matrices, with the identity for padding graphs."""
+    return jnp.linalg.inv(jnp.where(cg.padding_mask[:, None, None], lat, jnp.eye(3)))
+
+
+def to_frac(cg: CrystalGraphs) -> Float[Array, 'nodes 3']:
+    inv_lat = safe_inv_lat(cg.graph_data.lat, cg)
+    return jnp.einsum('ni,nij->nj', cg.nodes.cart, inv_lat[cg.nodes.graph_i])
+
+
+def wrap_positions(cg: CrystalGraphs) -> CrystalGraphs:
+    """Moves the atoms into the unit cell. Doesn't change the structure, but the edges have to be
+    recomputed."""
+    frac = to_frac(cg)
+    cart = jnp.einsum('ni,nij->nj', frac - jnp.floor(frac), cg.graph_data.lat[cg.nodes.graph_i])
+    return cg.replace(nodes=cg.nodes.replace(cart=cart))
+
+
+def build_candidates(
+    cg: CrystalGraphs, k: int, num_candidates: int, n_images: int
+) -> NeighborCandidates:
+    """Finds the num_candidates nearest neighbors of each atom on device, checking the lattice
+    translations up to n_images along each axis. The atoms should be inside the unit cell: see
+    wrap_positions."""
+    grid = np.arange(-n_images, n_images + 1)
+    ims = np.stack(np.meshgrid(grid, grid, grid, indexing='ij'), axis=-1).reshape(-1, 3)
+    zero_im = int(np.flatnonzero(np.all(ims == 0, axis=-1))[0])
+
+    n = cg.n_total_nodes
+    graph_i = cg.nodes.graph_i
+    cart = cg.nodes.cart
+    lat = cg.graph_data.lat
+    real = cg.padding_mask[graph_i]
+
+    offsets = jnp.einsum('mi,nij->nmj', ims.astype(cart.dtype), lat[graph_i])
+
+    # rank by squared distance in 32 bits, which is much faster for XLA on CPU and precise enough
+    # to choose the candidates
+    cart32, offsets32 = cart.astype(jnp.float32), offsets.astype(jnp.float32)
+    # nodes images nodes 3
+    vecs = cart32[None, None, :, :] + offsets32[:, :, None, :] - cart32[:, None, None, :]
+    sq_dists = jnp.sum(vecs**2, axis=-1)
+    allowed = (graph_i[:, None] == graph_i[None, :]) & real[:, None] & real[None, :]
+    allowed = jnp.broadcast_to(allowed[:, None, :], sq_dists.shape)
+    allowed = allowed.at[jnp.arange(n), zero_im, jnp.arange(n)].set(False)
+    sq_dists = jnp.where(allowed, sq_dists, jnp.inf).reshape(n, -1)
+
+    neg_dists, chosen = jax.lax.top_k(-sq_dists, num_candidates + 1)
+    im_i, recv = jnp.divmod(chosen, n)
+    # recomputing the few chosen distances is cheaper than gathering from the full array
+    cand_vecs = cart[recv] + jnp.take_along_axis(offsets, im_i[..., None], axis=1) - cart[:, None]
+    cand_dists = jnp.where(jnp.isinf(neg_dists), jnp.inf, jnp.linalg.norm(cand_vecs, axis=-1))
+    im_i, recv = im_i[:, :num_candidates], recv[:, :num_candidates]
+
+    # anything past the checked images is at least this far away
+    recip_norm = jnp.linalg.norm(jnp.swapaxes(safe_inv_lat(lat, cg), -1, -2), axis=-1)
+    coverage = n_images / jnp.max(recip_norm, axis=-1)
+    excluded = jnp.minimum(cand_dists[:, num_candidates], coverage[graph_i])
+    gap = excluded - cand_dists[:, k - 1]
+    skin = jax.ops.segment_min(
+        jnp.where(real, gap / 2, jnp.inf), graph_i, num_segments=cg.n_total_graphs
+    )
+    reach = jax.ops.segment_max(
+        jnp.where(real, excluded, 0), graph_i, num_segments=cg.n_total_graphs
+    )
+
+    return NeighborCandidates(
+        to_jimage=jnp.asarray(ims)[im_i],
+        receiver=recv,
+        ref_frac=to_frac(cg),
+        ref_lat=lat,
+        skin=skin,
+        reach=reach,
+    )
+
+
+def candidate_edges(cg: CrystalGraphs, cands: NeighborCandidates, k: int) -> EdgeData:
+    """The k nearest neighbors of each atom among the candidates, at the current positions. Padding
+    atoms get self-edges."""
+    offsets = jnp.einsum(
+        'nci,nij->ncj',
+        cands.to_jimage.astype(cg.nodes.cart.dtype),
+        cg.graph_data.lat[cg.nodes.graph_i],
+    )
+    vecs = cg.nodes.cart[cands.receiver] + offsets - cg.nodes.cart[:, None, :]
+    _neg_dists, chosen = jax.lax.top_k(-jnp.sum(vecs**2, axis=-1), k)
+
+    real = cg.padding_mask[cg.nodes.graph_i][:, None]
+    self_i = jnp.arange(cg.n_total_nodes)[:, None]
+    receiver = jnp.where(real, jnp.take_along_axis(cands.receiver, chosen, axis=1), self_i)
+    to_jimage = jnp.where(
+        real[..., None], jnp.take_along_axis(cands.to_jimage, chosen[..., None], axis=1), 0
+    )
+    return EdgeData(to_jimage=to_jimage, receiver=receiver)
+
+
+def rebuild_candidates(
+    cg: CrystalGraphs, k: int, num_candidates: int, n_images: int
+) -> tuple[CrystalGraphs, NeighborCandidates]:
+    """Wraps the atoms back into the cell and rebuilds the candidate list and the edges, for one
+    replica."""
+    cg = wrap_positions(cg)
+    cands = build_candidates(cg, k, num_candidates, n_images)
+    return cg.replace(edges=candidate_edges(cg, cands, k)), cands
+
+
+def refresh_candidates(
+    cands: NeighborCandidates, cg: CrystalGraphs, k: int, num_candidates: int, n_images: int
+) -> tuple[CrystalGraphs, NeighborCandidates, Bool[Array, '']]:
+    """Updates the edges of stacked replicas after the atoms or cells have moved, rebuilding the
+    candidate lists if they might be out of date. Returns the graphs, the candidates, and whether
+    they were rebuilt, which also wraps the atoms back into the cell.
+
+    Rebuilding inside vmap would turn the cond into a select and rebuild every step, so every
+    replica is rebuilt at once if any of them needs it."""
+    needs_rebuild = ~jnp.all(jax.vmap(lambda c, cg: c.is_valid(cg))(cands, cg))
+
+    def rebuild(cg):
+        return jax.vmap(rebuild_candidates, in_axes=(0, None, None, None))(
+            cg, k, num_candidates, n_images
+        )
+
+    def reselect(cg):
+        edges = jax.vmap(candidate_edges, in_axes=(0, 0, None))(cg, cands, k)
+        return cg.replace(edges=edges), cands
+
+    cg, cands = jax.lax.cond(needs_rebuild, rebuild, reselect, cg)
+    return cg, cands, needs_rebuild
+
+
+def per_graph(x: Float[Array, 'nodes *dims'], cg: CrystalGraphs) -> Float[Array, 'graphs *dims']:
+    """Sums over the atoms of each structure."""
+    return jax.ops.segment_sum(x, cg.nodes.graph_i, num_segments=cg.n_total_graphs)
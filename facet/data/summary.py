@@ -0,0 +1,187 @@
+"""
+Per-structure summary table of a dataset, for exploration and visualization.
+
+Each batch file is summarized as a whole: the statistics of every graph come from segment sums
+over its nodes and edges with np.bincount, not loops over graphs. Groups are summarized in
+parallel, and written to an Arrow/feather file as record batches as they finish, so the table is
+never all in memory at once.
+
+Run python -m facet.data.summary --data.dataset_name=mptrj to write summary.feather to the
+dataset folder. Read it with pd.read_feather.
+"""
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+import pyarrow as pa
+import pyrallis
+from pyarrow import ipc
+
+from facet.config import DataConfig, field
+from facet.config.common import dataclass
+from facet.data.databatch import CrystalGraphs
+from facet.utils import load_pytree
+
+SPLITS = ('train', 'valid', 'test')
+
+
+def segment_counts(
+    segment_i: np.ndarray, value_i: np.ndarray, num_segments: int, num_values: int
+) -> np.ndarray:
+    """Counts of each value in each segment, as a segments x values array."""
+    flat_i = segment_i.astype(np.int64) * num_values + value_i
+    counts = np.bincount(flat_i, minlength=num_segments * num_values)
+    return counts.reshape(num_segments, num_values)
+
+
+def edge_lengths(cg: CrystalGraphs) -> np.ndarray:
+    """The lengths of the edges, as nodes x k, like the norms of edge_vecs but on the host."""
+    cart = np.asarray(cg.nodes.cart)
+    lat = np.asarray(cg.graph_data.lat)[np.asarray(cg.nodes.graph_i)]
+    offsets = np.einsum('nax,nka->nkx', lat, np.asarray(cg.edges.to_jimage, dtype=lat.dtype))
+    vecs = cart[np.asarray(cg.edges.receiver)] + offsets - cart[:, None, :]
+    return np.sqrt(np.sum(np.square(vecs), axis=-1))
+
+
+def summarize_batch(
+    cg: CrystalGraphs, dist_bins: np.ndarray, num_species: int
+) -> dict[str, np.ndarray]:
+    """Columns of statistics for each real graph in the batch: its index, dataset ID, lattice
+    parameters, energy, number of nodes, histogram of edge lengths, and number of atoms of each
+    species."""
+    padding_mask = np.asarray(cg.padding_mask)
+    graph_i = np.asarray(cg.nodes.graph_i).astype(np.int64)
+    node_mask = padding_mask[graph_i]
+    num_graphs = len(padding_mask)
+    num_bins = len(dist_bins) - 1
+
+    dists = edge_lengths(cg)
+    # like np.histogram: each bin includes its left edge, and the last one its right edge too
+    bin_i = np.clip(np.searchsorted(dist_bins, dists, side='right') - 1, 0, num_bins - 1)
+    in_range = (dists >= dist_bins[0]) & (dists <= dist_bins[-1]) & node_mask[:, None]
+    edge_graph_i = np.broadcast_to(graph_i[:, None], dists.shape)
+    dist_hist = segment_counts(edge_graph_i[in_range], bin_i[in_range], num_graphs, num_bins)
+
+    species = np.asarray(cg.nodes.species).astype(np.int64)
+    species_counts = segment_counts(graph_i[node_mask], species[node_mask], num_graphs, num_species)
+
+    abc = np.asarray(cg.graph_data.abc)
+    angles = np.rad2deg(np.asarray(cg.graph_data.angles_rad))
+    columns = {
+        'graph_i': np.arange(num_graphs, dtype=np.int32),
+        'dataset_id': np.asarray(cg.graph_data.dataset_id),
+        **{name: abc[:, i] for i, name in enumerate('abc')},
+        **{name: angles[:, i] for i, name in enumerate(('alpha', 'beta', 'gamma'))},
+        'e_form': np.asarray(cg.e_form),
+        'n_nodes': np.bincount(graph_i[node_mask], minlength=num_graphs).astype(np.int32),
+    }
+    centers = (dist_bins[1:] + dist_bins[:-1]) / 2
+    for center, counts in zip(centers, dist_hist.T):
+        columns[f'bin_{center:05.2f}'] = counts.astype(np.int32)
+    for i, counts in enumerate(species_counts.T):
+        columns[f'species_{i}'] = counts.astype(np.int32)
+
+    return {name: col[padding_mask] for name, col in columns.items()}
+
+
+def summarize_group(
+    files: Sequence[Path], dist_bins: np.ndarray, num_species: int
+) -> dict[str, np.ndarray]:
+    """The summaries of the batch files, concatenated, with the number of each file."""
+    # the data pipeline is only needed here, and is slow to import
+    from facet.data.dataset import process_raw
+
+    summaries = []
+    for path in files:
+        summary = summarize_batch(process_raw(load_pytree(path)), dist_bins, num_species)
+        summary['file'] = np.full(len(summary['graph_i']), int(path.stem), dtype=np.int32)
+        summaries.append(summary)
+    return {name: np.concatenate([s[name] for s in summaries]) for name in summaries[0]}
+
+
+def species_names(atomic_numbers: Sequence[int]) -> list[str]:
+    """Element symbols of the species, or their indices for padding or unknown elements."""
+    from pymatgen.core import Element
+
+    names = []
+    for i, z in enumerate(atomic_numbers):
+        try:
+            names.append(Element.from_Z(int(z)).symbol)
+        except ValueError:
+            names.append(str(i))
+    return names
+
+
+def to_record_batch(
+    summary: dict[str, np.ndarray], split: str, group_num: int, species: Sequence[str]
+) -> pa.RecordBatch:
+    num_rows = len(summary['graph_i'])
+    split_col = pa.DictionaryArray.from_arrays(
+        np.full(num_rows, SPLITS.index(split), dtype=np.int8), pa.array(SPLITS)
+    )
+    columns = {
+        'split': split_col,
+        'group': np.full(num_rows, group_num, dtype=np.int32),
+        **{name: col for name, col in summary.items() if not name.startswith('species_')},
+        **{name: summary[f'species_{i}'] for i, name in enumerate(species)},
+    }
+    return pa.RecordBatch.from_pydict(columns)
+
+
+@dataclass
+class SummaryConfig:
+    data: DataConfig = field(default_factory=DataConfig)
+    # Where to write the summary. Defaults to summary.feather in the dataset folder.
+    out: Optional[Path] = None
+    # Edges of the bins of the edge length histograms, in Å.
+    dist_bins: list[float] = field(default_factory=lambda: np.linspace(0, 10, 21).tolist())
+    num_workers: int = 4
+
+
+def write_summary(config: SummaryConfig) -> Path:
+    """Summarizes every group of every split, and returns the path of the feather file."""
+    # the data pipeline is only needed here, and is slow to import
+    from facet.data.dataset import groups_in_split
+
+    out = config.out or config.data.dataset_folder / 'summary.feather'
+    dist_bins = np.array(config.dist_bins)
+    atomic_numbers = config.data.metadata.atomic_numbers
+    species = species_names(atomic_numbers)
+
+    groups = [(split, group) for split in SPLITS for group in groups_in_split(config.data, split)]
+    group_files = [sorted(group.glob('*.mpk')) for _split, group in groups]
+
+    tmp_out = out.with_name(f'.{out.name}.tmp')
+    writer = None
+    with ProcessPoolExecutor(config.num_workers) as pool:
+        summaries = pool.map(
+            summarize_group, group_files, repeat(dist_bins), repeat(len(atomic_numbers))
+        )
+        for i, ((split, group), summary) in enumerate(zip(groups, summaries)):
+            group_num = int(group.stem.removeprefix('group_'))
+            batch = to_record_batch(summary, split, group_num, species)
+            if writer is None:
+                writer = ipc.new_file(tmp_out, batch.schema)
+            writer.write_batch(batch)
+            logging.info('Summarized group %d of %d', i + 1, len(groups))
+
+    if writer is None:
+        raise FileNotFoundError(f'No groups in {config.data.dataset_folder / "batches"}')
+    writer.close()
+    tmp_out.replace(out)
+    return out
+
+
+@pyrallis.wrap()
+def main(config: SummaryConfig):
+    logging.basicConfig(level=logging.INFO)
+    out = write_summary(config)
+    logging.info('Wrote %s', out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""
+Synthetic crystals, for benchmarks and for exercising the models and data pipeline without a
+dataset.
+
+The structures are random, but have a realistic density and exact periodic k-NN graphs, so the
+models see the same kinds of inputs they do in training. write_dataset lays them out like the
+preprocessed datasets, so the data loader can read them: run python -m facet.data.synthetic
+--data_folder=precomputed/ to write precomputed/synthetic, then train with
+--data.dataset_name=synthetic.
+"""
+
+import logging
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+import pyrallis
+from flax.serialization import to_state_dict
+
+from facet.config.common import dataclass
+from facet.data.databatch import CrystalData, CrystalGraphs, NodeData, TargetInfo, collate
+from facet.data.metadata import DatasetMetadata, save_metadata
+from facet.data.neighbors import knn_graph
+from facet.utils import save_pytree
+
+# typical volume per atom of inorganic crystals, in Å^3
+VOLUME_PER_ATOM = 15.0
+
+
+def random_structure(
+    rng: np.random.Generator,
+    num_atoms: int,
+    k: int,
+    num_species: int,
+    volume_per_atom: float = VOLUME_PER_ATOM,
+) -> CrystalGraphs:
+    """A single unpadded graph with random positions in a randomly strained cell, random species,
+    and random targets of roughly the scale of the real ones."""
+    side = (num_atoms * volume_per_atom) ** (1 / 3)
+    strain = rng.normal(scale=0.1, size=(3, 3))
+    lat = side * (np.eye(3) + (strain + strain.T) / 2)
+    cart = rng.random((num_atoms, 3)) @ lat
+
+    stress = rng.normal(scale=10, size=(3, 3))
+
+    # the same types as the preprocessed datasets
+    return CrystalGraphs(
+        nodes=NodeData(
+            species=rng.integers(0, num_species, num_atoms).astype(np.uint8),
+            cart=cart.astype(np.float32),
+            graph_i=np.zeros(num_atoms, dtype=np.uint16),
+        ),
+        edges=knn_graph(lat, cart, k),
+        n_node=np.array([num_atoms], dtype=np.uint16),
+        padding_mask=np.ones(1, dtype=np.bool_),
+        graph_data=CrystalData.from_lattice(lat, rng.integers(0, 2**31)),
+        target_data=TargetInfo(
+            e_form=rng.normal(loc=-5, size=1),
+            force=rng.normal(size=(num_atoms, 3)),
+            stress=((stress + stress.T) / 2)[None],
+        ),
+    )
+
+
+def random_structures(
+    num_graphs: int,
+    k: int,
+    num_species: int,
+    atoms_range: tuple[int, int] = (2, 64),
+    seed: int = 0,
+) -> list[CrystalGraphs]:
+    """Unpadded graphs with sizes drawn uniformly from atoms_range, inclusive."""
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(atoms_range[0], atoms_range[1] + 1, num_graphs)
+    return [random_structure(rng, int(n), k, num_species) for n in sizes]
+
+
+def pack_batch(
+    graphs: Sequence[CrystalGraphs], n_nodes: int, k: int, n_graphs: int
+) -> tuple[CrystalGraphs, int]:
+    """Collates the first graphs that fit and pads them to the given shape, leaving room for a
+    padding node and graph. Returns the batch and the number of graphs used."""
+    num_used, num_atoms = 0, 0
+    for g in graphs:
+        if num_atoms + g.n_total_nodes >= n_nodes or num_used + 1 >= n_graphs:
+            break
+        num_atoms += g.n_total_nodes
+        num_used += 1
+    if num_used == 0:
+        raise ValueError(f'The first graph does not fit in {n_nodes} nodes')
+    return collate(graphs[:num_used]).padded(n_nodes, k, n_graphs), num_used
+
+
+def synthetic_batch(
+    n_nodes: int, k: int, n_graphs: int, num_species: int, seed: int = 0
+) -> CrystalGraphs:
+    """A padded batch of the given shape, filled about as much as the batches in training: the
+    graphs have up to 4 times the average number of nodes per graph."""
+    max_atoms = max(2, 4 * n_nodes // n_graphs)
+    graphs = random_structures(n_graphs, k, num_species, (1, max_atoms), seed=seed)
+    return pack_batch(graphs, n_nodes, k, n_graphs)[0]
+
+
+def synthetic_metadata(
+    num_species: int,
+    k: int,
+    batch_num_atoms: int,
+    batch_num_graphs: int,
+    volume_per_atom: float = VOLUME_PER_ATOM,
+    dataset_name: str = 'synthetic',
+) -> DatasetMetadata:
+    """Metadata matching the synthetic structures. The species have atomic numbers 1 to
+    num_species, and the neighbor counts are those of an ideal gas with the same density."""
+    r = np.linspace(1, 10, 19)
+    counts = np.minimum(np.round(4 / 3 * np.pi * r**3 / volume_per_atom), k).astype(int)
+    return DatasetMetadata(
+        dataset_name=dataset_name,
+        supported_targets=('energy', 'force', 'stress'),
+        batches_per_group=np.ones(1, dtype=np.uint32),
+        batch_num_atoms=batch_num_atoms,
+        nearest_k=k,
+        batch_num_graphs=batch_num_graphs,
+        shift_energy=-5.0,
+        scale_energy=1.0,
+        atomic_numbers=np.arange(1, num_species + 1),
+        atomwise_shift_energy=np.zeros(num_species),
+        atomwise_scale_energy=np.ones(num_species),
+        r_max_quantile_r=r,
+        r_max_quantile_k=np.eye(k + 1)[counts],
+    )
+
+
+def structure_sizes(
+    rng: np.random.Generator, num: int, median: float, sigma: float, max_atoms: int
+) -> np.ndarray:
+    """Numbers of atoms with a log-normal distribution, like those of the Materials Project: most
+    structures are small, with a long tail of large ones."""
+    sizes = np.round(rng.lognormal(np.log(median), sigma, num))
+    return np.clip(sizes, 1, max_atoms).astype(int)
+
+
+def save_pytree_zarr(tree, path: Path):
+    """Saves a PyTree as a zipped zarr group, in the format facet.data.dataset.load_file_zarr
+    reads."""
+    import zarr  # type: ignore
+
+    def write(group, state):
+        for key, value in state.items():
+            if isinstance(value, dict):
+                write(group.create_group(key), value)
+            else:
+                group.array(key, np.asarray(value))
+
+    path.unlink(missing_ok=True)
+    store = zarr.ZipStore(str(path), mode='w')
+    write(zarr.group(store=store, overwrite=True), to_state_dict(tree))
+    store.close()
+
+
+def write_dataset(
+    folder: Path,
+    num_groups: int = 36,
+    batches_per_group: int = 8,
+    batch_num_graphs: int = 32,
+    batch_num_atoms: int = 32,
+    k: int = 16,
+    num_species: int = 89,
+    median_atoms: float = 16,
+    sigma_atoms: float = 0.8,
+    use_zarr: bool = False,
+    seed: int = 0,
+) -> DatasetMetadata:
+    """Writes a dataset of random structures to folder/batches/group_XXXX/NNNNN.mpk, with the same
+    layout, batch shapes, and types as the preprocessed datasets, and the metadata to
+    folder/metadata.mpk. With use_zarr, also writes each batch as NNNNN.zip.
+
+    Each batch is padded to batch_num_graphs graphs and batch_num_graphs * batch_num_atoms nodes,
+    filled with structures in the order they're drawn until the next one doesn't fit."""
+    rng = np.random.default_rng(seed)
+    n_nodes = batch_num_graphs * batch_num_atoms
+    max_atoms = min(n_nodes - 1, 8 * batch_num_atoms)
+
+    for group in range(num_groups):
+        group_folder = folder / 'batches' / f'group_{group:04}'
+        group_folder.mkdir(parents=True, exist_ok=True)
+        pending = []
+        for batch in range(batches_per_group):
+            graphs, num_atoms = [], 0
+            while True:
+                if not pending:
+                    pending = list(structure_sizes(rng, 64, median_atoms, sigma_atoms, max_atoms))
+                size = pending[-1]
+                if num_atoms + size >= n_nodes or len(graphs) + 1 >= batch_num_graphs:
+                    break
+                graphs.append(random_structure(rng, pending.pop(), k, num_species))
+                num_atoms += size
+
+            cg = collate(graphs).padded(n_nodes, k, batch_num_graphs).to_storage()
+            save_pytree(cg, group_folder / f'{batch:05}.mpk')
+            if use_zarr:
+                save_pytree_zarr(cg, group_folder / f'{batch:05}.zip')
+        logging.info('Wrote group %d of %d', group + 1, num_groups)
+
+    metadata = synthetic_metadata(num_species, k, batch_num_atoms, batch_num_graphs)
+    metadata = metadata.replace(batches_per_group=np.full(num_groups, batches_per_group))
+    save_metadata(metadata, folder / 'metadata.mpk')
+    return metadata
+
+
+@dataclass
+class SyntheticDatasetConfig:
+    # Writes the dataset to data_folder/dataset_name, where DataConfig looks for it.
+    data_folder: Path = Path('precomputed/')
+    dataset_name: str = 'synthetic'
+
+    num_groups: int = 36
+    batches_per_group: int = 8
+    batch_num_graphs: int = 32
+    batch_num_atoms: int = 32
+    k: int = 16
+    num_species: int = 89
+    # Median and log-scale standard deviation of the number of atoms in each structure.
+    median_atoms: float = 16
+    sigma_atoms: float = 0.8
+    # Also write each batch as zarr.
+    use_zarr: bool = False
+    seed: int = 0
+
+
+@pyrallis.wrap()
+def main(config: SyntheticDatasetConfig):
+    logging.basicConfig(level=logging.INFO)
+    write_dataset(
+        config.data_folder / config.dataset_name,
+        num_groups=config.num_groups,
+        batches_per_group=config.batches_per_group,
+        batch_num_graphs=config.batch_num_graphs,
+        batch_num_atoms=config.batch_num_atoms,
+        k=config.k,
+        num_species=config.num_species,
+        median_atoms=config.median_atoms,
+        sigma_atoms=config.sigma_atoms,
+        use_zarr=config.use_zarr,
+        seed=config.seed,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Exports trained models for inference. Load the exported directory with facet.frozen.FrozenModel.
+
+Run with python -m facet.export --run_dir=logs/my_run --out_dir=frozen/my_run.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Optional, Sequence
+
+import jax
+import jax.numpy as jnp
+import pyrallis
+from flax.serialization import from_state_dict, msgpack_restore, to_bytes
+
+from facet.calculator import FacetCalculator
+from facet.config import field
+from facet.config.common import dataclass
+from facet.data.databatch import CrystalData, CrystalGraphs, EdgeData, NodeData, TargetInfo
+from facet.frozen import ARTIFACT_VERSION, INPUT_NAMES, bucket_file
+from facet.layers import Context
+from facet.quantize import dequantize_params
+from facet.stress import cell_volume, inverse_volume
+
+
+@dataclass
+class ExportConfig:
+    # Training run to export the best checkpoint of.
+    run_dir: Path = Path('logs/')
+    out_dir: Path = Path('frozen/')
+    use_ema: bool = True
+
+    # Batch shapes to export: every combination of nodes and graphs.
+    node_buckets: list[int] = field(default_factory=lambda: [64, 128, 256, 512, 1024])
+    graph_buckets: list[int] = field(default_factory=lambda: [8, 32])
+
+    # Platforms to export for, like cpu or cuda. Defaults to the current backend.
+    platforms: Optional[list[str]] = None
+
+    # Store the weights as 'int8' or 'fp8', dequantizing them inside the exported functions. See
+    # facet.quantize.
+    quantize: Optional[str] = None
+
+
+def efs_function(calc: FacetCalculator):
+    """The model as a function of the parameters and the arrays in INPUT_NAMES, returning the
+    energy, force, and stress as the model outputs them. The parameters are those of the calculator
+    as they come back from MsgPack: quantized weights are plain dictionaries, and are dequantized
+    inside the function, like FacetCalculator.executable does."""
+
+    def efs(params, species, cart, graph_i, to_jimage, receiver, n_node, padding_mask, lat):
+        params = dequantize_params(from_state_dict(calc.params, params))
+        n_graphs = n_node.shape[0]
+        volume = cell_volume(lat)
+        cg = CrystalGraphs(
+            nodes=NodeData(species=species, cart=cart, graph_i=graph_i),
+            edges=EdgeData(to_jimage=to_jimage, receiver=receiver),
+            n_node=n_node,
+            padding_mask=padding_mask,
+            graph_data=CrystalData(
+                dataset_id=jnp.zeros(n_graphs, dtype=jnp.int32),
+                abc=jnp.zeros((n_graphs, 3), dtype=lat.dtype),
+                angles_rad=jnp.zeros((n_graphs, 3), dtype=lat.dtype),
+                lat=lat,
+                volume=volume,
+                inv_volume=inverse_volume(volume),
+            ),
+            target_data=TargetInfo(
+                e_form=jnp.zeros(n_graphs, dtype=lat.dtype),
+                force=jnp.zeros_like(cart),
+                stress=jnp.zeros_like(lat),
+            ),
+        )
+        out = calc.efs(calc.mod.apply, params, cg, ctx=Context(training=False))
+        return out.energy, out.force, out.stress
+
+    return efs
+
+
+def graph_inputs(cg: CrystalGraphs) -> list[jax.Array]:
+    """The arrays in INPUT_NAMES from a batch, as JAX would see them."""
+    arrays = {
+        'species': cg.nodes.species,
+        'cart': cg.nodes.cart,
+        'graph_i': cg.nodes.graph_i,
+        'to_jimage': cg.edges.to_jimage,
+        'receiver': cg.edges.receiver,
+        'n_node': cg.n_node,
+        'padding_mask': cg.padding_mask,
+        'lat': cg.graph_data.lat,
+    }
+    return [jnp.asarray(arrays[name]) for name in INPUT_NAMES]
+
+
+def export_model(
+    calc: FacetCalculator,
+    out_dir: Path,
+    buckets: Sequence[tuple[int, int]],
+    platforms: Optional[Sequence[str]] = None,
+):
+    """Writes the parameters, metadata, and a serialized function for each (nodes, graphs) bucket
+    to out_dir."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # the loader gets the parameters back from MsgPack, so export with the same tree structure
+    params_bytes = to_bytes(calc.params)
+    params = msgpack_restore(params_bytes)
+    with open(out_dir / 'params.mpk', 'wb') as f:
+        f.write(params_bytes)
+
+    example = calc.example()
+    efs = jax.jit(efs_function(calc))
+    dtypes = {}
+    for n_nodes, n_graphs in buckets:
+        inputs = graph_inputs(example.padded(n_nodes, calc.k, n_graphs))
+        dtypes = {name: str(x.dtype) for name, x in zip(INPUT_NAMES, inputs)}
+        exported = jax.export.export(efs, platforms=platforms)(params, *inputs)
+        with open(out_dir / bucket_file(n_nodes, n_graphs), 'wb') as f:
+            f.write(exported.serialize())
+        logging.info('Exported %d nodes, %d graphs', n_nodes, n_graphs)
+
+    metadata = {
+        'version': ARTIFACT_VERSION,
+        'k': calc.k,
+        'atomic_numbers': [int(z) for z in calc.config.data.metadata.atomic_numbers],
+        'buckets': [list(b) for b in buckets],
+        'dtypes': dtypes,
+        'grad_mode': calc.efs.grad_mode,
+        'platforms': list(platforms) if platforms is not None else [jax.default_backend()],
+    }
+    with open(out_dir / 'metadata.json', 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+@pyrallis.wrap()
+def main(config: ExportConfig):
+    logging.basicConfig(level=logging.INFO)
+    calc = FacetCalculator.from_run(
+        config.run_dir, use_ema=config.use_ema, quantize=config.quantize
+    )
+    buckets = [(n, g) for n in config.node_buckets for g in config.graph_buckets]
+    export_model(calc, config.out_dir, buckets, config.platforms)
+
+
+if __name__ == '__main__':
+    main()
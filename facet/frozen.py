@@ -0,0 +1,190 @@
+"""
+Loads models exported with facet.export.
+
+A frozen model is a directory with the EMA parameters, the little metadata needed to build inputs,
+and one serialized StableHLO function per batch shape. Loading one doesn't import the model code,
+the configs, or orbax, and doesn't trace anything, so it only takes as long as reading the files.
+"""
+
+import json
+from os import PathLike
+from pathlib import Path
+from typing import Optional, Sequence
+
+import jax
+import numpy as np
+from flax.serialization import msgpack_restore
+from jaxtyping import Array, Float
+
+from facet.data.neighbors import knn_graph
+from facet.stress import EV_PER_A3_TO_KBAR
+
+ARTIFACT_VERSION = 1
+
+# inputs of the exported functions, in order
+INPUT_NAMES = (
+    'species',
+    'cart',
+    'graph_i',
+    'to_jimage',
+    'receiver',
+    'n_node',
+    'padding_mask',
+    'lat',
+)
+
+
+def bucket_file(n_nodes: int, n_graphs: int) -> str:
+    return f'efs_{n_nodes}_{n_graphs}.stablehlo'
+
+
+def split_results(
+    energy: Float[Array, 'graphs 1'],
+    force: Float[Array, 'nodes 3'],
+    stress: Float[Array, 'graphs 3 3'],
+    sizes: Sequence[int],
+) -> list[dict]:
+    """Splits the outputs for a batch into the results for the first len(sizes) structures, which
+    have the given numbers of atoms, in ASE units: eV for energy, eV/Å for forces, and eV/Å^3 Voigt
+    stress with ASE's sign convention."""
+    results = []
+    start = 0
+    for graph_i, n in enumerate(sizes):
+        total = float(energy[graph_i, 0]) * n
+        # targets use kbar, with positive stress compressive
+        full = -np.asarray(stress[graph_i]) / EV_PER_A3_TO_KBAR
+        results.append(
+            {
+                'energy': total,
+                'free_energy': total,
+                'forces': np.asarray(force[start : start + n]),
+                'stress': full[[0, 1, 2, 1, 0, 0], [0, 1, 2, 2, 2, 1]],
+            }
+        )
+        start += n
+    return results
+
+
+class FrozenModel:
+    """Model loaded from an exported directory. Predicts batches padded to the exported shapes."""
+
+    def __init__(self, path: PathLike, cache_dir: Optional[PathLike] = '/tmp/jax_comp_cache'):
+        """Loads the model in path. XLA still compiles each function the first time it's called,
+        which can take a while, so the compiled programs are kept in cache_dir, shared with training
+        runs, unless it's None."""
+        self.path = Path(path)
+        if cache_dir is not None:
+            jax.config.update('jax_compilation_cache_dir', str(cache_dir))
+            # the default only caches programs that take a second to compile
+            jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
+        with open(self.path / 'metadata.json') as f:
+            self.metadata = json.load(f)
+        if self.metadata['version'] != ARTIFACT_VERSION:
+            raise ValueError(
+                f'{self.path} has version {self.metadata["version"]}, expected {ARTIFACT_VERSION}'
+            )
+
+        with open(self.path / 'params.mpk', 'rb') as f:
+            self.params = jax.device_put(msgpack_restore(f.read()))
+
+        self.k = self.metadata['k']
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in self.metadata['dtypes'].items()}
+        numbers = np.array(self.metadata['atomic_numbers'])
+        self.species_index = np.full(int(np.max(numbers)) + 1, -1, dtype=np.int16)
+        self.species_index[numbers] = np.arange(len(numbers))
+        # sorted by size, so the first that fits is the smallest
+        self.buckets = sorted(tuple(b) for b in self.metadata['buckets'])
+        # deserialized functions, by bucket: deserializing is fast, but not free
+        self.functions = {}
+
+    def function(self, bucket: tuple[int, int]) -> jax.export.Exported:
+        if bucket not in self.functions:
+            with open(self.path / bucket_file(*bucket), 'rb') as f:
+                self.functions[bucket] = jax.export.deserialize(bytearray(f.read()))
+        return self.functions[bucket]
+
+    def bucket(self, n_node: int, n_graph: int) -> tuple[int, int]:
+        """Smallest exported shape with room for the given real nodes and graphs, plus padding."""
+        for n_nodes, n_graphs in self.buckets:
+            if n_node < n_nodes and n_graph < n_graphs:
+                return n_nodes, n_graphs
+        raise ValueError(
+            f'No exported shape fits {n_node} atoms in {n_graph} structures: export a larger one'
+        )
+
+    def structure_inputs(self, structure) -> dict[str, np.ndarray]:
+        """Inputs for a single ASE Atoms or pymatgen Structure, without padding. The atoms don't
+        need to be inside the unit cell."""
+        if hasattr(structure, 'cell'):
+            lat, cart, numbers = structure.cell.array, structure.positions, structure.numbers
+        else:
+            lat = structure.lattice.matrix
+            cart, numbers = structure.cart_coords, np.array(structure.atomic_numbers)
+        if np.max(numbers) >= len(self.species_index) or np.any(self.species_index[numbers] < 0):
+            raise ValueError(f'Structure has elements the model was not trained on: {numbers}')
+
+        edges = knn_graph(lat, cart, self.k)
+        return {
+            'species': self.species_index[numbers],
+            'cart': np.asarray(cart),
+            'graph_i': np.zeros(len(numbers)),
+            'to_jimage': edges.to_jimage,
+            'receiver': edges.receiver,
+            'n_node': np.array([len(numbers)]),
+            'padding_mask': np.ones(1),
+            'lat': np.asarray(lat)[None],
+        }
+
+    def batch_inputs(self, inputs: Sequence[dict], bucket: tuple[int, int]) -> list[np.ndarray]:
+        """Collates the inputs for single structures and pads them to the bucket, the same way as
+        CrystalGraphs.padded: the padding nodes all belong to the first padding graph, with edges to
+        the first padding node."""
+        n_nodes, n_graphs = bucket
+        n_node = sum(len(x['species']) for x in inputs)
+        pad_nodes, pad_graphs = n_nodes - n_node, n_graphs - len(inputs)
+
+        node_offsets = np.cumsum([0] + [len(x['species']) for x in inputs])
+        arrays = {
+            'species': [x['species'] for x in inputs] + [np.zeros(pad_nodes)],
+            'cart': [x['cart'] for x in inputs] + [np.zeros((pad_nodes, 3))],
+            'graph_i': [np.full(len(x['species']), i) for i, x in enumerate(inputs)]
+            + [np.full(pad_nodes, len(inputs))],
+            'to_jimage': [x['to_jimage'] for x in inputs] + [np.zeros((pad_nodes, self.k, 3))],
+            'receiver': [x['receiver'] + off for x, off in zip(inputs, node_offsets)]
+            + [np.full((pad_nodes, self.k), n_node)],
+            'n_node': [x['n_node'] for x in inputs] + [[pad_nodes], np.zeros(pad_graphs - 1)],
+            'padding_mask': [x['padding_mask'] for x in inputs] + [np.zeros(pad_graphs)],
+            'lat': [x['lat'] for x in inputs] + [np.zeros((pad_graphs, 3, 3))],
+        }
+        return [np.concatenate(arrays[name]).astype(self.dtypes[name]) for name in INPUT_NAMES]
+
+    def batches(self, sizes: Sequence[int]) -> list[list[int]]:
+        """Groups structures with the given numbers of atoms into batches that fit the largest
+        exported shape, largest structures first."""
+        max_nodes, max_graphs = self.buckets[-1]
+        batches = []
+        curr, curr_size = [], 0
+        for i in np.argsort(-np.array(sizes), kind='stable'):
+            size = sizes[i]
+            if curr and (curr_size + size >= max_nodes or len(curr) + 1 >= max_graphs):
+                batches.append(curr)
+                curr, curr_size = [], 0
+            curr.append(int(i))
+            curr_size += size
+        if curr:
+            batches.append(curr)
+        return batches
+
+    def predict(self, structures: Sequence) -> list[dict[str, np.ndarray | float]]:
+        """Computes the energy, forces, and stress of every structure, in ASE units."""
+        inputs = [self.structure_inputs(s) for s in structures]
+        sizes = [len(x['species']) for x in inputs]
+        results: list[dict] = [{} for _ in structures]
+        for batch in self.batches(sizes):
+            bucket = self.bucket(sum(sizes[i] for i in batch), len(batch))
+            args = self.batch_inputs([inputs[i] for i in batch], bucket)
+            energy, force, stress = jax.device_get(self.function(bucket).call(self.params, *args))
+            batch_results = split_results(energy, force, stress, [sizes[i] for i in batch])
+            for i, result in zip(batch, batch_results):
+                results[i] = result
+        return results
@@ -7,8 +7,11 @@ from jaxtyping import Float, Array
 
 from facet.data.metadata import DatasetMetadata
 from facet.layers import Context, E3IrrepsArray, Identity
+from facet.probes import Probe
 from facet.utils import get_or_init
 
+basis_probe = Probe(f'{__name__}.basis')
+
 
 class RadialBasis(nn.Module):
     """Set of radial basis functions."""
@@ -106,7 +109,7 @@ class BesselBasis(RadialBasis):
 
         e_d = jnp.sqrt(2 / r_max) * jnp.sinc(self.freq * dist) * (jnp.pi * self.freq / r_max)
 
-        # debug_stat(e_d=e_d, env=env, dist=dist)
+        basis_probe(e_d=e_d, dist=dist)
         return e_d
 
 
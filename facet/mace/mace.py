@@ -32,8 +32,11 @@ from facet.mace.node_embedding import NodeEmbedding
 from facet.mace.self_connection import (
     SelfConnectionBlock,
 )
+from facet.probes import Probe
 from facet.utils import debug_stat, debug_structure, get_or_init, load_pytree
 
+rescale_probe = Probe(f'{__name__}.rescale')
+
 
 def safe_norm(x: jnp.ndarray, axis: int | None = None, keepdims=False) -> jnp.ndarray:
     """nan-safe norm."""
@@ -87,7 +90,7 @@ class SpeciesWiseRescale(nn.Module):
         shift = shift / num_atoms + self.global_shift
 
         graph_energies = self.reduction(energies, cg.nodes.graph_i, cg.n_total_graphs, ctx=ctx)
-        # debug_stat(scale=scale, shift=shift, energies=graph_energies)
+        rescale_probe(scale=scale, shift=shift, energies=graph_energies)
         scaled_outs = graph_energies * scale + shift
 
         return scaled_outs[..., None]
@@ -127,15 +130,17 @@ class MACELayer(nn.Module):
         #         axis=-1,
         #     )
         if self.residual:
-            x = E3LayerNorm(
-                separation='scalars',
-                scale_init=self.resid_init,
-                learned_scale=True,
-                name='resid_ln',
-            )(x, ctx)
-            # resid = ResidualLinearAdapter(x.irreps)(node_feats, ctx=ctx)
-            resid = ResidualAdapter(x.irreps)(node_feats, ctx=ctx)
-            x = x + resid
+            # Flax names the scope of every module call, but the sum isn't in any module
+            with jax.named_scope('residual'):
+                x = E3LayerNorm(
+                    separation='scalars',
+                    scale_init=self.resid_init,
+                    learned_scale=True,
+                    name='resid_ln',
+                )(x, ctx)
+                # resid = ResidualLinearAdapter(x.irreps)(node_feats, ctx=ctx)
+                resid = ResidualAdapter(x.irreps)(node_feats, ctx=ctx)
+                x = x + resid
 
         layer_norm = E3LayerNorm(
             separation='scalars', scale_init=nn.initializers.ones, name='layer_norm'
@@ -293,8 +298,13 @@ class MaceModel(nn.Module):
         self,
         cg: CrystalGraphs,
         ctx: Context,
+        vecs: Float[Array, 'nodes k 3'] | None = None,
     ) -> Float[Array, ' graphs 1']:
-        vecs = edge_vecs(cg).astype(self.dtype)
+        """Predicts the energy of each graph. vecs, if given, overrides the edge vectors computed
+        from the graph, so gradients can be taken with respect to them directly."""
+        if vecs is None:
+            vecs = edge_vecs(cg)
+        vecs = vecs.astype(self.dtype)
 
         # shape [n_nodes, n_interactions, output_irreps]
         mace_out = self.mace(
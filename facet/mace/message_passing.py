@@ -6,11 +6,14 @@ import jax.numpy as jnp
 from e3nn_jax.legacy import FunctionalTensorProduct
 import e3nn_jax as e3nn
 from facet.layers import Context, LazyInMLP
+from facet.probes import Probe
 from facet.utils import debug_stat, debug_structure
 import jax
 import functools as ft
 import operator
 
+messages_probe = Probe(f'{__name__}.messages')
+
 
 class MPConv(IrrepsModule):
     avg_num_neighbors: float | None
@@ -373,7 +376,7 @@ class SimpleMixMLPConv(MPConv):
         # radial = nn.tanh(radial.array)
         messages = messages * radial  # [n_nodes, k, irreps]
 
-        # debug_stat(messages=messages, radial=radial)
+        messages_probe(messages=messages, radial=radial)
 
         zeros = E3IrrepsArray.zeros(messages.irreps, node_feats.shape[:1], messages.dtype)
         # TODO flip this perhaps?
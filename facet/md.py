@@ -0,0 +1,265 @@
+"""
+Molecular dynamics on device.
+
+Runs velocity Verlet, optionally with a Langevin or Nosé–Hoover thermostat, for many steps in a
+single jax.lax.scan. The k-NN graph is selected each step from a candidate list that is only
+rebuilt, on device, when the atoms have moved far enough that it might be out of date: see
+facet.data.neighbors.NeighborCandidates.
+
+Many independent replicas run in one program: every array in MDState has a leading replica axis,
+and each replica is a padded CrystalGraphs that can itself hold several structures. Units are Å, eV,
+amu, K, and fs.
+"""
+
+import functools as ft
+from typing import Callable, Optional
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from flax import struct
+from jaxtyping import Array, Bool, Float, Int
+
+from facet.data.databatch import CrystalGraphs
+from facet.data.neighbors import (
+    NeighborCandidates,
+    num_images,
+    per_graph,
+    rebuild_candidates,
+    refresh_candidates,
+)
+from facet.layers import Context
+from facet.regression import EFSWrapper
+
+# 1 fs in units of Å sqrt(amu / eV)
+FS = 0.09822694788464063
+# Boltzmann constant, eV/K
+KB = 8.617333262e-5
+
+THERMOSTATS = ('none', 'langevin', 'nose-hoover')
+
+
+class MDState(struct.PyTreeNode):
+    """State of a batch of MD replicas. Every array has a leading replica axis."""
+
+    cg: CrystalGraphs
+    velocity: Float[Array, 'replicas nodes 3']
+    force: Float[Array, 'replicas nodes 3']
+    # total energy per structure
+    energy: Float[Array, 'replicas graphs']
+    mass: Float[Array, 'replicas nodes']
+    cands: NeighborCandidates
+    # Nosé–Hoover thermostat friction and position per structure
+    nh_xi: Float[Array, 'replicas graphs']
+    nh_eta: Float[Array, 'replicas graphs']
+    rng: jax.Array
+    step: Int[Array, '']
+    num_rebuilds: Int[Array, '']
+    # False if a candidate list was ever built without enough margin
+    neighbors_ok: Bool[Array, '']
+
+
+class MDObservables(struct.PyTreeNode):
+    """Values recorded at every step."""
+
+    potential_energy: Float[Array, 'replicas graphs']
+    kinetic_energy: Float[Array, 'replicas graphs']
+    temperature: Float[Array, 'replicas graphs']
+    # Nosé–Hoover conserved quantity, or the total energy for the other thermostats
+    conserved: Float[Array, 'replicas graphs']
+
+
+def node_mask(cg: CrystalGraphs) -> Bool[Array, '*replicas nodes']:
+    return jnp.take_along_axis(cg.padding_mask, cg.nodes.graph_i.astype(jnp.int32), axis=-1)
+
+
+def degrees_of_freedom(cg: CrystalGraphs) -> Float[Array, 'graphs']:
+    """3N - 3, since the center of mass is fixed."""
+    return jnp.maximum(3 * cg.n_node - 3, 1).astype(cg.nodes.cart.dtype)
+
+
+def remove_drift(
+    velocity: Float[Array, 'nodes 3'], mass: Float[Array, 'nodes'], cg: CrystalGraphs
+) -> Float[Array, 'nodes 3']:
+    """Removes the center of mass velocity of each structure."""
+    momentum = per_graph(mass[:, None] * velocity, cg)
+    total_mass = per_graph(mass, cg)
+    return velocity - (momentum / jnp.maximum(total_mass, 1e-6)[:, None])[cg.nodes.graph_i]
+
+
+def kinetic_energy(
+    velocity: Float[Array, 'nodes 3'], mass: Float[Array, 'nodes'], cg: CrystalGraphs
+) -> Float[Array, 'graphs']:
+    return per_graph(0.5 * mass * jnp.sum(velocity**2, axis=-1), cg)
+
+
+class MDIntegrator(struct.PyTreeNode):
+    """Settings for an MD run. All fields are static."""
+
+    # time step, fs
+    dt: float = struct.field(pytree_node=False, default=1.0)
+    # thermostat: 'none' for NVE, 'langevin', or 'nose-hoover'
+    thermostat: str = struct.field(pytree_node=False, default='none')
+    # target temperature, K
+    temperature: float = struct.field(pytree_node=False, default=300.0)
+    # Langevin friction, 1/fs
+    friction: float = struct.field(pytree_node=False, default=0.01)
+    # Nosé–Hoover relaxation time, fs
+    nh_tau: float = struct.field(pytree_node=False, default=100.0)
+    # number of edges per atom: should match the data the model was trained on
+    k: int = struct.field(pytree_node=False, default=16)
+    # size of the candidate list: more candidates means a larger skin and fewer rebuilds
+    num_candidates: int = struct.field(pytree_node=False, default=32)
+    # lattice translations checked along each axis when rebuilding
+    n_images: int = struct.field(pytree_node=False, default=1)
+    grad_mode: str = struct.field(pytree_node=False, default='positions')
+
+    def __post_init__(self):
+        if self.thermostat not in THERMOSTATS:
+            raise ValueError(f'Unknown thermostat {self.thermostat}: choose from {THERMOSTATS}')
+
+    @property
+    def efs(self) -> EFSWrapper:
+        return EFSWrapper(compute_force=True, compute_stress=False, grad_mode=self.grad_mode)
+
+    def with_images_for(self, cg: CrystalGraphs) -> 'MDIntegrator':
+        """Sets n_images from the structures in cg, a single replica. Runs on the host."""
+        return self.replace(n_images=num_images(cg, self.num_candidates))
+
+    def forces(
+        self, apply_fn: Callable, params, cg: CrystalGraphs
+    ) -> tuple[Float[Array, 'nodes 3'], Float[Array, 'graphs']]:
+        out = self.efs(apply_fn, params, cg, ctx=Context(training=False))
+        return out.force, out.energy[..., 0] * cg.n_node
+
+    def rebuild(self, cg: CrystalGraphs) -> tuple[CrystalGraphs, NeighborCandidates]:
+        """Wraps the atoms back into the cell and rebuilds the candidate list, for one replica."""
+        return rebuild_candidates(cg, self.k, self.num_candidates, self.n_images)
+
+    def init(
+        self,
+        apply_fn: Callable,
+        params,
+        cg: CrystalGraphs,
+        mass: Float[Array, 'replicas nodes'],
+        rng: jax.Array,
+        temperature: Optional[float] = None,
+    ) -> MDState:
+        """Sets up replicas from stacked graphs and masses. Velocities are drawn from the
+        Maxwell-Boltzmann distribution at the given temperature, which defaults to the thermostat
+        temperature, with no center of mass motion."""
+        temperature = self.temperature if temperature is None else temperature
+        mask = node_mask(cg)
+        mass = jnp.where(mask, mass, 1)
+
+        rng, vel_rng = jax.random.split(rng)
+        velocity = jax.random.normal(vel_rng, cg.nodes.cart.shape, cg.nodes.cart.dtype)
+        velocity = velocity * jnp.sqrt(KB * temperature / mass)[..., None]
+        velocity = jnp.where(mask[..., None], velocity, 0)
+
+        velocity = jnp.where(mask[..., None], jax.vmap(remove_drift)(velocity, mass, cg), 0)
+
+        cg, cands = jax.vmap(self.rebuild)(cg)
+        force, energy = jax.vmap(ft.partial(self.forces, apply_fn, params))(cg)
+        return MDState(
+            cg=cg,
+            velocity=velocity,
+            force=force,
+            energy=energy,
+            mass=mass,
+            cands=cands,
+            nh_xi=jnp.zeros_like(cg.padding_mask, dtype=cg.nodes.cart.dtype),
+            nh_eta=jnp.zeros_like(cg.padding_mask, dtype=cg.nodes.cart.dtype),
+            rng=rng,
+            step=jnp.zeros((), dtype=jnp.int32),
+            num_rebuilds=jnp.zeros((), dtype=jnp.int32),
+            neighbors_ok=jnp.all(cands.ok),
+        )
+
+    def step(self, apply_fn: Callable, params, state: MDState) -> tuple[MDState, MDObservables]:
+        """Advances every replica by a single time step."""
+        dt = self.dt * FS
+        cg = state.cg
+        mask = node_mask(cg)[..., None]
+        inv_mass = 1 / state.mass[..., None]
+        velocity = state.velocity
+        rng = state.rng
+
+        dof = jax.vmap(degrees_of_freedom)(cg)
+        kt = KB * self.temperature
+        nh_q = dof * kt * (self.nh_tau * FS) ** 2
+
+        def nose_hoover_half(velocity, xi, eta):
+            ke = jax.vmap(kinetic_energy)(velocity, state.mass, cg)
+            xi = xi + dt / 2 * (2 * ke - dof * kt) / nh_q
+            eta = eta + dt / 2 * xi
+            scale = jnp.take_along_axis(jnp.exp(-xi * dt / 2), cg.nodes.graph_i, axis=-1)
+            return velocity * scale[..., None], xi, eta
+
+        xi, eta = state.nh_xi, state.nh_eta
+        if self.thermostat == 'nose-hoover':
+            velocity, xi, eta = nose_hoover_half(velocity, xi, eta)
+
+        velocity = velocity + dt / 2 * state.force * inv_mass
+        if self.thermostat == 'langevin':
+            # BAOAB: the friction and noise go between two half drifts
+            cart = cg.nodes.cart + dt / 2 * velocity
+            rng, noise_rng = jax.random.split(rng)
+            c1 = np.exp(-self.friction / FS * dt)
+            noise = jax.random.normal(noise_rng, velocity.shape, velocity.dtype)
+            velocity = c1 * velocity + jnp.sqrt((1 - c1**2) * kt * inv_mass) * noise
+            # keep the center of mass fixed, so the temperature is over 3N - 3 degrees of freedom
+            velocity = jax.vmap(remove_drift)(velocity, state.mass, cg)
+            cart = cart + dt / 2 * velocity
+        else:
+            cart = cg.nodes.cart + dt * velocity
+        velocity = jnp.where(mask, velocity, 0)
+        cg = cg.replace(nodes=cg.nodes.replace(cart=jnp.where(mask, cart, cg.nodes.cart)))
+
+        cg, cands, needs_rebuild = refresh_candidates(
+            state.cands, cg, self.k, self.num_candidates, self.n_images
+        )
+
+        force, energy = jax.vmap(ft.partial(self.forces, apply_fn, params))(cg)
+        velocity = velocity + dt / 2 * force * inv_mass
+        if self.thermostat == 'nose-hoover':
+            velocity, xi, eta = nose_hoover_half(velocity, xi, eta)
+        velocity = jnp.where(mask, velocity, 0)
+
+        ke = jax.vmap(kinetic_energy)(velocity, state.mass, cg)
+        conserved = energy + ke
+        if self.thermostat == 'nose-hoover':
+            conserved = conserved + 0.5 * nh_q * xi**2 + dof * kt * eta
+
+        new_state = state.replace(
+            cg=cg,
+            velocity=velocity,
+            force=force,
+            energy=energy,
+            cands=cands,
+            nh_xi=xi,
+            nh_eta=eta,
+            rng=rng,
+            step=state.step + 1,
+            num_rebuilds=state.num_rebuilds + needs_rebuild,
+            neighbors_ok=state.neighbors_ok & jnp.all(cands.ok),
+        )
+        obs = MDObservables(
+            potential_energy=energy,
+            kinetic_energy=ke,
+            temperature=2 * ke / (dof * KB),
+            conserved=conserved,
+        )
+        return new_state, obs
+
+    @ft.partial(jax.jit, static_argnames=('self', 'apply_fn', 'num_steps'))
+    def run(
+        self, apply_fn: Callable, params, state: MDState, num_steps: int
+    ) -> tuple[MDState, MDObservables]:
+        """Runs num_steps steps in a single dispatch. Returns the final state and the observables
+        at every step, with a leading step axis."""
+
+        def body(state, _):
+            return self.step(apply_fn, params, state)
+
+        return jax.lax.scan(body, state, None, length=num_steps)
@@ -0,0 +1,144 @@
+"""Metrics logging for training runs, off the training loop.
+
+TrainingRun gives each metric to a MetricsLogger, which only puts it on a queue. A background
+thread takes everything that has been queued, converts any device arrays to numbers, and writes the
+batch to each sink at once, so the training loop never waits on the device, the disk, or the
+network to log. The sinks are an append-only JSONL file, which needs nothing else, and Neptune,
+which is optional.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, NamedTuple, Optional, Sequence
+
+import jax
+import numpy as np
+
+
+class MetricPoint(NamedTuple):
+    name: str
+    value: Any
+    # The epoch the value is from, or None for values of the whole run, like the parameter count.
+    step: Optional[float] = None
+
+
+def to_python(value):
+    """Converts arrays, including those on device, to numbers or lists."""
+    if isinstance(value, (jax.Array, np.ndarray, np.generic)):
+        return np.asarray(value).tolist()
+    elif isinstance(value, dict):
+        return {k: to_python(v) for k, v in value.items()}
+    else:
+        return value
+
+
+class MetricsSink(ABC):
+    """Where logged metrics are written. Points are given in the order they were logged."""
+
+    @abstractmethod
+    def write(self, points: Sequence[MetricPoint]):
+        pass
+
+    def close(self):
+        pass
+
+
+class JSONLSink(MetricsSink):
+    """Appends a JSON object for every point to a file. Values of the whole run have no step."""
+
+    def __init__(self, path: Path):
+        self.file = open(path, 'a')
+
+    def write(self, points: Sequence[MetricPoint]):
+        lines = []
+        for point in points:
+            record = {'name': point.name, 'value': point.value}
+            if point.step is not None:
+                record['step'] = point.step
+            lines.append(json.dumps(record) + '\n')
+        self.file.write(''.join(lines))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NeptuneSink(MetricsSink):
+    """Logs to a Neptune run, extending each series with all of its new values at once."""
+
+    def __init__(self, run):
+        self.run = run
+
+    def write(self, points: Sequence[MetricPoint]):
+        series = defaultdict(lambda: ([], []))
+        for point in points:
+            if point.step is None:
+                self.run[point.name] = point.value
+            else:
+                values, steps = series[point.name]
+                values.append(point.value)
+                steps.append(point.step)
+
+        for name, (values, steps) in series.items():
+            self.run[name].extend(values, steps=steps)
+
+
+class MetricsLogger:
+    """Writes metrics to the sinks in a background thread.
+
+    Logging only queues the value. The thread waits flush_secs after the first value it gets, so
+    the other values of the same log step are written with it. A value that can't be converted, or
+    a sink that raises, is logged and skipped, so it can't stop training or later metrics. The time
+    log calls take is in log_secs, to check that it stays negligible."""
+
+    def __init__(self, sinks: Sequence[MetricsSink], flush_secs: float = 1.0):
+        self.sinks = list(sinks)
+        self.flush_secs = flush_secs
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.log_secs = 0.0
+        self.done = object()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log(self, name: str, value, step: Optional[float] = None):
+        start = time.perf_counter()
+        self.queue.put(MetricPoint(name, value, step))
+        self.log_secs += time.perf_counter() - start
+
+    def _run(self):
+        closed = False
+        while not closed:
+            items = [self.queue.get()]
+            time.sleep(self.flush_secs)
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+
+            closed = any(item is self.done for item in items)
+            points = []
+            for point in items:
+                if point is self.done:
+                    continue
+                try:
+                    points.append(point._replace(value=to_python(point.value)))
+                except Exception:  # noqa: BLE001
+                    logging.exception(f'Could not convert metric {point.name}')
+            if not points:
+                continue
+            for sink in self.sinks:
+                try:
+                    sink.write(points)
+                except Exception:  # noqa: BLE001
+                    logging.exception(f'Could not write metrics to {type(sink).__name__}')
+
+    def close(self):
+        """Writes everything logged so far, and closes the sinks."""
+        self.queue.put(self.done)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
@@ -0,0 +1,75 @@
+"""
+Debug probes: named points in the code that show the values passing through them.
+
+Probes can stay in model code. A probe that isn't enabled does nothing when the function it's in is
+traced, so it isn't in the compiled program at all: there's no host callback, and nothing stops XLA
+fusing the operations around it. An enabled stat probe reduces each array to a few statistics on
+device, and only those are sent to the host. A structure probe works out shapes while tracing, and
+sends nothing.
+
+Probes are enabled with the log.probes option, by name or by the module or package they're in:
+log.probes=['facet.mace.message_passing'] enables every probe in the message passing module.
+TrainingRun and show_model enable them from their config: other code calls enable_probes. Probes are
+checked when code is traced, so they should be enabled before any jitted function that uses them is
+first called.
+"""
+
+import fnmatch
+import inspect
+from typing import Sequence
+
+from facet.utils import debug_stat, debug_structure
+
+# Every probe that has been created, by name.
+PROBES: dict[str, 'Probe'] = {}
+
+_enabled: tuple[str, ...] = ()
+
+
+def enable_probes(patterns: Sequence[str]):
+    """Enables the probes that match any of the patterns, and disables the rest. A pattern is a
+    probe's name, the name of a module or package it's in, or a glob like '*.energies'."""
+    global _enabled
+    _enabled = tuple(patterns)
+
+
+def matches(name: str, pattern: str) -> bool:
+    return name == pattern or name.startswith(pattern + '.') or fnmatch.fnmatchcase(name, pattern)
+
+
+class Probe:
+    """A named point in the code to show values at. Creating a probe registers it, so probes are
+    made once, at the top level of a module:
+
+        energies_probe = Probe(f'{__name__}.energies')
+
+    and then called with the values to show, like debug_stat or debug_structure. Calling a probe
+    returns its first argument, so it can wrap an expression.
+
+    Making a probe again in the same module, as reloading the module does, replaces the old one.
+    Two modules can't have probes with the same name."""
+
+    def __init__(self, name: str, kind: str = 'stat', tree_depth: int = 5):
+        if kind not in ('stat', 'structure'):
+            raise ValueError(f'Probe kind should be stat or structure, not {kind}')
+        module = inspect.currentframe().f_back.f_globals.get('__name__')
+        if name in PROBES and PROBES[name].module != module:
+            raise ValueError(f'There is already a probe named {name}, in {PROBES[name].module}')
+
+        self.name = name
+        self.module = module
+        self.kind = kind
+        self.tree_depth = tree_depth
+        PROBES[name] = self
+
+    @property
+    def enabled(self) -> bool:
+        return any(matches(self.name, pattern) for pattern in _enabled)
+
+    def __call__(self, *args, **kwargs):
+        values = {f'arg{i}': arg for i, arg in enumerate(args)}
+        values.update(**kwargs)
+        if self.enabled:
+            show = debug_stat if self.kind == 'stat' else debug_structure
+            show(tree_depth=self.tree_depth + 1, **{self.name: values})
+        return list(values.values())[0]
@@ -0,0 +1,400 @@
+"""
+Runtime profile of the model, broken down by block.
+
+Every submodule down to the MACELayer sub-blocks (interaction, self-connection, layer norms,
+readout, as well as the embeddings, head, and rescale) is compiled on its own, with the inputs it
+gets in the full model, to get the XLA cost analysis and measured run time of its forward pass and
+of its forward and backward passes. Flax runs each module call under a jax.named_scope with the
+module's name, so the blocks also show up by name in profiler traces of the full model: pass
+--trace_dir to write one.
+
+The report is written as JSON, which can be compared between configs, and as HTML. Run with
+python -m facet.profiling --config_file=configs/small.toml --out=reports/profile, adding
+--baseline=reports/other.json to show the change from another report.
+"""
+
+import json
+import logging
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+import flax
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pyrallis
+import rich
+from flax import errors
+from flax import linen as nn
+from pyrallis import cfgparsing
+from rich import box
+from rich.console import Console
+from rich.table import Table
+from rich.terminal_theme import MONOKAI
+
+from facet.config import MainConfig
+from facet.config.common import dataclass
+from facet.data.databatch import CrystalGraphs
+from facet.layers import Context
+from facet.regression import EFSWrapper
+
+REPORT_VERSION = 1
+
+# fields of each cost, and how to show them
+COST_UNITS = {
+    'flops': ('GFLOP', 1e9),
+    'bytes_accessed': ('MB accessed', 1e6),
+    'temp_bytes': ('MB temp', 1e6),
+    'ms': ('ms', 1),
+}
+
+
+def cost_analysis(compiled: jax.stages.Compiled) -> dict[str, float]:
+    """XLA's estimate of the FLOPs, transcendental ops, and bytes accessed by the program, with the
+    size of its temporary buffers."""
+    costs = compiled.cost_analysis()
+    # older versions of JAX return one analysis per device
+    if isinstance(costs, (list, tuple)):
+        costs = costs[0] if costs else None
+    costs = costs or {}
+    out = {
+        'flops': float(costs.get('flops', 0)),
+        'transcendentals': float(costs.get('transcendentals', 0)),
+        'bytes_accessed': float(costs.get('bytes accessed', 0)),
+    }
+    try:
+        memory = compiled.memory_analysis()
+        out['temp_bytes'] = float(memory.temp_size_in_bytes)
+    except (AttributeError, NotImplementedError):
+        out['temp_bytes'] = 0.0
+    return out
+
+
+def time_compiled(fn: Callable, args, name: str, num_iters: int) -> float:
+    """Median run time of fn(*args) in milliseconds, after a warmup run. Each run is annotated, so
+    it shows up in profiler traces."""
+    jax.block_until_ready(fn(*args))
+    times = []
+    for _ in range(num_iters):
+        with jax.profiler.TraceAnnotation(name):
+            start = time.perf_counter()
+            jax.block_until_ready(fn(*args))
+            times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000
+
+
+def profile_fn(fn: Callable, args, name: str, num_iters: int) -> dict[str, float]:
+    compiled = jax.jit(fn).lower(*args).compile()
+    return {**cost_analysis(compiled), 'ms': time_compiled(compiled, args, name, num_iters)}
+
+
+def split_arrays(tree) -> tuple[list[jax.Array], Callable]:
+    """The arrays in tree, and a function that puts new arrays back in their place. The other leaves
+    are kept as they are, so the function can be traced with only the arrays as inputs."""
+    leaves, treedef = jax.tree.flatten(tree)
+    is_array = [isinstance(x, (jax.Array, np.ndarray)) for x in leaves]
+    arrays = [x for x, a in zip(leaves, is_array) if a]
+
+    def rebuild(new_arrays):
+        new_arrays = iter(new_arrays)
+        return treedef.unflatten([next(new_arrays) if a else x for x, a in zip(leaves, is_array)])
+
+    return arrays, rebuild
+
+
+def sum_outputs(out) -> jax.Array:
+    return sum(
+        jnp.sum(x.astype(jnp.float32))
+        for x in jax.tree.leaves(out)
+        if jnp.issubdtype(x.dtype, jnp.floating)
+    )
+
+
+def block_calls(mod: nn.Module, variables, args, kwargs, max_depth: int) -> dict:
+    """Runs mod eagerly, recording the module, variables, and inputs of every submodule called
+    within max_depth levels of mod, by path."""
+    calls = {}
+
+    def record(next_fun, call_args, call_kwargs, context):
+        module = context.module
+        path = module.scope.path if module.scope is not None else ()
+        if (
+            context.method_name == '__call__'
+            and 0 < len(path) <= max_depth
+            and '/'.join(path) not in calls
+        ):
+            # the variables of modules defined in setup() are only partly bound at this point,
+            # so take them from the full tree
+            block_vars = {}
+            for col, tree in variables.items():
+                for key in path:
+                    tree = tree.get(key, {})
+                if tree:
+                    block_vars[col] = tree
+            unbound, _ = module.unbind()
+            calls['/'.join(path)] = (unbound, block_vars, call_args, call_kwargs)
+        return next_fun(*call_args, **call_kwargs)
+
+    with jax.disable_jit(), nn.intercept_methods(record):
+        mod.apply(variables, *args, **kwargs)
+    return calls
+
+
+def block_functions(unbound: nn.Module, variables, args, kwargs) -> dict[str, tuple]:
+    """Functions that run the forward pass of the block and its forward and backward passes, by
+    name, each with its arguments. Only the arrays in args and kwargs are arguments: the rest are
+    fixed. The backward pass differentiates the sum of the outputs with respect to the parameters
+    and the floating-point inputs."""
+    arrays, rebuild = split_arrays((args, kwargs))
+    floats = [jnp.issubdtype(x.dtype, jnp.floating) for x in arrays]
+
+    def forward(variables, arrays):
+        call_args, call_kwargs = rebuild(arrays)
+        return unbound.apply(variables, *call_args, **call_kwargs)
+
+    def forward_backward(variables, float_arrays, other_arrays):
+        def loss(variables, float_arrays):
+            float_iter, other_iter = iter(float_arrays), iter(other_arrays)
+            arrays = [next(float_iter) if f else next(other_iter) for f in floats]
+            return sum_outputs(forward(variables, arrays))
+
+        return jax.grad(loss, argnums=(0, 1))(variables, float_arrays)
+
+    float_arrays = [x for x, f in zip(arrays, floats) if f]
+    other_arrays = [x for x, f in zip(arrays, floats) if not f]
+    return {
+        'forward': (forward, (variables, arrays)),
+        'backward': (forward_backward, (variables, float_arrays, other_arrays)),
+    }
+
+
+def profile_block(
+    unbound: nn.Module, variables, args, kwargs, name: str, num_iters: int
+) -> dict:
+    passes = block_functions(unbound, variables, args, kwargs)
+    return {
+        'type': type(unbound).__name__,
+        'params': int(sum(x.size for x in jax.tree.leaves(variables.get('params', {})))),
+        **{
+            pass_name: profile_fn(fn, fn_args, f'{name}/{pass_name}', num_iters)
+            for pass_name, (fn, fn_args) in passes.items()
+        },
+    }
+
+
+def profile_model(
+    config: MainConfig,
+    cg: CrystalGraphs,
+    params=None,
+    num_iters: int = 10,
+    max_depth: int = 3,
+    trace_dir: Optional[Path] = None,
+) -> dict:
+    """Profiles the model in config on the batch cg, initializing the parameters if not given.
+    Returns the report, which is JSON-serializable."""
+    mod = config.build_regressor()
+    ctx = Context(training=False)
+    cg = jax.tree.map(jnp.asarray, cg)
+    if params is None:
+        params = mod.init(jax.random.key(0), cg, ctx=ctx)
+    # forces and stress, as in inference, whatever the loss uses
+    efs = EFSWrapper(grad_mode=config.train.loss.grad_mode)
+
+    # only the full model is traced: the blocks show up in it by their named scopes
+    flax.config.update('flax_profile', True)
+    trace = jax.profiler.trace(str(trace_dir)) if trace_dir is not None else nullcontext()
+    with trace:
+        total = {
+            'forward': profile_fn(
+                lambda p, cg: mod.apply(p, cg, ctx=ctx), (params, cg), 'model/forward', num_iters
+            ),
+            'efs': profile_fn(
+                lambda p, cg: efs(mod.apply, p, cg, ctx=ctx), (params, cg), 'model/efs', num_iters
+            ),
+        }
+
+    blocks = {}
+    calls = block_calls(mod, params, (cg,), {'ctx': ctx}, max_depth)
+    for name, (unbound, variables, args, kwargs) in calls.items():
+        logging.info('Profiling %s', name)
+        try:
+            blocks[name] = profile_block(unbound, variables, args, kwargs, name, num_iters)
+        except errors.ScopeParamNotFoundError:
+            # modules that use submodules owned by their parent, like MACE with the embeddings,
+            # can't run on their own: their children are profiled instead
+            logging.info('Skipping %s, which uses parameters outside its scope', name)
+
+    return {
+        'version': REPORT_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'backend': jax.default_backend(),
+        'device': jax.devices()[0].device_kind,
+        'model': pyrallis.encode(config.model),
+        'batch': {
+            'nodes': cg.n_total_nodes,
+            'graphs': cg.n_total_graphs,
+            'k': int(cg.receivers.shape[-1]),
+            'real_nodes': int(jnp.sum(cg.n_node * cg.padding_mask)),
+        },
+        'total': total,
+        'blocks': blocks,
+    }
+
+
+def format_cost(cost: dict, key: str) -> str:
+    _unit, scale = COST_UNITS[key]
+    return f'{cost[key] / scale:.3f}'
+
+
+def report_table(report: dict) -> Table:
+    batch = report['batch']
+    table = Table(
+        title=f'{report["device"]}: {batch["nodes"]} nodes, {batch["graphs"]} graphs, '
+        f'k = {batch["k"]}',
+        box=box.SIMPLE,
+    )
+    table.add_column('Block')
+    table.add_column('Type')
+    table.add_column('Params', justify='right')
+    for pass_name in ('forward', 'backward'):
+        for key, (unit, _scale) in COST_UNITS.items():
+            table.add_column(f'{pass_name} {unit}', justify='right')
+    table.add_column('% forward', justify='right')
+
+    total_ms = report['total']['forward']['ms']
+    for name, cost in report['total'].items():
+        table.add_row(
+            f'[bold]model {name}',
+            '',
+            '',
+            *[format_cost(cost, key) for key in COST_UNITS],
+            *['' for _ in COST_UNITS],
+            '',
+        )
+    for name, block in report['blocks'].items():
+        table.add_row(
+            name,
+            block['type'],
+            f'{block["params"]:,}',
+            *[format_cost(block['forward'], key) for key in COST_UNITS],
+            *[format_cost(block['backward'], key) for key in COST_UNITS],
+            f'{100 * block["forward"]["ms"] / total_ms:.1f}',
+        )
+    return table
+
+
+def diff_reports(base: dict, new: dict) -> dict:
+    """Ratios of the new costs to the base costs, by block, for blocks in both reports."""
+    diff = {'total': {}, 'blocks': {}}
+    for name, cost in new['total'].items():
+        if name in base['total']:
+            diff['total'][name] = cost_ratios(base['total'][name], cost)
+    for name, block in new['blocks'].items():
+        if name in base['blocks']:
+            diff['blocks'][name] = {
+                pass_name: cost_ratios(base['blocks'][name][pass_name], block[pass_name])
+                for pass_name in ('forward', 'backward')
+            }
+    diff['only_base'] = [name for name in base['blocks'] if name not in new['blocks']]
+    diff['only_new'] = [name for name in new['blocks'] if name not in base['blocks']]
+    return diff
+
+
+def cost_ratios(base: dict, new: dict) -> dict:
+    return {key: new[key] / base[key] if base[key] else float('nan') for key in COST_UNITS}
+
+
+def format_ratio(ratio: float) -> str:
+    if np.isnan(ratio):
+        return '-'
+    color = 'green' if ratio < 0.95 else 'red' if ratio > 1.05 else 'default'
+    return f'[{color}]{ratio:.2f}x'
+
+
+def diff_table(diff: dict) -> Table:
+    table = Table(title='Change from baseline', box=box.SIMPLE)
+    table.add_column('Block')
+    for pass_name in ('forward', 'backward'):
+        for key, (unit, _scale) in COST_UNITS.items():
+            table.add_column(f'{pass_name} {unit}', justify='right')
+
+    for name, ratios in diff['total'].items():
+        table.add_row(
+            f'[bold]model {name}',
+            *[format_ratio(ratios[key]) for key in COST_UNITS],
+            *['' for _ in COST_UNITS],
+        )
+    for name, block in diff['blocks'].items():
+        table.add_row(
+            name,
+            *[format_ratio(block['forward'][key]) for key in COST_UNITS],
+            *[format_ratio(block['backward'][key]) for key in COST_UNITS],
+        )
+    for name in diff['only_base']:
+        table.add_row(f'[dim]{name} (baseline only)')
+    for name in diff['only_new']:
+        table.add_row(f'[dim]{name} (new only)')
+    return table
+
+
+def write_report(report: dict, out: Path, baseline: Optional[dict] = None):
+    """Writes the report to out.json and out.html, with the change from the baseline report in the
+    HTML if given."""
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with open(out.with_suffix('.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    console = Console(record=True, width=240)
+    console.print(report_table(report))
+    if baseline is not None:
+        console.print(diff_table(diff_reports(baseline, report)))
+    console.save_html(str(out.with_suffix('.html')), theme=MONOKAI)
+
+
+@dataclass
+class ProfileConfig:
+    # Config of the model to profile.
+    config_file: Path = Path('configs/small.toml')
+    # Report path, without extension: writes out.json and out.html.
+    out: Path = Path('reports/profile')
+    # Previous report to compare against.
+    baseline: Optional[Path] = None
+    # Directory to write a profiler trace of the whole run to.
+    trace_dir: Optional[Path] = None
+    # Timed runs of each block.
+    num_iters: int = 10
+    # Profile submodules up to this deep: 3 reaches the blocks in each MACE layer.
+    max_depth: int = 3
+
+
+@pyrallis.wrap()
+def main(config: ProfileConfig):
+    # the data pipeline is only needed here, and is slow to import
+    from facet.data.dataset import dataloader
+
+    logging.basicConfig(level=logging.INFO)
+    with open(config.config_file) as f:
+        run = cfgparsing.load(MainConfig, f)
+
+    _steps, dl = dataloader(run, split='valid', infinite=False)
+    # a single replica of the first batch
+    cg = jax.tree.map(lambda x: x[0], next(iter(dl)))
+    report = profile_model(
+        run, cg, num_iters=config.num_iters, max_depth=config.max_depth, trace_dir=config.trace_dir
+    )
+
+    baseline = None
+    if config.baseline is not None:
+        with open(config.baseline) as f:
+            baseline = json.load(f)
+    write_report(report, config.out, baseline)
+    rich.print(report_table(report))
+    if baseline is not None:
+        rich.print(diff_table(diff_reports(baseline, report)))
+
+
+if __name__ == '__main__':
+    main()
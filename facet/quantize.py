@@ -0,0 +1,220 @@
+"""
+Weight-only quantization for inference.
+
+The e3nn Linear weights, radial MLP kernels, and SymmetricContraction weights are stored as int8 or
+fp8 with a scale per output channel, and dequantized inside the jitted model. Every one of those
+weights multiplies whole irreps, so scaling by channel keeps the model equivariant.
+
+Run with python -m facet.quantize --run_dir=logs/my_run to measure the accuracy drift against the
+fp32 EMA parameters on the validation set and the CPU throughput of both.
+"""
+
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Literal
+
+import jax
+import jax.numpy as jnp
+import pyrallis
+import rich
+from flax import struct
+from flax.traverse_util import flatten_dict, unflatten_dict
+
+from facet.checkpointing import best_ckpt, ckpt_params, run_config
+from facet.config.common import dataclass
+from facet.data.databatch import CrystalGraphs
+from facet.layers import Context
+from facet.regression import EFSWrapper
+from facet.validation import PARAM_SETS, Validator, stack_params
+
+QuantDtype = Literal['int8', 'fp8']
+
+# largest representable magnitude of each quantized type
+QUANT_MAX = {'int8': 127.0, 'fp8': 448.0}
+QUANT_DTYPES = {'int8': jnp.int8, 'fp8': jnp.float8_e4m3fn}
+
+# parameters to quantize, by path: all have the output channels last
+QUANTIZED_PARAMS = {
+    # e3nn Linear: one (mul_in, mul_out) weight per pair of irreps, named like 'w[0,1] 64x0e,32x0e'
+    'linear': re.compile(r'/w\[\d+,\d+\] [^/]*$'),
+    # radial and other MLPs: (in, out) Dense kernels
+    'mlp': re.compile(r'(LazyInMLP_\d+|mlp)/Dense_\d+/kernel$'),
+    # SymmetricContraction: (num_rbf, mul, features) weights, named like 'w2_1e'
+    'contraction': re.compile(r'/w\d+_\d+[eo]$'),
+}
+
+
+class QuantizedArray(struct.PyTreeNode):
+    """Array stored as quantized values times a scale per channel of the last axis."""
+
+    values: jax.Array
+    scale: jax.Array
+    dtype: str = struct.field(pytree_node=False)
+
+    def dequantize(self) -> jax.Array:
+        return (self.values.astype(jnp.float32) * self.scale).astype(self.dtype)
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.scale.nbytes
+
+
+def quantize_array(x: jax.Array, dtype: QuantDtype) -> QuantizedArray:
+    """Quantizes x with a scale per channel of the last axis, chosen so the largest value in each
+    channel maps to the largest quantized value."""
+    x32 = jnp.asarray(x, dtype=jnp.float32)
+    amax = jnp.max(jnp.abs(x32), axis=tuple(range(x.ndim - 1)), keepdims=True)
+    scale = jnp.where(amax > 0, amax / QUANT_MAX[dtype], 1.0)
+    scaled = x32 / scale
+    if dtype == 'int8':
+        scaled = jnp.round(scaled)
+    values = jnp.clip(scaled, -QUANT_MAX[dtype], QUANT_MAX[dtype]).astype(QUANT_DTYPES[dtype])
+    return QuantizedArray(values=values, scale=scale, dtype=str(x.dtype))
+
+
+def is_quantized(path: str) -> bool:
+    return any(pattern.search(path) for pattern in QUANTIZED_PARAMS.values())
+
+
+def quantize_params(params, dtype: QuantDtype = 'int8'):
+    """Quantizes the weights matching QUANTIZED_PARAMS. The other parameters are unchanged."""
+    flat = flatten_dict(params)
+    quantized = {}
+    for path, x in flat.items():
+        name = '/'.join(map(str, path))
+        quantized[path] = quantize_array(x, dtype) if x.ndim >= 2 and is_quantized(name) else x
+    return unflatten_dict(quantized)
+
+
+def dequantize_params(params):
+    """Full-precision parameters from quantize_params. Call inside jit, so only the quantized
+    weights are transferred and stored."""
+    return jax.tree.map(
+        lambda x: x.dequantize() if isinstance(x, QuantizedArray) else x,
+        params,
+        is_leaf=lambda x: isinstance(x, QuantizedArray),
+    )
+
+
+def params_nbytes(params) -> int:
+    return sum(
+        x.nbytes for x in jax.tree.leaves(params, is_leaf=lambda x: isinstance(x, QuantizedArray))
+    )
+
+
+def prediction_drift(
+    apply_fn: Callable, efs: EFSWrapper, params, qparams, batches: Iterable[CrystalGraphs]
+) -> dict[str, float]:
+    """Mean absolute difference between the predictions of the full-precision and quantized
+    parameters, over stacked batches: energy per atom in eV, forces in eV/Å, and stress in kbar."""
+
+    @jax.jit
+    def batch_drift(params, qparams, cg):
+        def predict(params, cg):
+            return efs(apply_fn, dequantize_params(params), cg, ctx=Context(training=False))
+
+        out = jax.vmap(predict, in_axes=(None, 0))(params, cg)
+        qout = jax.vmap(predict, in_axes=(None, 0))(qparams, cg)
+        graph_mask = cg.padding_mask
+        node_mask = jax.vmap(lambda m, i: m[i])(graph_mask, cg.nodes.graph_i)
+        sums = {
+            'energy': jnp.sum(jnp.abs(out.energy - qout.energy)[..., 0] * graph_mask),
+            'force': jnp.sum(jnp.abs(out.force - qout.force) * node_mask[..., None]) / 3,
+        }
+        if out.stress is not None:
+            stress_diff = jnp.mean(jnp.abs(out.stress - qout.stress), axis=(-2, -1))
+            sums['stress'] = jnp.sum(stress_diff * graph_mask)
+        counts = {'graphs': jnp.sum(graph_mask), 'nodes': jnp.sum(node_mask)}
+        return sums, counts
+
+    totals = None
+    for cg in batches:
+        sums, counts = batch_drift(params, qparams, cg)
+        batch = {**sums, **counts}
+        totals = batch if totals is None else jax.tree.map(jnp.add, totals, batch)
+    totals = jax.device_get(totals)
+    drift = {
+        'energy_mae': totals['energy'] / totals['graphs'],
+        'force_mae': totals['force'] / totals['nodes'],
+    }
+    if 'stress' in totals:
+        drift['stress_mae'] = totals['stress'] / totals['graphs']
+    return {k: float(v) for k, v in drift.items()}
+
+
+def throughput(
+    apply_fn: Callable, efs: EFSWrapper, params, cg: CrystalGraphs, num_iters: int = 20
+) -> float:
+    """Structures per second on a single batch of cg, after compilation."""
+
+    @jax.jit
+    def predict(params, cg):
+        return efs(apply_fn, dequantize_params(params), cg, ctx=Context(training=False))
+
+    jax.block_until_ready(predict(params, cg))
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        out = predict(params, cg)
+    jax.block_until_ready(out)
+    return num_iters * int(jnp.sum(cg.padding_mask)) / (time.perf_counter() - start)
+
+
+@dataclass
+class QuantizeConfig:
+    # Training run to evaluate the best checkpoint of.
+    run_dir: Path = Path('logs/')
+    dtype: str = 'int8'
+    # Number of validation batches to measure the drift on. 0 means the whole validation set.
+    num_batches: int = 0
+    # Iterations of the throughput benchmark.
+    num_iters: int = 20
+
+
+@pyrallis.wrap()
+def main(config: QuantizeConfig):
+    # the data pipeline is only needed here, and is slow to import
+    from facet.data.dataset import dataloader
+
+    logging.basicConfig(level=logging.INFO)
+    jax.config.update('jax_platform_name', 'cpu')
+
+    run = run_config(config.run_dir)
+    params = ckpt_params(best_ckpt(config.run_dir), use_ema=True)
+    qparams = quantize_params(params, config.dtype)
+    apply_fn = run.build_regressor().apply
+    efs = EFSWrapper(grad_mode=run.train.loss.grad_mode)
+
+    steps, valid_dl = dataloader(run, split='valid', infinite=False)
+    if config.num_batches > 0:
+        steps = min(steps, config.num_batches)
+    batches = [cg for _, cg in zip(range(steps), valid_dl)]
+
+    drift = prediction_drift(apply_fn, efs, params, qparams, batches)
+    validator = Validator(run.train.loss, iter(batches), len(batches))
+    losses = validator.evaluate(
+        apply_fn, stack_params(params, dequantize_params(qparams)), jax.random.key(0)
+    )
+    full_losses, quant_losses = (losses[split] for split in PARAM_SETS)
+
+    # a single replica of the first batch
+    cg = jax.tree.map(lambda x: x[0], batches[0])
+    rich.print(
+        {
+            'dtype': config.dtype,
+            'param_mb': params_nbytes(params) / 1e6,
+            'quantized_param_mb': params_nbytes(qparams) / 1e6,
+            'drift': drift,
+            'valid_fp32': full_losses,
+            f'valid_{config.dtype}': quant_losses,
+            'fp32_structures_per_s': throughput(apply_fn, efs, params, cg, config.num_iters),
+            f'{config.dtype}_structures_per_s': throughput(
+                apply_fn, efs, qparams, cg, config.num_iters
+            ),
+        }
+    )
+
+
+if __name__ == '__main__':
+    main()
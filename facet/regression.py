@@ -1,32 +1,75 @@
 """Loss function for formation energy/force/stress regression."""
 
-from typing import Callable
+from typing import Callable, Optional
 import jax
 import jax.numpy as jnp
 
 from flax import linen as nn
+from flax import struct
 from flax.struct import PyTreeNode
 
 from facet.data.databatch import CrystalGraphs
-from facet.layers import Context
+from facet.layers import Context, edge_vecs
+from facet.stress import apply_strain, strain_grad_to_stress, to_voigt, virial
 from jaxtyping import Float, Array
 
 
 class EFSOutput(PyTreeNode):
     energy: Float[Array, ' graphs 1']
-    force: Float[Array, ' nodes 3']
-    stress: Float[Array, ' graphs 3 3']
+    # None if not computed
+    force: Optional[Float[Array, ' nodes 3']] = None
+    stress: Optional[Float[Array, ' graphs 3 3']] = None
 
     def rotate(self, rots, cg) -> 'EFSOutput':
         return EFSOutput(
             energy=self.energy,  # scalar
-            force=jnp.einsum('ij,ijk->ik', self.force, rots[cg.nodes.graph_i]),
-            stress=jnp.einsum('ijk,ikl->ijl', self.stress, rots),
+            force=None
+            if self.force is None
+            else jnp.einsum('ij,ijk->ik', self.force, rots[cg.nodes.graph_i]),
+            stress=None
+            if self.stress is None
+            else jnp.einsum('bji,bjk,bkl->bil', rots, self.stress, rots),
         )
 
+    @property
+    def stress_voigt(self) -> Optional[Float[Array, ' graphs 6']]:
+        return None if self.stress is None else to_voigt(self.stress)
+
+
+def edge_grads_to_cart_lat(
+    cg: CrystalGraphs, edge_grad: Float[Array, 'nodes k 3']
+) -> tuple[Float[Array, 'nodes 3'], Float[Array, 'graphs 3 3']]:
+    """Converts the gradient with respect to the edge vectors into gradients with respect to the
+    Cartesian coordinates and the lattice.
+
+    Each edge vector is cart[receiver] + to_jimage @ lat[graph_i] - cart[sender], so this is the
+    transpose of edge_vecs: the receivers and senders get the gradient with opposite signs, and the
+    lattice gets the gradient weighted by the image offsets."""
+    recv_grad = jax.ops.segment_sum(
+        edge_grad.reshape(-1, 3), cg.receivers.reshape(-1), num_segments=cg.n_total_nodes
+    )
+    cart_grad = recv_grad - edge_grad.sum(axis=1)
+    lat_grad = jax.ops.segment_sum(
+        jnp.einsum('nka,nkx->nax', cg.edges.to_jimage.astype(edge_grad.dtype), edge_grad),
+        cg.nodes.graph_i,
+        num_segments=cg.n_total_graphs,
+    )
+    return cart_grad, lat_grad
+
 
 class EFSWrapper(PyTreeNode):
-    compute_fs: bool = True
+    # Which gradient outputs to compute. Anything not computed is None in the output, and if
+    # neither is computed the model is only evaluated once, without any gradient.
+    compute_force: bool = struct.field(pytree_node=False, default=True)
+    compute_stress: bool = struct.field(pytree_node=False, default=True)
+
+    # What to differentiate the energy with respect to to get forces and stress:
+    # - 'positions' differentiates with respect to the coordinates and a symmetric strain applied
+    #   to the whole cell.
+    # - 'edges' differentiates once with respect to the edge vectors and assembles the forces and
+    #   the virial from that. The results are the same. On CPU it's no faster than 'positions'.
+    # Stress is in kbar, with the sign convention of the targets: see facet.stress.
+    grad_mode: str = struct.field(pytree_node=False, default='positions')
 
     def __call__(
         self, apply_fn: Callable, variables, cg: CrystalGraphs, *args, **kwargs
@@ -34,70 +77,81 @@ class EFSWrapper(PyTreeNode):
         """Evaluates the model with the variables on the graph, calculating the forces and stress
         from the gradient."""
 
-        def energy_fn(cart, lat):
-            energy = apply_fn(
-                variables,
-                cg.replace(
-                    nodes=cg.nodes.replace(cart=cart), graph_data=cg.graph_data.replace(lat=lat)
-                ),
-                *args,
-                **kwargs,
+        def total_energy(energy, cg):
+            # the model predicts the energy per atom, but forces and stress are derivatives of the
+            # total energy
+            return jnp.sum(energy[..., 0] * cg.n_node, where=cg.padding_mask)
+
+        def edge_energy_fn(vecs):
+            energy = apply_fn(variables, cg, *args, vecs=vecs, **kwargs)
+            return total_energy(energy, cg), energy
+
+        def energy_fn(cart, strain):
+            if strain is None:
+                lat = cg.graph_data.lat
+            else:
+                cart, lat = apply_strain(cart, cg.graph_data.lat, cg.nodes.graph_i, strain)
+            strained = cg.replace(
+                nodes=cg.nodes.replace(cart=cart), graph_data=cg.graph_data.replace(lat=lat)
             )
-            return jnp.sum(energy, where=cg.padding_mask), energy
-
-        if self.compute_fs:
+            energy = apply_fn(variables, strained, *args, **kwargs)
+            return total_energy(energy, strained), energy
+
+        if not (self.compute_force or self.compute_stress):
+            return EFSOutput(energy=apply_fn(variables, cg, *args, **kwargs))
+        elif self.grad_mode == 'edges':
+            vecs = edge_vecs(cg)
+            edge_grad, energy = jax.grad(edge_energy_fn, has_aux=True)(vecs)
+            fgrad = edge_grads_to_cart_lat(cg, edge_grad)[0] if self.compute_force else None
+            sgrad = virial(cg, vecs, edge_grad) if self.compute_stress else None
+        elif self.grad_mode == 'positions':
+            # None is an empty pytree, so it gets a None gradient
+            strain = jnp.zeros_like(cg.graph_data.lat) if self.compute_stress else None
             (fgrad, sgrad), energy = jax.grad(energy_fn, argnums=(0, 1), has_aux=True)(
-                cg.nodes.cart, cg.graph_data.lat
+                cg.nodes.cart, strain
             )
         else:
-            energy_sum, energy = energy_fn(cg.nodes.cart, cg.graph_data.lat)
-            fgrad = cg.nodes.cart * 0
-            sgrad = cg.graph_data.lat * 0
+            raise ValueError(f'Unknown gradient mode {self.grad_mode}')
 
-        # https://github.com/MDIL-SNU/SevenNet/blob/afb56e10b6a27190f7c3ce25cbf666cf9175608e/sevenn/nn/force_output.py#L72
-        # https://github.com/ACEsuit/mace/blob/575af0171369e2c19e04b115140b9901f83eb00c/mace/modules/utils.py#L60
-        force = -fgrad
-
-        volume = jax.vmap(
-            jnp.linalg.det,
-        )(cg.graph_data.lat.reshape(-1, 3, 3)).reshape(*cg.graph_data.lat.shape[:-2], 1, 1)
-
-        stress = jnp.where(
-            volume == 0, -sgrad, -sgrad / jnp.where(volume == 0, jnp.ones_like(volume), volume)
+        # same signs as SevenNet (sevenn/nn/force_output.py#L72 at afb56e10) and MACE
+        # (mace/modules/utils.py#L60 at 575af017)
+        force = -fgrad if self.compute_force else None
+        stress = (
+            strain_grad_to_stress(sgrad, cg.graph_data.inv_volume) if self.compute_stress else None
         )
-        stress = sgrad * 0.1  # convert to GPa?
 
         return EFSOutput(energy=energy, force=force, stress=stress)
 
 
 class EFSLoss(PyTreeNode):
-    """Calculates loss for the energy/force/stress."""
+    """Calculates loss for the energy/force/stress. Terms with zero weight are left out of the
+    output, and their predictions aren't needed."""
 
-    loss_fn: Callable
-    energy_weight: float
-    force_weight: float
-    stress_weight: float
+    loss_fn: Callable = struct.field(pytree_node=False)
+    energy_weight: float = struct.field(pytree_node=False)
+    force_weight: float = struct.field(pytree_node=False)
+    stress_weight: float = struct.field(pytree_node=False)
 
     def __call__(self, cg: CrystalGraphs, pred: EFSOutput):
-        # https://github.com/MDIL-SNU/SevenNet/blob/afb56e10b6a27190f7c3ce25cbf666cf9175608e/sevenn/nn/force_output.py#L82
-        voigt_i = jnp.array([0, 1, 2, 0, 1, 0])
-        voigt_j = jnp.array([0, 1, 2, 1, 2, 2])
-        loss = {
-            'energy': self.loss_fn(pred.energy[..., 0], cg.e_form, cg.padding_mask),
-            'force': self.loss_fn(
+        # as in SevenNet: sevenn/nn/force_output.py#L82 at afb56e10
+        loss = {}
+        weights = {}
+        if self.energy_weight != 0:
+            loss['energy'] = self.loss_fn(pred.energy[..., 0], cg.e_form, cg.padding_mask)
+            weights['energy'] = self.energy_weight
+        if self.force_weight != 0:
+            loss['force'] = self.loss_fn(
                 pred.force, cg.target_data.force, cg.padding_mask[cg.nodes.graph_i]
-            ),
-            'stress': self.loss_fn(
-                pred.stress[..., voigt_i, voigt_j],
-                cg.target_data.stress[..., voigt_i, voigt_j],
+            )
+            weights['force'] = self.force_weight
+        if self.stress_weight != 0:
+            loss['stress'] = self.loss_fn(
+                pred.stress_voigt,
+                to_voigt(cg.target_data.stress),
                 cg.padding_mask,
-            ),
-        }
+            )
+            weights['stress'] = self.stress_weight
 
-        loss['loss'] = (
-            self.energy_weight * loss['energy']
-            + self.force_weight * loss['force']
-            + self.stress_weight * loss['stress']
-        )
+        loss['loss'] = sum((weights[k] * loss[k] for k in weights), start=jnp.zeros(()))
 
         return loss
@@ -0,0 +1,323 @@
+"""
+Batched structure relaxation on device.
+
+Relaxes many structures at once with FIRE, inside a single jax.lax.while_loop. Every structure has
+its own FIRE state and convergence check: structures that have converged stop moving while the rest
+continue, and the loop ends once they've all converged. The cell can be relaxed too, using the
+stress from EFSWrapper, with the same generalized coordinates as ASE's UnitCellFilter: the atoms are
+positioned relative to a deformation of the starting cell, and the deformation, scaled by the number
+of atoms, is relaxed alongside them.
+
+The input is a stacked CrystalGraphs, like the training data: every array in RelaxState has a
+leading replica axis, and each replica is a padded batch of structures. Neighbor lists are kept up
+to date on device using facet.data.neighbors.NeighborCandidates. Units are Å, eV, and GPa.
+"""
+
+import functools as ft
+from typing import Callable
+
+import jax
+import jax.numpy as jnp
+from flax import struct
+from jaxtyping import Array, Bool, Float, Int
+
+from facet.data.databatch import CrystalGraphs
+from facet.data.neighbors import (
+    NeighborCandidates,
+    num_images,
+    per_graph,
+    rebuild_candidates,
+    refresh_candidates,
+)
+from facet.layers import Context
+from facet.regression import EFSWrapper
+from facet.stress import EV_PER_A3_TO_GPA, STRESS_SCALE, cell_volume, inverse_volume
+
+
+class RelaxState(struct.PyTreeNode):
+    """State of a batch of relaxations. Every array has a leading replica axis."""
+
+    cg: CrystalGraphs
+    # atom positions in the undeformed cell, so the current positions are ref_cart @ deform
+    ref_cart: Float[Array, 'replicas nodes 3']
+    ref_lat: Float[Array, 'replicas graphs 3 3']
+    deform: Float[Array, 'replicas graphs 3 3']
+    # generalized forces and FIRE velocities for the atoms and the cell
+    force: Float[Array, 'replicas nodes 3']
+    cell_force: Float[Array, 'replicas graphs 3 3']
+    velocity: Float[Array, 'replicas nodes 3']
+    cell_velocity: Float[Array, 'replicas graphs 3 3']
+    # FIRE parameters per structure
+    dt: Float[Array, 'replicas graphs']
+    alpha: Float[Array, 'replicas graphs']
+    num_positive: Int[Array, 'replicas graphs']
+    # total energy, or enthalpy if there's an external pressure
+    energy: Float[Array, 'replicas graphs']
+    # largest force on an atom or the cell
+    fmax: Float[Array, 'replicas graphs']
+    converged: Bool[Array, 'replicas graphs']
+    # number of steps each structure took to converge
+    num_steps: Int[Array, 'replicas graphs']
+    cands: NeighborCandidates
+    step: Int[Array, '']
+    num_rebuilds: Int[Array, '']
+    # False if a candidate list was ever built without enough margin
+    neighbors_ok: Bool[Array, '']
+
+
+class FIRERelaxer(struct.PyTreeNode):
+    """Settings for a relaxation. All fields are static. The FIRE defaults follow ASE."""
+
+    # converged when no force on an atom or the cell is larger than this, eV/Å. If the cell is
+    # relaxed, the forces on the atoms are the generalized ones, as in ASE's UnitCellFilter.
+    fmax: float = struct.field(pytree_node=False, default=0.05)
+    max_steps: int = struct.field(pytree_node=False, default=500)
+    relax_cell: bool = struct.field(pytree_node=False, default=False)
+    # external pressure, GPa
+    pressure: float = struct.field(pytree_node=False, default=0.0)
+
+    dt_start: float = struct.field(pytree_node=False, default=0.1)
+    dt_max: float = struct.field(pytree_node=False, default=1.0)
+    # largest distance a structure's coordinates can move in one step, Å
+    max_move: float = struct.field(pytree_node=False, default=0.2)
+    n_min: int = struct.field(pytree_node=False, default=5)
+    f_inc: float = struct.field(pytree_node=False, default=1.1)
+    f_dec: float = struct.field(pytree_node=False, default=0.5)
+    alpha_start: float = struct.field(pytree_node=False, default=0.1)
+    f_alpha: float = struct.field(pytree_node=False, default=0.99)
+
+    # number of edges per atom: should match the data the model was trained on
+    k: int = struct.field(pytree_node=False, default=16)
+    num_candidates: int = struct.field(pytree_node=False, default=32)
+    # lattice translations checked along each axis when rebuilding the neighbor list
+    n_images: int = struct.field(pytree_node=False, default=1)
+    grad_mode: str = struct.field(pytree_node=False, default='positions')
+
+    @property
+    def efs(self) -> EFSWrapper:
+        return EFSWrapper(
+            compute_force=True, compute_stress=self.relax_cell, grad_mode=self.grad_mode
+        )
+
+    def with_images_for(self, cg: CrystalGraphs) -> 'FIRERelaxer':
+        """Sets n_images from the structures in cg, a single replica. Runs on the host. If the cell
+        is relaxed, leaves some extra room for it to shrink."""
+        n_images = num_images(cg, self.num_candidates)
+        return self.replace(n_images=n_images + 1 if self.relax_cell else n_images)
+
+    def rebuild(self, cg: CrystalGraphs) -> tuple[CrystalGraphs, NeighborCandidates]:
+        """Wraps the atoms back into the cell and rebuilds the candidate list, for one replica."""
+        return rebuild_candidates(cg, self.k, self.num_candidates, self.n_images)
+
+    def forces(self, apply_fn: Callable, params, cg: CrystalGraphs, deform):
+        """Energy and generalized forces for one replica."""
+        out = self.efs(apply_fn, params, cg, ctx=Context(training=False))
+        energy = out.energy[..., 0] * cg.n_node
+        real = cg.padding_mask[cg.nodes.graph_i]
+        # -dE/du = f F^T, for positions u in the undeformed cell
+        force = jnp.einsum('nj,nij->ni', out.force, deform[cg.nodes.graph_i])
+        force = jnp.where(real[:, None], force, 0)
+        # converged on the generalized forces, like ASE
+        fmax = jax.ops.segment_max(
+            jnp.where(real, jnp.linalg.norm(force, axis=-1), 0),
+            cg.nodes.graph_i,
+            num_segments=cg.n_total_graphs,
+        )
+
+        if self.relax_cell:
+            volume = cg.graph_data.volume
+            # dH/dε, with the enthalpy H = E + pV
+            strain_grad = out.stress / STRESS_SCALE * volume[:, None, None]
+            strain_grad = strain_grad + (
+                self.pressure / EV_PER_A3_TO_GPA * volume[:, None, None] * jnp.eye(3)
+            )
+            energy = energy + self.pressure / EV_PER_A3_TO_GPA * volume
+            # the cell coordinate is n_atoms F, so its force is -F^-T dH/dε / n_atoms
+            cell_factor = jnp.maximum(cg.n_node, 1)[:, None, None].astype(strain_grad.dtype)
+            safe_deform = jnp.where(cg.padding_mask[:, None, None], deform, jnp.eye(3))
+            cell_force = -jnp.linalg.solve(
+                jnp.swapaxes(safe_deform, -1, -2), strain_grad / cell_factor
+            )
+            cell_force = jnp.where(cg.padding_mask[:, None, None], cell_force, 0)
+            fmax = jnp.maximum(fmax, jnp.max(jnp.linalg.norm(cell_force, axis=-2), axis=-1))
+        else:
+            cell_force = jnp.zeros_like(deform)
+
+        return energy, force, cell_force, fmax
+
+    def init(self, apply_fn: Callable, params, cg: CrystalGraphs) -> RelaxState:
+        """Sets up the relaxation of stacked graphs."""
+        cg, cands = jax.vmap(self.rebuild)(cg)
+        deform = jnp.broadcast_to(jnp.eye(3, dtype=cg.nodes.cart.dtype), cg.graph_data.lat.shape)
+        energy, force, cell_force, fmax = jax.vmap(ft.partial(self.forces, apply_fn, params))(
+            cg, deform
+        )
+        graph_zeros = jnp.zeros(cg.padding_mask.shape, dtype=cg.nodes.cart.dtype)
+        return RelaxState(
+            cg=cg,
+            ref_cart=cg.nodes.cart,
+            ref_lat=cg.graph_data.lat,
+            deform=deform,
+            force=force,
+            cell_force=cell_force,
+            velocity=jnp.zeros_like(force),
+            cell_velocity=jnp.zeros_like(cell_force),
+            dt=graph_zeros + self.dt_start,
+            alpha=graph_zeros + self.alpha_start,
+            num_positive=jnp.zeros(cg.padding_mask.shape, dtype=jnp.int32),
+            energy=energy,
+            fmax=fmax,
+            converged=(fmax < self.fmax) | ~cg.padding_mask,
+            num_steps=jnp.zeros(cg.padding_mask.shape, dtype=jnp.int32),
+            cands=cands,
+            step=jnp.zeros((), dtype=jnp.int32),
+            num_rebuilds=jnp.zeros((), dtype=jnp.int32),
+            neighbors_ok=jnp.all(cands.ok),
+        )
+
+    def fire_update(
+        self,
+        cg: CrystalGraphs,
+        ref_cart: Float[Array, 'nodes 3'],
+        deform: Float[Array, 'graphs 3 3'],
+        force: Float[Array, 'nodes 3'],
+        cell_force: Float[Array, 'graphs 3 3'],
+        velocity: Float[Array, 'nodes 3'],
+        cell_velocity: Float[Array, 'graphs 3 3'],
+        dt: Float[Array, ' graphs'],
+        alpha: Float[Array, ' graphs'],
+        num_positive: Int[Array, ' graphs'],
+        active: Bool[Array, ' graphs'],
+    ):
+        """One FIRE step for a single replica, following ASE. The structures that aren't active
+        keep their coordinates and FIRE state."""
+        graph_i = cg.nodes.graph_i
+        # the cell coordinate is n_atoms F
+        cell_scale = jnp.maximum(cg.n_node, 1)[:, None, None].astype(deform.dtype)
+
+        def nodes(x):
+            return x[graph_i][:, None]
+
+        def cells(x):
+            return x[:, None, None]
+
+        def graph_dot(a, b, cell_a, cell_b):
+            return per_graph(jnp.sum(a * b, axis=-1), cg) + jnp.sum(cell_a * cell_b, axis=(-2, -1))
+
+        vf = graph_dot(velocity, force, cell_velocity, cell_force)
+        v_norm = jnp.sqrt(graph_dot(velocity, velocity, cell_velocity, cell_velocity))
+        f_norm = jnp.sqrt(graph_dot(force, force, cell_force, cell_force))
+        mix = alpha * v_norm / jnp.maximum(f_norm, 1e-12)
+
+        # mix the velocity towards the force while going downhill, and stop when going uphill
+        positive = vf > 0
+        v = jnp.where(nodes(positive), nodes(1 - alpha) * velocity + nodes(mix) * force, 0)
+        cell_v = jnp.where(
+            cells(positive), cells(1 - alpha) * cell_velocity + cells(mix) * cell_force, 0
+        )
+        speed_up = positive & (num_positive > self.n_min)
+        new_dt = jnp.where(
+            positive,
+            jnp.where(speed_up, jnp.minimum(dt * self.f_inc, self.dt_max), dt),
+            dt * self.f_dec,
+        )
+        new_alpha = jnp.where(
+            positive, jnp.where(speed_up, alpha * self.f_alpha, alpha), self.alpha_start
+        )
+        new_num_positive = jnp.where(positive, num_positive + 1, 0)
+        # the first step just starts moving along the force
+        start = v_norm == 0
+        new_dt = jnp.where(start, dt, new_dt)
+        new_alpha = jnp.where(start, alpha, new_alpha)
+        new_num_positive = jnp.where(start, num_positive, new_num_positive)
+
+        v = v + nodes(new_dt) * force
+        cell_v = cell_v + cells(new_dt) * cell_force
+        dr = nodes(new_dt) * v
+        cell_dr = cells(new_dt) * cell_v
+        dr_norm = jnp.sqrt(graph_dot(dr, dr, cell_dr, cell_dr))
+        scale = jnp.where(dr_norm > self.max_move, self.max_move / jnp.maximum(dr_norm, 1e-12), 1)
+
+        return (
+            jnp.where(nodes(active), ref_cart + dr * nodes(scale), ref_cart),
+            jnp.where(cells(active), deform + cell_dr * cells(scale) / cell_scale, deform),
+            jnp.where(nodes(active), v, 0),
+            jnp.where(cells(active), cell_v, 0),
+            jnp.where(active, new_dt, dt),
+            jnp.where(active, new_alpha, alpha),
+            jnp.where(active, new_num_positive, num_positive),
+        )
+
+    def step(self, apply_fn: Callable, params, state: RelaxState) -> RelaxState:
+        """One step for every replica."""
+        active = ~state.converged
+        ref_cart, deform, velocity, cell_velocity, dt, alpha, num_positive = jax.vmap(
+            self.fire_update
+        )(
+            state.cg,
+            state.ref_cart,
+            state.deform,
+            state.force,
+            state.cell_force,
+            state.velocity,
+            state.cell_velocity,
+            state.dt,
+            state.alpha,
+            state.num_positive,
+            active,
+        )
+
+        cg = state.cg
+        deform_nodes = jax.vmap(lambda d, graph_i: d[graph_i])(deform, cg.nodes.graph_i)
+        lat = jnp.einsum('rgij,rgjk->rgik', state.ref_lat, deform)
+        volume = cell_volume(lat)
+        cg = cg.replace(
+            nodes=cg.nodes.replace(cart=jnp.einsum('rni,rnij->rnj', ref_cart, deform_nodes)),
+            graph_data=cg.graph_data.replace(
+                lat=lat, volume=volume, inv_volume=inverse_volume(volume)
+            ),
+        )
+
+        cg, cands, needs_rebuild = refresh_candidates(
+            state.cands, cg, self.k, self.num_candidates, self.n_images
+        )
+        # a rebuild wraps the atoms back into the cell
+        ref_cart = jnp.einsum('rni,rnij->rnj', cg.nodes.cart, jnp.linalg.inv(deform_nodes))
+
+        energy, force, cell_force, fmax = jax.vmap(ft.partial(self.forces, apply_fn, params))(
+            cg, deform
+        )
+        return state.replace(
+            cg=cg,
+            ref_cart=ref_cart,
+            deform=deform,
+            force=force,
+            cell_force=cell_force,
+            velocity=velocity,
+            cell_velocity=cell_velocity,
+            dt=dt,
+            alpha=alpha,
+            num_positive=num_positive,
+            energy=jnp.where(active, energy, state.energy),
+            fmax=jnp.where(active, fmax, state.fmax),
+            converged=state.converged | (fmax < self.fmax),
+            num_steps=state.num_steps + active,
+            cands=cands,
+            step=state.step + 1,
+            num_rebuilds=state.num_rebuilds + needs_rebuild,
+            neighbors_ok=state.neighbors_ok & jnp.all(cands.ok),
+        )
+
+    @ft.partial(jax.jit, static_argnames=('self', 'apply_fn'))
+    def run(self, apply_fn: Callable, params, state: RelaxState) -> RelaxState:
+        """Steps until every structure has converged or max_steps is reached."""
+
+        def cond(state):
+            return (state.step < self.max_steps) & ~jnp.all(state.converged)
+
+        return jax.lax.while_loop(cond, ft.partial(self.step, apply_fn, params), state)
+
+    def relax(self, apply_fn: Callable, params, cg: CrystalGraphs) -> RelaxState:
+        """Relaxes stacked graphs. Check converged in the result to see which structures
+        finished."""
+        return self.run(apply_fn, params, self.init(apply_fn, params, cg))
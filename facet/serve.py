@@ -0,0 +1,338 @@
+"""
+Local inference server with dynamic batching.
+
+Structures submitted to the server are queued and packed into batches with a few static shapes, so
+only one executable per shape is ever compiled. Each request has a deadline: the scheduler waits to
+fill a batch until the earliest deadline in the queue, less the expected time to run the batch, and
+then packs the most urgent requests into the smallest shape that fits them.
+
+Run with python -m facet.serve --run_dir=logs/my_run. POST /predict takes JSON like
+{"structures": [{"numbers": [...], "positions": [...], "cell": [...]}], "deadline_ms": 50} and
+returns the energy, forces, and stress of each structure in ASE units. GET /stats reports the
+latency percentiles and throughput.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional, Sequence
+
+import jax
+import numpy as np
+import pyrallis
+from ase import Atoms
+
+from facet.calculator import FacetCalculator
+from facet.config import field
+from facet.config.common import dataclass
+from facet.data.databatch import CrystalGraphs, collate
+
+
+@dataclass
+class ServeConfig:
+    # Training run to load the best checkpoint of.
+    run_dir: Path = Path('logs/')
+    use_ema: bool = True
+
+    host: str = '127.0.0.1'
+    port: int = 8470
+
+    # Static batch shapes. A batch is padded to the smallest number of nodes and graphs that fits.
+    node_buckets: list[int] = field(default_factory=lambda: [64, 128, 256, 512, 1024])
+    graph_buckets: list[int] = field(default_factory=lambda: [8, 32])
+
+    # Deadline for requests that don't give one, in milliseconds.
+    default_deadline_ms: float = 50.0
+
+    # Compile every bucket before serving.
+    warmup: bool = True
+
+
+class Job:
+    """A single structure waiting to be evaluated."""
+
+    def __init__(self, cg: CrystalGraphs, deadline: float):
+        self.cg = cg
+        self.n_node = cg.n_total_nodes
+        self.deadline = deadline
+        self.submitted = time.monotonic()
+        self.future: Future = Future()
+
+
+class LatencyStats:
+    """Latencies and batch statistics over a recent window. Thread-safe."""
+
+    def __init__(self, window: int = 10_000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.finished = deque(maxlen=window)
+        self.node_fill = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.num_late = 0
+        self.num_done = 0
+        self.num_batches = 0
+
+    def record_batch(self, jobs: Sequence[Job], num_nodes: int):
+        now = time.monotonic()
+        with self.lock:
+            for job in jobs:
+                self.latencies.append(now - job.submitted)
+                self.finished.append(now)
+                self.num_late += now > job.deadline
+            self.node_fill.append(sum(job.n_node for job in jobs) / num_nodes)
+            self.batch_sizes.append(len(jobs))
+            self.num_done += len(jobs)
+            self.num_batches += 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            if not self.latencies:
+                return {'num_done': 0}
+            latencies = np.array(self.latencies) * 1000
+            span = self.finished[-1] - self.finished[0]
+            return {
+                'num_done': self.num_done,
+                'num_batches': self.num_batches,
+                'num_late': self.num_late,
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'mean_ms': float(np.mean(latencies)),
+                'throughput': (len(self.finished) - 1) / span if span > 0 else 0.0,
+                'mean_batch_size': float(np.mean(self.batch_sizes)),
+                'mean_node_fill': float(np.mean(self.node_fill)),
+            }
+
+
+class BatchingServer:
+    """Queues structures and evaluates them in batches on a background thread.
+
+    The scheduler runs a batch once the queue fills the largest bucket or the most urgent request
+    would otherwise miss its deadline, using a running estimate of how long each bucket takes."""
+
+    def __init__(
+        self,
+        calc: FacetCalculator,
+        node_buckets: Sequence[int] = (64, 128, 256, 512, 1024),
+        graph_buckets: Sequence[int] = (8, 32),
+        default_deadline_ms: float = 50.0,
+    ):
+        self.calc = calc
+        # batches are padded with the calculator, so it needs the same node buckets
+        self.calc.node_buckets = sorted(node_buckets)
+        self.node_buckets = sorted(node_buckets)
+        self.graph_buckets = sorted(graph_buckets)
+        self.default_deadline = default_deadline_ms / 1000
+
+        self.stats = LatencyStats()
+        # expected run time of each bucket, in seconds
+        self.run_times: dict[tuple[int, int], float] = {}
+        # buckets that have been compiled, so their run times can be measured
+        self.compiled: set[tuple[int, int]] = set()
+        self.queue: list[Job] = []
+        self.cond = threading.Condition()
+        self.running = True
+        self.worker = threading.Thread(target=self.loop, daemon=True)
+        self.worker.start()
+
+    def buckets(self) -> list[tuple[int, int]]:
+        return [(n, g) for n in self.node_buckets for g in self.graph_buckets]
+
+    def bucket(self, n_node: int, n_graph: int) -> tuple[int, int]:
+        """Smallest bucket with room for the given real nodes and graphs, plus padding."""
+        graphs = next((g for g in self.graph_buckets if n_graph < g), n_graph + 1)
+        return self.calc.bucket(n_node), graphs
+
+    def warmup(self):
+        """Compiles every bucket and measures how long it takes to run."""
+        example = self.calc.example()
+        for n_nodes, n_graphs in self.buckets():
+            cg = example.padded(n_nodes, self.calc.k, n_graphs)
+            fn = self.calc.executable(cg)
+            jax.block_until_ready(fn(self.calc.params, cg))
+            start = time.monotonic()
+            jax.block_until_ready(fn(self.calc.params, cg))
+            self.run_times[(n_nodes, n_graphs)] = time.monotonic() - start
+            self.compiled.add((n_nodes, n_graphs))
+
+    def submit(self, structure, deadline_ms: Optional[float] = None) -> Future:
+        """Queues an ASE Atoms or pymatgen Structure. The future resolves to its results."""
+        deadline = self.default_deadline if deadline_ms is None else deadline_ms / 1000
+        job = Job(self.calc.graph(structure), time.monotonic() + deadline)
+        with self.cond:
+            if self.running:
+                self.queue.append(job)
+                self.cond.notify()
+            else:
+                job.future.set_exception(RuntimeError('server shut down'))
+        return job.future
+
+    def pack(self, queue: list[Job]) -> list[Job]:
+        """The most urgent jobs, then any others that still fit in the largest bucket. A structure
+        too large for any bucket gets its own batch."""
+        max_nodes, max_graphs = self.node_buckets[-1], self.graph_buckets[-1]
+        batch, n_node = [], 0
+        for job in sorted(queue, key=lambda job: job.deadline):
+            if n_node + job.n_node < max_nodes and len(batch) + 1 < max_graphs:
+                batch.append(job)
+                n_node += job.n_node
+            elif not batch:
+                return [job]
+        return batch
+
+    def ready(self, now: float) -> tuple[bool, float]:
+        """Whether to run a batch now, and if not, how long to wait for more requests. Call with the
+        lock held."""
+        if not self.queue:
+            return False, 1.0
+        n_node = sum(job.n_node for job in self.queue)
+        if n_node + 1 >= self.node_buckets[-1] or len(self.queue) + 1 >= self.graph_buckets[-1]:
+            return True, 0.0
+        bucket = self.bucket(n_node, len(self.queue))
+        expected = self.run_times.get(bucket, max(self.run_times.values(), default=0.0))
+        start_by = min(job.deadline for job in self.queue) - expected
+        return now >= start_by, start_by - now
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    run_now, wait = self.ready(time.monotonic())
+                    if run_now:
+                        break
+                    self.cond.wait(timeout=wait)
+                if not self.running:
+                    return
+                batch = self.pack(self.queue)
+                taken = set(map(id, batch))
+                self.queue = [job for job in self.queue if id(job) not in taken]
+
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                logging.exception('Batch failed')
+                for job in batch:
+                    job.future.set_exception(e)
+
+    def run_batch(self, batch: list[Job]):
+        n_node = sum(job.n_node for job in batch)
+        n_nodes, n_graphs = self.bucket(n_node, len(batch))
+        cg = collate([job.cg for job in batch]).padded(n_nodes, self.calc.k, n_graphs)
+
+        bucket = (n_nodes, n_graphs)
+        start = time.monotonic()
+        out = jax.device_get(self.calc.executable(cg)(self.calc.params, cg))
+        elapsed = time.monotonic() - start
+        if bucket not in self.compiled:
+            # the first run includes compilation, which says nothing about later runs
+            self.compiled.add(bucket)
+        elif bucket in self.run_times:
+            self.run_times[bucket] = 0.9 * self.run_times[bucket] + 0.1 * elapsed
+        else:
+            self.run_times[bucket] = elapsed
+
+        results = self.calc.split_results(out, [job.n_node for job in batch])
+        self.stats.record_batch(batch, n_nodes)
+        for job, result in zip(batch, results):
+            job.future.set_result(result)
+
+    def shutdown(self):
+        """Stops the worker. Jobs that haven't run fail, so nothing waits on them forever."""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.worker.join()
+
+        with self.cond:
+            pending, self.queue = self.queue, []
+        for job in pending:
+            job.future.set_exception(RuntimeError('server shut down'))
+
+
+def atoms_from_json(data: dict) -> Atoms:
+    return Atoms(
+        numbers=data['numbers'], positions=data['positions'], cell=data['cell'], pbc=True
+    )
+
+
+def result_to_json(result: dict) -> dict:
+    return {k: np.asarray(v).tolist() for k, v in result.items()}
+
+
+class HTTPServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections from busy clients
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def make_handler(server: BatchingServer) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code: int, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, server.stats.summary())
+            else:
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                futures = [
+                    server.submit(atoms_from_json(s), request.get('deadline_ms'))
+                    for s in request['structures']
+                ]
+            except (KeyError, ValueError, TypeError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            try:
+                results = [result_to_json(f.result()) for f in futures]
+            except Exception as e:  # noqa: BLE001
+                self.send_json(500, {'error': str(e)})
+                return
+            self.send_json(200, {'results': results})
+
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+    return Handler
+
+
+@pyrallis.wrap()
+def main(config: ServeConfig):
+    logging.basicConfig(level=logging.INFO)
+    calc = FacetCalculator.from_run(config.run_dir, use_ema=config.use_ema)
+    server = BatchingServer(
+        calc, config.node_buckets, config.graph_buckets, config.default_deadline_ms
+    )
+    if config.warmup:
+        logging.info('Compiling %d buckets', len(server.buckets()))
+        server.warmup()
+
+    httpd = HTTPServer((config.host, config.port), make_handler(server))
+    logging.info('Serving on http://%s:%d', config.host, config.port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.shutdown()
+        logging.info('Final stats: %s', server.stats.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ from flax.serialization import to_state_dict
 from facet.config import MainConfig
 from facet.data.dataset import dataloader, load_file, stack_trees
 from facet.layers import Context, edge_vecs
+from facet.probes import enable_probes
 from facet.regression import EFSLoss, EFSWrapper
 from facet.utils import debug_stat, debug_structure, flax_summary, intercept_stat
 
@@ -23,6 +24,7 @@ def to_dot_graph(x):
 
 def show_model(config: MainConfig, make_hlo_dot=False, do_profile=False, show_stat=False):
     # print(config.data.avg_dist(6), config.data.avg_num_neighbors(6))
+    enable_probes(config.log.probes)
     config.batch_size = 32
     config.model.resid_init = 'ones'
     kwargs = dict(ctx=Context(training=False))
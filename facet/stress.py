@@ -0,0 +1,117 @@
+"""
+Stress from the strain derivative of the energy.
+
+The stress is (1/V) dE/dε, where ε is a symmetric strain applied to both the atom positions and
+the lattice. Outputs use the units and sign convention of the MPtrj targets: kbar, with VASP's
+convention that positive values are compressive, so the sign is flipped relative to the physical
+Cauchy stress.
+"""
+
+from typing import Callable
+
+import jax
+import jax.numpy as jnp
+from jaxtyping import Array, Float
+
+# 1 eV/Å^3 in kbar and GPa.
+EV_PER_A3_TO_KBAR = 1602.1766208
+EV_PER_A3_TO_GPA = 160.21766208
+
+# Converts (1/V) dE/dε, in eV/Å^3, to the target stress convention.
+STRESS_SCALE = -EV_PER_A3_TO_KBAR
+
+# Voigt order: xx, yy, zz, xy, yz, xz.
+VOIGT_I = (0, 1, 2, 0, 1, 0)
+VOIGT_J = (0, 1, 2, 1, 2, 2)
+# Index into the Voigt components of each entry of the full tensor.
+FULL_FROM_VOIGT = ((0, 3, 5), (3, 1, 4), (5, 4, 2))
+
+
+def cell_volume(lat: Float[Array, '*graphs 3 3']) -> Float[Array, '*graphs']:
+    """Volume of the cells with the given lattice vectors as rows. Works with NumPy and JAX
+    arrays."""
+    a, b, c = lat[..., 0, :], lat[..., 1, :], lat[..., 2, :]
+    triple = (
+        a[..., 0] * (b[..., 1] * c[..., 2] - b[..., 2] * c[..., 1])
+        + a[..., 1] * (b[..., 2] * c[..., 0] - b[..., 0] * c[..., 2])
+        + a[..., 2] * (b[..., 0] * c[..., 1] - b[..., 1] * c[..., 0])
+    )
+    return abs(triple)
+
+
+def inverse_volume(volume: Float[Array, '*graphs']) -> Float[Array, '*graphs']:
+    """1 / volume, with 0 for the empty padding cells."""
+    safe = jnp.where(volume == 0, 1, volume)
+    return jnp.where(volume == 0, 0, 1 / safe)
+
+
+def symmetrize(x: Float[Array, '*batch 3 3']) -> Float[Array, '*batch 3 3']:
+    return (x + jnp.swapaxes(x, -1, -2)) / 2
+
+
+def apply_strain(
+    cart: Float[Array, 'nodes 3'],
+    lat: Float[Array, 'graphs 3 3'],
+    graph_i,
+    strain: Float[Array, 'graphs 3 3'],
+) -> tuple[Float[Array, 'nodes 3'], Float[Array, 'graphs 3 3']]:
+    """Deforms the positions and lattice by (I + ε), with ε the symmetric part of strain."""
+    deform = symmetrize(strain)
+    new_cart = cart + jnp.einsum('ni,nij->nj', cart, deform[graph_i])
+    new_lat = lat + jnp.einsum('gai,gij->gaj', lat, deform)
+    return new_cart, new_lat
+
+
+def virial(
+    cg, vecs: Float[Array, 'nodes k 3'], edge_grad: Float[Array, 'nodes k 3']
+) -> Float[Array, 'graphs 3 3']:
+    """dE/dε computed from the gradient with respect to the edge vectors: Σ r ⊗ dE/dr over the
+    edges of each graph, symmetrized. Equal to the strain derivative, because a strain maps every
+    edge vector r to r (I + ε)."""
+    per_node = jnp.einsum('nka,nkb->nab', vecs, edge_grad)
+    return symmetrize(
+        jax.ops.segment_sum(per_node, cg.nodes.graph_i, num_segments=cg.n_total_graphs)
+    )
+
+
+def strain_grad_to_stress(
+    strain_grad: Float[Array, 'graphs 3 3'], inv_volume: Float[Array, ' graphs']
+) -> Float[Array, 'graphs 3 3']:
+    """Converts dE/dε into stress in the target convention."""
+    return strain_grad * inv_volume[..., None, None] * STRESS_SCALE
+
+
+def to_voigt(stress: Float[Array, '*batch 3 3']) -> Float[Array, '*batch 6']:
+    """Full 3x3 tensor to the 6 Voigt components."""
+    return stress[..., VOIGT_I, VOIGT_J]
+
+
+def from_voigt(voigt: Float[Array, '*batch 6']) -> Float[Array, '*batch 3 3']:
+    """6 Voigt components to the full symmetric 3x3 tensor."""
+    return voigt[..., jnp.array(FULL_FROM_VOIGT)]
+
+
+def finite_difference_stress(
+    total_energy_fn: Callable, cg, h: float = 1e-4
+) -> Float[Array, 'graphs 3 3']:
+    """Central finite-difference estimate of the stress, for checking the analytic version.
+    total_energy_fn maps a graph to the total energy of each of its graphs."""
+    strain_grad = []
+    for i in range(3):
+        row = []
+        for j in range(3):
+            e_ij = jnp.zeros((cg.n_total_graphs, 3, 3)).at[:, i, j].set(h)
+            energies = []
+            for sign in (1, -1):
+                cart, lat = apply_strain(
+                    cg.nodes.cart, cg.graph_data.lat, cg.nodes.graph_i, sign * e_ij
+                )
+                strained = cg.replace(
+                    nodes=cg.nodes.replace(cart=cart), graph_data=cg.graph_data.replace(lat=lat)
+                )
+                energies.append(total_energy_fn(strained))
+            row.append((energies[0] - energies[1]) / (2 * h))
+        strain_grad.append(jnp.stack(row, axis=-1))
+
+    return strain_grad_to_stress(jnp.stack(strain_grad, axis=-2), cg.graph_data.inv_volume)
+
@@ -1,6 +1,10 @@
 """Training state runner interface."""
 
 from time import sleep
+
+import rich
+
+from facet.compile_monitor import MONITOR
 from facet.config import MainConfig
 from facet.dashboard import Dashboard
 from facet.training_state import TrainingRun
@@ -10,6 +14,7 @@ def run_using_dashboard(config: MainConfig):
     run = TrainingRun(config)
     app = Dashboard(run, config=config)
     app.run()
+    rich.print(MONITOR.table())
     return run
 
 
@@ -21,6 +26,7 @@ def run_quietly(config: MainConfig):
 
     print('Saved to:')
     print(run.finish().absolute())
+    rich.print(MONITOR.table())
     return run
 
 
@@ -59,5 +65,6 @@ def run_using_progress(config: MainConfig):
         progress.advance(task, advance=0)
     print('Saved to:')
     print(run.finish().absolute())
+    rich.print(MONITOR.table())
     sleep(60)
     return run
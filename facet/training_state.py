@@ -5,10 +5,9 @@ import random
 import shutil
 import time
 from collections import defaultdict
-from datetime import datetime, timedelta
-from os import PathLike
+from datetime import datetime
 from pathlib import Path
-from shutil import copytree, make_archive
+from shutil import make_archive
 from typing import Any, Literal, Mapping, Sequence, Union
 
 import chex
@@ -22,16 +21,17 @@ import pyrallis
 from flax import struct
 from flax import linen as nn
 from flax.training import train_state
+from jax.sharding import NamedSharding, PartitionSpec
 
-from facet.checkpointing import best_ckpt
+from facet.checkpointing import RunCheckpointer, best_ckpt, ckpt_dir
+from facet.compile_monitor import MONITOR, watch_traces
 from facet.config import LossConfig, MainConfig
-from facet.data.dataset import CrystalGraphs, dataloader
+from facet.data.dataset import CrystalGraphs, LoaderState, dataloader, num_stacked, prefetch
 from facet.layers import Context
-from facet.model_summary import model_summary
+from facet.metrics_sink import JSONLSink, MetricsLogger, MetricsSink, NeptuneSink
+from facet.probes import enable_probes
 from facet.utils import debug_structure, get_nested_path, item_if_arr
-
-import neptune  # type: ignore
-from neptune.types import File  # type: ignore
+from facet.validation import PARAM_SETS, Validator, batch_mesh
 
 
 @struct.dataclass
@@ -72,7 +72,8 @@ def create_train_state(module: nn.Module, optimizer, rng, batch: CrystalGraphs):
         params=params,
         tx=tx,
         metrics=Metrics(),
-        last_grad_norm=0,
+        # the type optax.global_norm gives, so the first step isn't retraced
+        last_grad_norm=jnp.zeros((), jnp.float32),
     )
 
 
@@ -82,6 +83,15 @@ class Checkpoint:
     seed: int
     metrics_history: Mapping[str, Sequence[float]]
     curr_epoch: float
+    loader: LoaderState
+
+
+def ckpt_loader_state(ckpt) -> LoaderState | None:
+    """The data loader position of a restored checkpoint, if it has one."""
+    loader = ckpt.get('loader')
+    if loader is None:
+        return None
+    return LoaderState(**{k: int(v) for k, v in loader.items()})
 
 
 def eval_state(state: TrainState) -> TrainState:
@@ -95,18 +105,74 @@ def update_metrics(state: TrainState, metric_updates) -> TrainState:
 class TrainingRun:
     def __init__(self, config: MainConfig):
         self.seed = random.randint(100, 1000)
-        self.rng = {'params': jax.random.key(self.seed)}
-        logging.info(f'Seed: {self.seed}')
         self.config = config
+        # before anything is traced, so the enabled probes are compiled in
+        enable_probes(config.log.probes)
 
         self.metrics_history: Mapping[str, list[Any]] = defaultdict(list)
         self.num_epochs = config.num_epochs
-        self.steps_in_epoch, self.dl = dataloader(config, split='train', infinite=True)
-        self.steps_in_test_epoch, self.test_dl = dataloader(config, split='valid', infinite=True)
+
+        self.state: TrainState | None = None
+        self.restart_ckpt = None
+        self.resume_step: int | None = None
+        self.loader_state = LoaderState(seed=config.data.shuffle_seed)
+        if config.restart_from is not None and config.resume:
+            self.folder: Path | None = Path(config.restart_from)
+            self.checkpointer = RunCheckpointer(ckpt_dir(self.folder))
+            self.resume_step = self.checkpointer.latest_step()
+            if self.resume_step is None:
+                raise ValueError(f'No checkpoints to resume in {self.folder}')
+
+            info = self.checkpointer.restore_info(self.resume_step)
+            self.seed = int(info['seed'])
+            for k, v in info.get('metrics_history', {}).items():
+                self.metrics_history[k] = np.asarray(v).tolist()
+            loader_state = ckpt_loader_state(info)
+            if loader_state is None:
+                logging.warning('Checkpoint has no data loader state: starting from the start')
+            else:
+                self.loader_state = loader_state
+            logging.info(f'Resuming from step {self.resume_step}, data at {self.loader_state}')
+        else:
+            if config.restart_from is not None:
+                self.restart_ckpt = best_ckpt(config.restart_from)
+            self.folder = self.make_folder()
+            if self.folder is None:
+                ckpt_folder = Path(ocp.test_utils.erase_and_create_empty('/tmp/jax_ckpt'))
+            else:
+                ckpt_folder = ckpt_dir(self.folder)
+            self.checkpointer = RunCheckpointer(ckpt_folder)
+
+        self.rng = {'params': jax.random.key(self.seed)}
+        logging.info(f'Seed: {self.seed}')
+
+        self.steps_in_epoch, self.dl = dataloader(
+            config, split='train', infinite=True, start=self.loader_state
+        )
+        self.batches_per_epoch = self.steps_in_epoch // num_stacked(config)
+        valid_device = config.device.validation_device()
+        self.steps_in_test_epoch, test_dl = dataloader(
+            config, split='valid', infinite=True, device=valid_device
+        )
+        self.test_dl = prefetch(test_dl)
+        self.validator = Validator(
+            config.train.loss,
+            self.test_dl,
+            self.steps_in_test_epoch,
+            device=valid_device,
+            async_mode=config.log.async_valid,
+        )
+        self.valid_metrics: dict[str, dict[str, float]] = {split: {} for split in PARAM_SETS}
         self.num_steps = self.steps_in_epoch * self.num_epochs
-        self.steps = range(self.num_steps)
-        self.curr_step = 0
-        self.start_time = time.monotonic()
+        if self.resume_step is None:
+            self.steps = range(self.num_steps)
+            self.curr_step = 0
+        else:
+            self.steps = range(self.resume_step + 1, self.num_steps)
+            self.curr_step = self.resume_step
+        # the elapsed time continues from the checkpoint's
+        elapsed_mins = max(self.metrics_history.get('rel_mins', []), default=0)
+        self.start_time = time.monotonic() - 60 * elapsed_mins
         self.scheduler = self.config.train.build_lr_schedule(
             num_epochs=self.num_epochs, steps_in_epoch=self.steps_in_epoch
         )
@@ -114,24 +180,26 @@ class TrainingRun:
         self.model = self.make_model()
         self.metrics = Metrics()
 
-        opts = ocp.CheckpointManagerOptions(
-            save_interval_steps=1,
-            best_fn=lambda metrics: metrics['te_loss'],
-            best_mode='min',
-            max_to_keep=4,
-            enable_async_checkpointing=True,
-            keep_time_interval=timedelta(minutes=30),
-        )
-        self.mngr = ocp.CheckpointManager(
-            ocp.test_utils.erase_and_create_empty('/tmp/jax_ckpt'),
-            options=opts,
-        )
-
         self.run = self.init_run()
+        sinks: list[MetricsSink] = []
+        if 'jsonl' in config.log.sinks and self.folder is not None:
+            sinks.append(JSONLSink(self.folder / 'metrics.jsonl'))
+        if self.run is not None:
+            sinks.append(NeptuneSink(self.run))
+        self.logger = MetricsLogger(sinks)
+        self.logger.log('parameters', self.config.as_dict())
+        self.logger.log('seed', self.seed)
 
         self.test_loss = 1000
 
-    def init_run(self) -> neptune.Run:
+    def init_run(self):
+        """Starts the Neptune run, if it's one of the sinks."""
+        if 'neptune' not in self.config.log.sinks:
+            return None
+
+        import neptune  # type: ignore
+        from neptune.types import File  # type: ignore
+
         run = neptune.init_run(
             mode='debug' if self.config.debug_mode else 'async',
             tags=self.config.log.tags,
@@ -140,22 +208,26 @@ class TrainingRun:
             source_files='facet/**/*.py',
         )
 
-        run['parameters'] = self.config.as_dict()
         run['full_config'] = File.from_content(
             pyrallis.cfgparsing.dump(self.config, omit_defaults=False), extension='toml'
         )
-
-        if not self.config.debug_mode:
-            summary = model_summary(self.config)
-            run['model_summary'] = File.from_content(summary['html'], extension='html')
-            run['gflops'] = summary['gflops']
-
         run['dataset_metadata'].track_files(str(self.config.data.dataset_folder / 'metadata.json'))
-        run['seed'] = self.seed
         return run
 
+    def log_model_summary(self):
+        """Uploads the model summary. It takes a while, and captures stdout while it runs, so it's
+        done once training is over."""
+        from neptune.types import File  # type: ignore
+
+        from facet.model_summary import model_summary
+
+        summary = model_summary(self.config)
+        self.run['model_summary'] = File.from_content(summary['html'], extension='html')
+        self.logger.log('gflops', summary['gflops'])
+
     @staticmethod
     @ft.partial(jax.jit, static_argnames=('config',))
+    @watch_traces
     @chex.assert_max_traces(5)
     def compute_metrics(
         *,
@@ -173,44 +245,7 @@ class TrainingRun:
 
     @staticmethod
     @ft.partial(jax.jit, static_argnames=('config',))
-    @chex.assert_max_traces(5)
-    def test_preds(config: LossConfig, state: TrainState, params, batch: CrystalGraphs, rng):
-        """Evaluate metrics for a single batch."""
-        rngs = {k: v for k, v in rng.items()} if isinstance(rng, dict) else {'params': rng}
-        rng = jax.random.fold_in(rngs['params'], state.step)
-
-        from jax.experimental import mesh_utils
-        from jax.experimental.shard_map import shard_map
-        from jax.sharding import Mesh, PartitionSpec as P
-
-        devs = jax.local_devices()
-        mesh = Mesh(mesh_utils.create_device_mesh([len(devs)], devices=devs), 'batch')
-
-        @ft.partial(jax.vmap, in_axes=(None, 0))
-        def loss_fn(params, batch):
-            preds = config.efs_wrapper(
-                state.apply_fn, params, batch, ctx=Context(training=True), rngs=rng
-            )
-            loss = config.efs_loss(batch, preds)
-            return loss
-
-        @ft.partial(
-            shard_map,
-            mesh=mesh,
-            in_specs=(P(None), P('batch')),
-            out_specs=P('batch'),
-            check_rep=False,
-        )
-        def ploss_fn(params, batch):
-            loss = loss_fn(params, batch)
-            loss = jax.lax.pmean(loss, axis_name='batch')
-            return loss
-
-        loss = ploss_fn(params, batch)
-        return loss
-
-    @staticmethod
-    @ft.partial(jax.jit, static_argnames=('config',))
+    @watch_traces
     @chex.assert_max_traces(5)
     def train_grads(config: LossConfig, state: TrainState, params, batch: CrystalGraphs, rng):
         """Train for a single step."""
@@ -258,6 +293,7 @@ class TrainingRun:
 
     @staticmethod
     @ft.partial(jax.jit)
+    @watch_traces
     @chex.assert_max_traces(5)
     def update_train_state(state: TrainState, grads) -> TrainState:
         # grads = jax.tree_map(lambda x: x.mean(axis=0), grads)
@@ -290,19 +326,28 @@ class TrainingRun:
     ):
         if split == 'train':
             self.metrics_history[f'tr_{metric_name}'].append(metric_value)
-            self.run[f'train/{metric_name}'].append(value=metric_value, step=self.curr_epoch)
+            self.logger.log(f'train/{metric_name}', metric_value, self.curr_epoch)
         elif split == 'valid':
             self.metrics_history[f'te_{metric_name}'].append(metric_value)
-            self.run[f'valid/{metric_name}'].append(value=metric_value, step=self.curr_epoch)
+            self.logger.log(f'valid/{metric_name}', metric_value, self.curr_epoch)
         elif split == 'eval':
             self.metrics_history[f'ev_{metric_name}'].append(metric_value)
-            self.run[f'eval/{metric_name}'].append(value=metric_value, step=self.curr_epoch)
+            self.logger.log(f'eval/{metric_name}', metric_value, self.curr_epoch)
         elif split is None:
             self.metrics_history[f'{metric_name}'].append(metric_value)
-            self.run[f'{metric_name}'].append(value=metric_value, step=self.curr_epoch)
+            self.logger.log(f'{metric_name}', metric_value, self.curr_epoch)
         else:
             raise ValueError(f'Split invalid: {split}')
 
+    def update_valid_metrics(self, result: tuple[int, dict[str, dict[str, float]]] | None):
+        """Stores the results of a finished validation run, to be logged at the next log step."""
+        if result is None:
+            return
+
+        _step, self.valid_metrics = result
+        if 'loss' in self.valid_metrics['eval']:
+            self.test_loss = self.valid_metrics['eval']['loss']
+
     @property
     def eval_state(self) -> TrainState:
         estate = eval_state(self.state)
@@ -316,7 +361,7 @@ class TrainingRun:
 
     def step(self, step: int, batch: CrystalGraphs):
         self.curr_step = step
-        if step == 0:
+        if self.state is None:
             # initialize model
             self.state = create_train_state(
                 module=self.model,
@@ -325,16 +370,27 @@ class TrainingRun:
                 batch=batch,
             )
 
-            if self.config.restart_from is not None:
-                self.state = self.state.replace(
-                    params=best_ckpt(self.config.restart_from)['state']['params']
-                )
+            if self.resume_step is not None:
+                # the new state is the template the checkpoint is restored to
+                self.state, stats = self.checkpointer.restore_state(self.resume_step, self.state)
+                for k, v in stats.items():
+                    self.logger.log(f'ckpt_stats/{k}', v)
+            elif self.restart_ckpt is not None:
+                self.state = self.state.replace(params=self.restart_ckpt['state']['params'])
+
+            # replicated over the mesh the steps run on, like the states they return, so the
+            # second step isn't retraced for the new sharding
+            replicated = NamedSharding(batch_mesh(jax.local_devices()), PartitionSpec())
+            self.state = jax.device_put(self.state, replicated)
 
             # log number of parameters
-            self.run['params'] = int(
-                jax.tree.reduce(
-                    lambda x, y: x + y, jax.tree.map(lambda x: x.size, self.state.params)
-                )
+            self.logger.log(
+                'params',
+                int(
+                    jax.tree.reduce(
+                        lambda x, y: x + y, jax.tree.map(lambda x: x.size, self.state.params)
+                    )
+                ),
             )
 
             for path in self.config.log.log_params:
@@ -345,40 +401,56 @@ class TrainingRun:
         elif step >= self.num_steps:
             return None
 
+        self.loader_state = self.loader_state.advance(self.batches_per_epoch)
+
         kwargs = dict(
             config=self.config.train.loss,
             batch=batch,
             rng=self.rng,
         )
 
+        # the metrics are kept out of the jitted steps, which don't use them: they gain entries
+        # after the first step, which would retrace every step function
+        metrics = self.state.metrics
+        self.state = self.state.replace(metrics=Metrics())
         self.state, preds = self.train_step(state=self.state, **kwargs)  # type: ignore
         # jax.debug.visualize_array_sharding(preds[..., 0])
         metric_updates = self.compute_metrics(preds=preds, state=self.eval_state, **kwargs)
-        self.state = update_metrics(self.state, metric_updates)
+        self.state = update_metrics(self.state.replace(metrics=metrics), metric_updates)
+
+        if self.should_validate:
+            self.update_valid_metrics(
+                self.validator.submit(
+                    self.state.apply_fn,
+                    self.eval_state.params,
+                    self.state.params,
+                    self.rng,
+                    self.curr_step,
+                )
+            )
+
+        self.update_valid_metrics(self.validator.poll())
+        if self.is_last_step:
+            self.update_valid_metrics(self.validator.wait())
 
         if self.should_log or self.should_ckpt or self.should_validate:
+            log_start = time.perf_counter()
             for metric, value in self.state.metrics.items():  # compute metrics
                 if metric == 'grad_norm':
                     self.log_metric('grad_norm', value, None)
                     continue
                 self.log_metric(metric, value, 'train')
 
-                if not self.should_validate:
-                    if f'te_{metric}' in self.metrics_history:
-                        test_value = self.metrics_history[f'te_{metric}'][-1]
-                    else:
-                        test_value = 0
-                    self.log_metric(metric, test_value, 'valid')
-
-                    if f'ev_{metric}' in self.metrics_history:
-                        test_value = self.metrics_history[f'ev_{metric}'][-1]
-                    else:
-                        test_value = 0
-                    self.log_metric(metric, test_value, 'eval')
+                # the EMA parameters are logged as eval, and the current parameters as valid: the
+                # difference is useful to debug e.g., EMA and normal training
+                self.log_metric(metric, self.valid_metrics['valid'].get(metric, 0), 'valid')
+                self.log_metric(metric, self.valid_metrics['eval'].get(metric, 0), 'eval')
 
+            # reset train_metrics for next training epoch, to zeros rather than nothing, so the
+            # metrics keep their structure
             self.state = self.state.replace(
-                metrics=Metrics()
-            )  # reset train_metrics for next training epoch
+                metrics=jax.tree.map(jnp.zeros_like, self.state.metrics)
+            )
 
             self.log_metric('lr', self.lr, None)
             self.log_metric('step', self.curr_step, None)
@@ -406,68 +478,45 @@ class TrainingRun:
                     param = get_nested_path(self.state.params['params'], path)
                     if param is not None:
                         if param.size == 1:
-                            self.run[f'model_params/{path}'].append(param.item())
+                            self.logger.log(
+                                f'model_params/{path}', param.reshape(()), self.curr_epoch
+                            )
                         elif param.size <= 64:  # nothing too crazy!
                             for i, val in enumerate(param.flatten()):
-                                self.run[f'model_params/{path}/{i}'].append(val)
+                                self.logger.log(f'model_params/{path}/{i}', val, self.curr_epoch)
                         else:
                             # we don't want to accidentally upload a million values
                             continue
 
-        # debug_structure(self.state)
-        # print(self.metrics_history)
+            # traces and compiles so far: these should stop growing after the first steps
+            for k, v in MONITOR.totals().items():
+                self.logger.log(f'compile/{k}', v, self.curr_epoch)
 
-        def compute_test_metrics(test_state):
-            for _i, test_batch in zip(range(self.steps_in_test_epoch), self.test_dl):
-                test_preds = TrainingRun.test_preds(
-                    self.config.train.loss,
-                    test_state,
-                    test_state.params,
-                    test_batch,
-                    self.rng,
-                )
-
-                metric_updates = self.compute_metrics(
-                    config=self.config.train.loss,
-                    state=test_state,
-                    batch=test_batch,
-                    preds=test_preds,
-                )
-
-                test_state = update_metrics(test_state, metric_updates)
-
-            return test_state
-
-        if self.should_validate:
-            self.test_state = self.eval_state.replace(metrics=Metrics())
-            self.test_state = compute_test_metrics(self.test_state)
+            # the time the training loop spent logging, which should stay small
+            self.log_metric('log_ms', (time.perf_counter() - log_start) * 1000, None)
 
-            for metric, value in self.test_state.metrics.items():
-                if metric == 'grad_norm':
-                    continue
-                self.log_metric(metric, value, 'eval')
-                if f'{metric}' == 'loss':
-                    self.test_loss = value
-
-            # compute values with current training: useful to debug difference between
-            # e.g., EMA and normal training
-            test_state_eval = self.state.replace(metrics=Metrics())
-            test_state_eval = compute_test_metrics(test_state_eval)
-            for metric, value in test_state_eval.metrics.items():
-                if metric == 'grad_norm':
-                    continue
-                self.log_metric(metric, value, 'valid')
+        # debug_structure(self.state)
+        # print(self.metrics_history)
 
         if self.should_ckpt:
             # print(self.test_loss)
-            self.mngr.save(
-                self.curr_step,
-                args=ocp.args.StandardSave(self.ckpt()),  # type: ignore
-                metrics={'te_loss': self.test_loss},
+            self.log_ckpt_stats(
+                self.checkpointer.save(
+                    self.curr_step, self.ckpt(), metrics={'te_loss': self.test_loss}
+                )
             )
+        self.log_ckpt_stats(self.checkpointer.poll())
 
         return self
 
+    def log_ckpt_stats(self, ckpt_stats: list[dict[str, float]]):
+        """Logs how long the checkpoint saves took and how large they were."""
+        for stats in ckpt_stats:
+            epoch = stats['step'] / self.steps_in_epoch
+            for k, v in stats.items():
+                if k != 'step':
+                    self.logger.log(f'ckpt_stats/{k}', v, epoch)
+
     def step_until_done(self):
         for step, batch in zip(self.steps, self.dl):
             yield self.step(step, batch)
@@ -528,45 +577,64 @@ class TrainingRun:
     def ckpt(self):
         """Checkpoint PyTree."""
         return Checkpoint(
-            self.state, self.seed, dict(self.metrics_history), self.curr_step / self.steps_in_epoch
+            # the metrics were just reset, and restoring them would need a template of their keys
+            self.state.replace(metrics=Metrics()),
+            self.seed,
+            # one array for each metric, rather than one for each value
+            {k: np.asarray(v) for k, v in self.metrics_history.items()},
+            self.curr_step / self.steps_in_epoch,
+            self.loader_state,
         )
 
-    def save_final(self, out_dir: str | PathLike):
-        """Save final model to directory."""
-        if not self.config.debug_mode:
-            self.mngr.wait_until_finished()
-            copytree(self.mngr.directory, Path(out_dir) / 'ckpts/')
-
-    def finish(self):
+    def make_folder(self) -> Path | None:
+        """Creates the folder of a new run, where its checkpoints are written as it trains, and
+        saves its config there. Debug runs don't have one."""
         if self.config.debug_mode:
-            return Path('/dev/null')
+            return None
 
-        now = datetime.now()
         if self.config.log.exp_name is None:
-            exp_name = now.strftime('%m-%d-%H-%M')
+            exp_name = datetime.now().strftime('%m-%d-%H-%M')
         else:
             exp_name = self.config.log.exp_name
 
-        folder = Path('logs/') / f'{exp_name}_{self.seed}'
+        folder = self.config.log.log_dir / f'{exp_name}_{self.seed}'
         folder.mkdir(exist_ok=True)
+        with open(folder / 'config.toml', 'w') as outfile:
+            pyrallis.cfgparsing.dump(self.config, outfile)
+        return folder
+
+    def save_final(self):
+        """Waits for the last checkpoint to be written."""
+        self.log_ckpt_stats(self.checkpointer.wait())
+
+    def finish(self):
+        self.validator.shutdown()
+        self.logger.log('compile_summary', MONITOR.summary())
+        if self.folder is None:
+            self.logger.close()
+            return Path('/dev/null')
+
+        now = datetime.now()
+        folder = self.folder
+        exp_name = folder.name.removesuffix(f'_{self.seed}')
 
         pd.DataFrame(self.metrics_history).to_feather(folder / 'metrics.feather')
 
         with open(folder / 'time_stopped.txt', 'w') as f:
             f.write(now.isoformat())
 
-        with open(folder / 'config.toml', 'w') as outfile:
-            pyrallis.cfgparsing.dump(self.config, outfile)
-
-        self.save_final(folder / 'final_ckpt')
+        self.save_final()
 
-        self.run['exp_name'] = exp_name
+        self.logger.log('exp_name', exp_name)
+        if self.run is not None:
+            self.log_model_summary()
+        self.logger.close()
 
         zipname = make_archive(exp_name, 'zip', root_dir=folder)
-        new_path = Path('logs') / f'{exp_name}.zip'
+        new_path = self.config.log.log_dir / f'{exp_name}.zip'
         shutil.move(zipname, new_path)
-        self.run['checkpoint'].upload(str(new_path))
-
-        self.run.stop()
+        if self.run is not None:
+            self.run['checkpoint'].upload(str(new_path))
+            self.run.stop()
 
         return folder
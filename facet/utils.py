@@ -3,7 +3,7 @@
 from inspect import signature
 import io
 import re
-from dataclasses import asdict, is_dataclass
+from dataclasses import fields, is_dataclass
 from functools import partial
 from os import PathLike
 from pathlib import Path
@@ -18,6 +18,7 @@ import jax
 import jax.numpy as jnp
 import numpy as np
 import rich
+from flax import struct
 from flax.serialization import msgpack_restore
 from flax.serialization import to_bytes
 from jaxtyping import jaxtyped
@@ -140,6 +141,78 @@ class TreeVisitor:
     def np_arr(self, arr: np.ndarray):
         raise NotImplementedError()
 
+    def summary(self, summary: 'ArraySummary'):
+        raise NotImplementedError()
+
+
+@struct.dataclass
+class ArraySummary:
+    """Statistics of an array, small enough to send to the host whatever the array's size. kind is
+    'f' for floats, 'i' for integers and booleans, or 'values' for arrays so small the values are
+    kept."""
+
+    stats: dict[str, jax.Array]
+    kind: str = struct.field(pytree_node=False)
+    size: int = struct.field(pytree_node=False)
+    sampled: bool = struct.field(pytree_node=False)
+    prefix: str = struct.field(pytree_node=False, default='')
+
+
+def summarize_array(arr, sample_size: int = 10_000) -> ArraySummary:
+    """Reduces an array to the statistics StatsVisitor shows, where the array is: on device, or
+    inside a traced function. The range, mean, standard deviation and share of zeros are exact.
+    Quantiles and unique values come from a fixed subsample of arrays larger than sample_size."""
+    prefix = ''
+    if isinstance(arr, IrrepsArray):
+        prefix = f'Irreps({arr.irreps})'
+        arr = arr.array
+
+    flat = jnp.ravel(arr)
+    if jnp.issubdtype(flat.dtype, jnp.floating):
+        flat = flat.astype(jnp.float32)
+    elif flat.dtype == jnp.bool_:
+        flat = flat.astype(jnp.int32)
+
+    size = flat.size
+    if size <= 5:
+        return ArraySummary({'values': flat}, 'values', size, False, prefix)
+
+    sampled = size > sample_size
+    if sampled:
+        # n^2 + 1 tends to have fewer factors: should capture most slices
+        inds = np.arange(int(np.sqrt(size - 2)) + 1) ** 2 + 1
+        sample = flat[inds]
+    else:
+        sample = flat
+
+    stats = {
+        'lo': jnp.min(flat),
+        'hi': jnp.max(flat),
+        'quartiles': jnp.quantile(sample, jnp.array([0.25, 0.5, 0.75]), method='nearest'),
+    }
+    if jnp.issubdtype(flat.dtype, jnp.floating):
+        kind = 'f'
+        stats['mean'] = jnp.nanmean(flat)
+        stats['std'] = jnp.nanstd(flat)
+    else:
+        kind = 'i'
+        stats['zeros'] = jnp.mean(flat == 0)
+        ordered = jnp.sort(sample)
+        is_new = jnp.concat([jnp.ones(1, dtype=bool), ordered[1:] != ordered[:-1]])
+        stats['num_unique'] = jnp.sum(is_new)
+        stats['unique'] = ordered[jnp.nonzero(is_new, size=5, fill_value=0)[0]]
+
+    return ArraySummary(stats, kind, size, sampled, prefix)
+
+
+def summarize_tree(tree, sample_size: int = 10_000):
+    """Replaces the arrays in a tree with their ArraySummary."""
+    return jax.tree.map(
+        lambda x: summarize_array(x, sample_size) if hasattr(x, 'shape') else x,
+        tree,
+        is_leaf=lambda x: isinstance(x, IrrepsArray),
+    )
+
 
 class StatsVisitor(TreeVisitor):
     def __init__(self, sample_size: int = 10_000, pad=True) -> None:
@@ -148,58 +221,42 @@ class StatsVisitor(TreeVisitor):
         self.pad = pad
 
     def jax_arr(self, arr: jax.Array):
-        flat = arr.flatten()
-        size = len(flat)
-        if size <= 5:
-            return str(jnp.round(flat, 4))
+        return self.summary(summarize_array(arr, self.sample_size))
 
-        lo = arr.min().item()
-        hi = arr.max().item()
+    def summary(self, summary: ArraySummary):
+        stats = {k: np.asarray(v) for k, v in summary.stats.items()}
+        if summary.kind == 'values':
+            return str(np.round(stats['values'], 4))
 
-        if size <= self.sample_size:
-            sampling = False
-        else:
-            sampling = True
-
-            # n^2 + 1 tends to have fewer factors: should capture most slices
-            inds = jnp.arange(np.floor(np.sqrt(size - 1)) + 1, dtype=jnp.int64) ** 2 + 1
-            x = np.array(flat[inds])
-
-        if flat.dtype == jnp.bfloat16:
-            x = np.array(flat.astype(jnp.float32))
-        else:
-            x = np.array(flat)
+        lo = stats['lo']
+        hi = stats['hi']
+        q25, q50, q75 = stats['quartiles']
 
-        summary = ''
-        if x.dtype.kind == 'f':
-            mu = np.nanmean(x)
-            sd = np.nanstd(x)
+        out = ''
+        if summary.kind == 'f':
+            mu = stats['mean']
+            sd = stats['std']
             fmt = lambda s: f'{s:>8.3g}'
             if (abs(mu) > 1000 or sd > 1000) or (1e-5 < abs(mu) < 1e-2 and 1e-5 < sd < 1e-2):
                 factor = round(np.log10(max(abs(mu), sd)))
-                x = x / 10**factor
-                lo = lo / 10**factor
-                hi = hi / 10**factor
-                summary += f' E{factor}'
+                lo, q25, q50, q75, hi = (x / 10**factor for x in (lo, q25, q50, q75, hi))
+                out += f' E{factor}'
             else:
                 factor = 0
-            summary = f'{fmt(mu / 10 ** factor)} ± {fmt(sd / 10 ** factor)}' + summary
+            out = f'{fmt(mu / 10 ** factor)} ± {fmt(sd / 10 ** factor)}' + out
         else:
-            zeros = np.mean(x == 0)
+            zeros = stats['zeros']
             if zeros > 0.2:
-                summary += f'{zeros:.0%} 0, '
+                out += f'{zeros:.0%} 0, '
 
-            if (hi - lo) < 0.2 * size:
-                n_uniq = len(set(x))
+            if (hi - lo) < 0.2 * summary.size:
+                n_uniq = int(stats['num_unique'])
                 if n_uniq <= 5:
-                    summary += f'uniq: {set(x)}'
+                    out += f'uniq: {set(stats["unique"][:n_uniq].tolist())}'
                 else:
-                    summary += f'uniq: {n_uniq}'
+                    out += f'uniq: {n_uniq}'
 
             fmt = lambda s: f'{float(s):n}'
-            # fmt = str
-
-        q25, q50, q75 = np.quantile(x, [0.25, 0.5, 0.75], method='closest_observation')
 
         try:
             quarts = f'({fmt(lo)} {fmt(q25)} {fmt(q50)} {fmt(q75)} {fmt(hi)})'
@@ -207,9 +264,11 @@ class StatsVisitor(TreeVisitor):
                 quarts = f'{quarts:>50}'
         except ValueError:
             print(lo, q25, q50, q75, hi)
-        out = f'{quarts} {summary}'
-        out += '~' if sampling else ''
+        out = f'{quarts} {out}'
+        out += '~' if summary.sampled else ''
 
+        if summary.prefix:
+            out = f'{summary.prefix}[{out}]'
         return out
 
     def scalar(self, x: int | float):
@@ -272,7 +331,9 @@ def tree_from_dict(base: Tree, obj, depth=0, collapse_single=True):
 
 
 def tree_traverse(visitor: TreeVisitor, obj, max_depth=2, collapse_single=True):
-    if isinstance(obj, jax.Array):
+    if isinstance(obj, ArraySummary):
+        return visitor.summary(obj)
+    elif isinstance(obj, jax.Array):
         return visitor.jax_arr(obj)
     elif isinstance(obj, np.ndarray):
         return visitor.np_arr(obj)
@@ -307,7 +368,9 @@ def tree_traverse(visitor: TreeVisitor, obj, max_depth=2, collapse_single=True):
             }
     elif is_dataclass(obj):
         # print(type(obj), obj)
-        return {obj.__class__.__name__: tree_traverse(visitor, asdict(obj), max_depth)}
+        # not asdict, which would turn the ArraySummary values into dictionaries too
+        values = {f.name: getattr(obj, f.name) for f in fields(obj)}
+        return {obj.__class__.__name__: tree_traverse(visitor, values, max_depth)}
     elif obj is None:
         return 'None'
     else:
@@ -333,19 +396,27 @@ def _debug_stat(tree_depth=5, **kwargs):
     show_obj({f'{k}': tree_traverse(StatsVisitor(), v, tree_depth) for k, v in kwargs.items()})
 
 
-def debug_structure(*args, **kwargs):
-    """Prints out the structure of the inputs. Returns first argument."""
+def debug_structure(*args, tree_depth=5, **kwargs):
+    """Prints out the structure of the inputs. Returns first argument.
+
+    Shapes are known when tracing, so the structure is worked out then, and no arrays are sent to
+    the host."""
     new_kwargs = {f'arg{i}': arg for i, arg in enumerate(args)}
     new_kwargs.update(**kwargs)
-    jax.debug.callback(_debug_structure, **new_kwargs)
+    structure = {
+        f'{k}': tree_traverse(StructureVisitor(), v, tree_depth) for k, v in new_kwargs.items()
+    }
+    jax.debug.callback(partial(show_obj, structure))
     return list(new_kwargs.values())[0]
 
 
-def debug_stat(*args, **kwargs):
-    """Prints out a reduction of the inputs. Is almost the mean, but with a small fudge factor so differently-shaped arrays will have different summaries. Returns first argument."""
+def debug_stat(*args, tree_depth=5, **kwargs):
+    """Prints out a reduction of the inputs. Is almost the mean, but with a small fudge factor so differently-shaped arrays will have different summaries. Returns first argument.
+
+    The arrays are summarized on device, and only the summaries are sent to the host."""
     new_kwargs = {f'arg{i}': arg for i, arg in enumerate(args)}
     new_kwargs.update(**kwargs)
-    jax.debug.callback(_debug_stat, **new_kwargs)
+    jax.debug.callback(partial(_debug_stat, tree_depth), **summarize_tree(new_kwargs))
     return list(new_kwargs.values())[0]
 
 
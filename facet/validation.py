@@ -0,0 +1,175 @@
+"""Validation engine: evaluates the EMA and live parameters in a single pass over the validation
+set, accumulating metrics on device."""
+
+import functools as ft
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterator, Optional
+
+import chex
+import jax
+import jax.numpy as jnp
+from jax.experimental import mesh_utils
+from jax.experimental.shard_map import shard_map
+from jax.sharding import Mesh
+from jax.sharding import PartitionSpec as P
+
+from facet.compile_monitor import watch_traces
+from facet.config import LossConfig
+from facet.data.databatch import CrystalGraphs
+from facet.layers import Context
+
+# Names of the stacked parameter sets, in order. Each maps to the split the metrics are logged to.
+PARAM_SETS = ('eval', 'valid')
+
+
+def batch_mesh(devices) -> Mesh:
+    """Mesh with a single 'batch' axis over the given devices."""
+    devices = list(devices)
+    return Mesh(mesh_utils.create_device_mesh([len(devices)], devices=devices), 'batch')
+
+
+def stack_params(*params):
+    """Stacks parameter trees along a new leading axis, so they can be evaluated in one pass."""
+    return jax.tree.map(lambda *xs: jnp.stack(xs), *params)
+
+
+@ft.partial(jax.jit, static_argnames=('config', 'apply_fn', 'mesh'), donate_argnames=('totals',))
+@watch_traces
+@chex.assert_max_traces(5)
+def accumulate_batch(
+    config: LossConfig,
+    apply_fn: Callable,
+    mesh: Mesh,
+    params,
+    batch: CrystalGraphs,
+    rng,
+    totals,
+):
+    """Evaluates the stacked parameter sets on a single batch, adding the batch-averaged losses to
+    the running totals. The totals stay on device: pass None for the first batch."""
+    rngs = {k: v for k, v in rng.items()} if isinstance(rng, dict) else {'params': rng}
+
+    @ft.partial(jax.vmap, in_axes=(None, 0))
+    def loss_fn(params, batch):
+        preds = config.efs_wrapper(
+            apply_fn, params, batch, ctx=Context(training=False), rngs=rngs['params']
+        )
+        return config.efs_loss(batch, preds)
+
+    @ft.partial(
+        shard_map,
+        mesh=mesh,
+        in_specs=(P(None), P('batch')),
+        out_specs=P(),
+        check_rep=False,
+    )
+    def ploss_fn(params, batch):
+        # params_sets stack -> param_sets
+        loss = jax.vmap(loss_fn, in_axes=(0, None))(params, batch)
+        loss = jax.tree.map(lambda x: jnp.mean(x, axis=1), loss)
+        return jax.lax.pmean(loss, axis_name='batch')
+
+    loss = ploss_fn(params, batch)
+    if totals is None:
+        return loss
+    else:
+        return jax.tree.map(jnp.add, totals, loss)
+
+
+class Validator:
+    """Runs validation for a training run.
+
+    The EMA and live parameters are stacked and evaluated in the same forward pass over each batch,
+    and the losses are summed on device, so there is a single transfer per validation run. If
+    async_mode is True, validation runs in a background thread and the results are picked up by
+    poll() once they're ready, so the training loop never waits on it. Passing a device runs
+    validation on that device instead of the training devices, which works best with a device that
+    isn't used for training.
+    """
+
+    def __init__(
+        self,
+        config: LossConfig,
+        test_dl: Iterator[CrystalGraphs],
+        steps_in_test_epoch: int,
+        device: Optional[jax.Device] = None,
+        async_mode: bool = False,
+    ):
+        self.config = config
+        self.test_dl = test_dl
+        self.steps_in_test_epoch = steps_in_test_epoch
+        self.device = device
+        if device is None:
+            self.mesh = batch_mesh(jax.local_devices())
+        else:
+            self.mesh = batch_mesh([device])
+
+        self.async_mode = async_mode
+        self.executor = ThreadPoolExecutor(max_workers=1) if async_mode else None
+        self.pending: Optional[Future] = None
+
+    def evaluate(self, apply_fn: Callable, params, rng) -> dict[str, dict[str, float]]:
+        """Evaluates the stacked parameters on the whole validation set. Returns a mapping from
+        split name to the averaged metrics."""
+        if self.device is not None:
+            params = jax.device_put(params, self.device)
+
+        totals = None
+        num_batches = 0
+        for _i, test_batch in zip(range(self.steps_in_test_epoch), self.test_dl):
+            totals = accumulate_batch(
+                self.config, apply_fn, self.mesh, params, test_batch, rng, totals
+            )
+            num_batches += 1
+
+        if totals is None:
+            logging.warning('Validation set is empty')
+            return {split: {} for split in PARAM_SETS}
+
+        totals = jax.device_get(totals)
+        return {
+            split: {k: float(v[i]) / num_batches for k, v in totals.items()}
+            for i, split in enumerate(PARAM_SETS)
+        }
+
+    def submit(
+        self, apply_fn: Callable, eval_params, live_params, rng, step: int
+    ) -> Optional[tuple[int, dict[str, dict[str, float]]]]:
+        """Starts validation of the EMA and live parameters. If not running asynchronously, blocks
+        until validation is done. Any still-running validation is waited on first, and its results
+        are returned if they haven't been polled yet."""
+        params = stack_params(eval_params, live_params)
+        previous = self.wait()
+        if self.async_mode:
+            self.pending = self.executor.submit(self._run, apply_fn, params, rng, step)
+        else:
+            self.pending = Future()
+            self.pending.set_result(self._run(apply_fn, params, rng, step))
+
+        return previous
+
+    def _run(self, apply_fn: Callable, params, rng, step: int):
+        return step, self.evaluate(apply_fn, params, rng)
+
+    def poll(self) -> Optional[tuple[int, dict[str, dict[str, float]]]]:
+        """Returns the step and results of the last validation run if it's finished and hasn't
+        been returned yet, otherwise None."""
+        if self.pending is not None and self.pending.done():
+            result = self.pending.result()
+            self.pending = None
+            return result
+        else:
+            return None
+
+    def wait(self) -> Optional[tuple[int, dict[str, dict[str, float]]]]:
+        """Blocks until the pending validation run, if any, is finished, and returns its
+        results."""
+        if self.pending is None:
+            return None
+        self.pending.result()
+        return self.poll()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,96 @@
+"""Load generator for facet.serve. Sends random structures to a running server at a fixed rate and
+reports the latency percentiles and throughput seen by the clients and by the server."""
+
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyrallis
+import rich
+from ase.build import bulk
+
+from facet.config import field
+from facet.config.common import dataclass
+
+
+@dataclass
+class LoadConfig:
+    url: str = 'http://127.0.0.1:8470'
+    # Requests per second, sent as a Poisson process.
+    rate: float = 50.0
+    num_requests: int = 1000
+    structures_per_request: int = 1
+    # Deadline sent with each request, in milliseconds.
+    deadline_ms: float = 50.0
+    # Elements to build the random structures from: must be supported by the model.
+    elements: list[str] = field(default_factory=lambda: ['Si'])
+    max_repeat: int = 3
+    concurrency: int = 64
+    seed: int = 0
+
+
+def random_structure(config: LoadConfig, rng: np.random.Generator) -> dict:
+    element = config.elements[rng.integers(len(config.elements))]
+    atoms = bulk(element, cubic=True).repeat(rng.integers(1, config.max_repeat + 1, size=3))
+    atoms.rattle(0.05, seed=int(rng.integers(1 << 31)))
+    return {
+        'numbers': atoms.numbers.tolist(),
+        'positions': atoms.positions.tolist(),
+        'cell': atoms.cell.array.tolist(),
+    }
+
+
+def send(url: str, payload: dict) -> float:
+    request = urllib.request.Request(
+        url + '/predict',
+        data=json.dumps(payload).encode(),
+        headers={'Content-Type': 'application/json'},
+    )
+    start = time.monotonic()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.monotonic() - start
+
+
+@pyrallis.wrap()
+def main(config: LoadConfig):
+    rng = np.random.default_rng(config.seed)
+    payloads = [
+        {
+            'structures': [
+                random_structure(config, rng) for _ in range(config.structures_per_request)
+            ],
+            'deadline_ms': config.deadline_ms,
+        }
+        for _ in range(config.num_requests)
+    ]
+    gaps = rng.exponential(1 / config.rate, size=config.num_requests)
+
+    futures = []
+    start = time.monotonic()
+    with ThreadPoolExecutor(config.concurrency) as pool:
+        next_time = start
+        for payload, gap in zip(payloads, gaps):
+            next_time += gap
+            time.sleep(max(next_time - time.monotonic(), 0))
+            futures.append(pool.submit(send, config.url, payload))
+        latencies = np.array([f.result() for f in futures]) * 1000
+    elapsed = time.monotonic() - start
+
+    with urllib.request.urlopen(config.url + '/stats') as response:
+        server_stats = json.loads(response.read())
+
+    rich.print(
+        {
+            'client_p50_ms': float(np.percentile(latencies, 50)),
+            'client_p99_ms': float(np.percentile(latencies, 99)),
+            'client_throughput': config.num_requests * config.structures_per_request / elapsed,
+            'server': server_stats,
+        }
+    )
+
+
+if __name__ == '__main__':
+    main()
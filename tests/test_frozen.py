@@ -0,0 +1,86 @@
+"""Exports a small model and checks the frozen model predicts the same as the calculator."""
+
+from pathlib import Path
+
+import jax
+import numpy as np
+import pytest
+from ase import Atoms
+
+from facet.calculator import FacetCalculator
+from facet.config import DataConfig, LogConfig, MainConfig
+from facet.config.mace import IrrepsConfig, MACEConfig
+from facet.data.metadata import save_metadata
+from facet.data.synthetic import synthetic_batch, synthetic_metadata
+from facet.export import export_model
+from facet.frozen import FrozenModel
+from facet.layers import Context
+
+K, NUM_SPECIES = 6, 5
+BUCKETS = [(16, 4), (32, 4)]
+
+
+def small_calculator(folder: Path, quantize=None) -> FacetCalculator:
+    (folder / 'synthetic').mkdir(exist_ok=True)
+    save_metadata(
+        synthetic_metadata(NUM_SPECIES, K, batch_num_atoms=32, batch_num_graphs=4),
+        folder / 'synthetic' / 'metadata.mpk',
+    )
+    config = MainConfig(
+        batch_size=4,
+        data=DataConfig(data_folder=folder, dataset_name='synthetic'),
+        log=LogConfig(log_dir=folder),
+        model=MACEConfig(hidden_irreps=IrrepsConfig(dim=8, max_degree=1, num_layers=1)),
+    )
+    mod = config.build_regressor()
+    cg = jax.tree.map(np.asarray, synthetic_batch(32, K, 4, NUM_SPECIES))
+    params = mod.init(jax.random.key(0), cg.to_compute(), ctx=Context(training=False))
+    # some weights start at zero, which would make the forces and stress zero
+    leaves, treedef = jax.tree.flatten(params)
+    keys = jax.random.split(jax.random.key(1), len(leaves))
+    leaves = [x + 0.1 * jax.random.normal(k, x.shape, x.dtype) for k, x in zip(keys, leaves)]
+    params = jax.tree.unflatten(treedef, leaves)
+    return FacetCalculator(config, params, node_buckets=[16, 32], max_graphs=3, quantize=quantize)
+
+
+def structures() -> list[Atoms]:
+    rng = np.random.default_rng(0)
+    out = []
+    for n in (2, 5, 9):
+        cell = np.diag(rng.uniform(3, 4, 3)) + rng.uniform(-0.3, 0.3, (3, 3))
+        frac = rng.random((n, 3))
+        out.append(Atoms(rng.integers(1, NUM_SPECIES + 1, n), cell=cell, pbc=True))
+        out[-1].set_scaled_positions(frac)
+    return out
+
+
+def assert_results_close(actual: list[dict], desired: list[dict]):
+    assert np.abs(np.concatenate([d['forces'] for d in desired])).max() > 1e-3
+    for a, d in zip(actual, desired):
+        for key in ('energy', 'forces', 'stress'):
+            np.testing.assert_allclose(a[key], d[key], rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('quantize', [None, 'int8'])
+def test_export_round_trip(tmp_path, quantize):
+    calc = small_calculator(tmp_path, quantize)
+    export_model(calc, tmp_path / 'frozen', BUCKETS)
+    model = FrozenModel(tmp_path / 'frozen', cache_dir=None)
+
+    atoms = structures()
+    assert_results_close(model.predict(atoms), calc.predict(atoms))
+
+
+def test_unwrapped_positions(tmp_path):
+    calc = small_calculator(tmp_path)
+    export_model(calc, tmp_path / 'frozen', BUCKETS)
+    model = FrozenModel(tmp_path / 'frozen', cache_dir=None)
+
+    wrapped = structures()
+    unwrapped = [atoms.copy() for atoms in wrapped]
+    rng = np.random.default_rng(1)
+    for atoms in unwrapped:
+        shift = rng.integers(-3, 4, (len(atoms), 3))
+        atoms.set_scaled_positions(atoms.get_scaled_positions() + shift)
+
+    assert_results_close(model.predict(unwrapped), model.predict(wrapped))
@@ -0,0 +1,52 @@
+"""Checks the k-NN graphs against a brute-force search."""
+
+import numpy as np
+import pytest
+
+from facet.data.neighbors import knn_arrays
+
+
+def brute_force_dists(lat, cart, k: int, n_max: int = 6) -> np.ndarray:
+    """The distances to the k nearest neighbors of each atom, checking every image up to n_max
+    cells away from the positions given."""
+    grid = np.arange(-n_max, n_max + 1)
+    ims = np.stack(np.meshgrid(grid, grid, grid, indexing='ij'), axis=-1).reshape(-1, 3)
+    vecs = cart[None, None, :, :] + (ims @ lat)[None, :, None, :] - cart[:, None, None, :]
+    dists = np.linalg.norm(vecs, axis=-1)
+    n = len(cart)
+    zero_im = np.flatnonzero(np.all(ims == 0, axis=-1))[0]
+    dists[np.arange(n), zero_im, np.arange(n)] = np.inf
+    return np.sort(dists.reshape(n, -1), axis=1)[:, :k]
+
+
+def random_structure(rng: np.random.Generator, num_atoms: int, max_shift: float):
+    lat = np.diag(rng.uniform(3, 6, size=3)) + rng.uniform(-1, 1, size=(3, 3))
+    frac = rng.uniform(0, 1, size=(num_atoms, 3))
+    frac += rng.uniform(-max_shift, max_shift, size=frac.shape)
+    return lat, frac @ lat
+
+
+@pytest.mark.parametrize('max_shift', [0, 1.5, 3])
+def test_knn_matches_brute_force(max_shift):
+    rng = np.random.default_rng(123)
+    k = 8
+    for _ in range(50):
+        lat, cart = random_structure(rng, int(rng.integers(1, 7)), max_shift)
+        ims, recv, dists = knn_arrays(lat, cart, k)
+
+        np.testing.assert_allclose(dists, brute_force_dists(lat, cart, k), atol=1e-8)
+        # the images are for the positions given, not the wrapped ones
+        vecs = cart[recv] + ims @ lat - cart[:, None, :]
+        np.testing.assert_allclose(np.linalg.norm(vecs, axis=-1), dists, atol=1e-8)
+
+
+def test_knn_atom_far_outside_cell():
+    lat = np.array([[4.0, 0, 0], [0.5, 4.5, 0], [0, 0.3, 5.0]])
+    frac = np.array([[0.1, 0.2, 0.3], [0.6, 0.5, 0.4], [0.3, 0.8, 0.7]])
+    frac[1] += [2.3, -1.6, 0]
+    cart = frac @ lat
+    ims, recv, dists = knn_arrays(lat, cart, 6)
+
+    np.testing.assert_allclose(dists, brute_force_dists(lat, cart, 6), atol=1e-8)
+    vecs = cart[recv] + ims @ lat - cart[:, None, :]
+    np.testing.assert_allclose(np.linalg.norm(vecs, axis=-1), dists, atol=1e-8)
@@ -0,0 +1,91 @@
+"""Checks the batched FIRE relaxation against ASE's FIRE, step for step."""
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from facet.data.databatch import CrystalData, CrystalGraphs, NodeData, TargetInfo
+from facet.data.neighbors import knn_graph
+from facet.layers import Context, edge_vecs
+from facet.regression import EFSWrapper
+from facet.relax import FIRERelaxer
+from facet.stress import EV_PER_A3_TO_GPA, EV_PER_A3_TO_KBAR
+
+ase = pytest.importorskip('ase')
+from ase.build import bulk  # noqa: E402
+from ase.calculators.calculator import Calculator, all_changes  # noqa: E402
+from ase.filters import UnitCellFilter  # noqa: E402
+from ase.optimize import FIRE  # noqa: E402
+
+K = 16
+
+
+def apply_fn(params, cg, ctx=None, vecs=None):
+    """A smooth pair potential with the interface of the model: energy per atom."""
+    if vecs is None:
+        vecs = edge_vecs(cg)
+    r = jnp.sqrt(jnp.sum(vecs**2, axis=-1) + 1e-12)
+    cutoff = jnp.where(r < 3.5, 0.5 * (jnp.cos(jnp.pi * r / 3.5) + 1), 0) ** 2
+    pair = params * ((1 - jnp.exp(-1.5 * (r - 2.35))) ** 2 - 1) * cutoff
+    energy = jax.ops.segment_sum(0.5 * pair.sum(axis=-1), cg.nodes.graph_i, cg.n_total_graphs)
+    return (energy / jnp.maximum(cg.n_node, 1))[:, None]
+
+
+def graph(atoms) -> CrystalGraphs:
+    lat = atoms.cell.array
+    n = len(atoms)
+    cg = CrystalGraphs(
+        nodes=NodeData(
+            species=np.ones(n, np.int16), cart=atoms.positions, graph_i=np.zeros(n, np.int16)
+        ),
+        edges=knn_graph(lat, atoms.positions, K),
+        n_node=np.array([n]),
+        padding_mask=np.ones(1, bool),
+        graph_data=CrystalData.from_lattice(lat, dtype=np.float64),
+        target_data=TargetInfo.new_empty(1, n),
+    )
+    return jax.tree.map(jnp.asarray, cg.padded(n + 1, K, 2))
+
+
+class PairCalculator(Calculator):
+    implemented_properties = ['energy', 'forces', 'stress']
+
+    def calculate(self, atoms=None, properties=None, system_changes=all_changes):
+        super().calculate(atoms, properties, system_changes)
+        n = len(self.atoms)
+        out = EFSWrapper()(apply_fn, 1.0, graph(self.atoms), ctx=Context(training=False))
+        # facet's stress is in kbar with the opposite sign
+        stress = -np.asarray(out.stress[0]) / EV_PER_A3_TO_KBAR
+        self.results = {
+            'energy': float(out.energy[0, 0]) * n,
+            'forces': np.asarray(out.force[:n]),
+            'stress': stress[[0, 1, 2, 1, 0, 0], [0, 1, 2, 2, 2, 1]],
+        }
+
+
+@pytest.mark.parametrize('relax_cell,pressure', [(False, 0.0), (True, 0.0), (True, 5.0)])
+def test_fire_matches_ase(relax_cell, pressure):
+    with jax.enable_x64(True):
+        atoms = bulk('Si', 'diamond', a=5.43 * 1.03).repeat((2, 1, 1))
+        atoms.rattle(0.05, seed=3)
+
+        cg = jax.tree.map(lambda x: x[None], graph(atoms))
+        relaxer = FIRERelaxer(
+            fmax=0.01, max_steps=300, relax_cell=relax_cell, pressure=pressure, k=K
+        ).with_images_for(graph(atoms))
+        state = relaxer.relax(apply_fn, 1.0, cg)
+
+        ase_atoms = atoms.copy()
+        ase_atoms.calc = PairCalculator()
+        scalar_pressure = pressure / EV_PER_A3_TO_GPA
+        target = UnitCellFilter(ase_atoms, scalar_pressure=scalar_pressure)
+        opt = FIRE(target if relax_cell else ase_atoms, logfile=None, downhill_check=False)
+        assert opt.run(fmax=0.01, steps=300)
+
+        enthalpy = ase_atoms.get_potential_energy() + scalar_pressure * ase_atoms.get_volume()
+        assert bool(state.converged[0, 0])
+        assert int(state.num_steps[0, 0]) == opt.nsteps
+        np.testing.assert_allclose(float(state.energy[0, 0]), enthalpy, rtol=1e-10)
+        volume = abs(np.linalg.det(np.asarray(state.cg.graph_data.lat[0, 0])))
+        np.testing.assert_allclose(volume, ase_atoms.get_volume(), rtol=1e-10)
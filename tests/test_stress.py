@@ -0,0 +1,63 @@
+"""Checks the analytic stress against finite differences of the energy."""
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from facet.config.mace import IrrepsConfig, MACEConfig
+from facet.data.synthetic import synthetic_batch, synthetic_metadata
+from facet.layers import Context
+from facet.regression import EFSWrapper
+from facet.stress import finite_difference_stress
+
+N_NODES, K, N_GRAPHS, NUM_SPECIES = 32, 8, 4, 5
+
+
+def perturb(params, key, scale: float = 0.1):
+    """Adds noise to every parameter. Some start at zero, which would make the energy of a new
+    model independent of the positions."""
+    leaves, treedef = jax.tree.flatten(params)
+    keys = jax.random.split(key, len(leaves))
+    noise = [scale * jax.random.normal(k, x.shape, x.dtype) for k, x in zip(keys, leaves)]
+    return jax.tree.unflatten(treedef, [x + n for x, n in zip(leaves, noise)])
+
+
+def to_f64(tree):
+    return jax.tree.map(
+        lambda x: x.astype(jnp.float64) if jnp.issubdtype(x.dtype, jnp.floating) else x, tree
+    )
+
+
+def test_stress_matches_finite_differences():
+    with jax.enable_x64(True):
+        metadata = synthetic_metadata(NUM_SPECIES, K, N_NODES, N_GRAPHS)
+        config = MACEConfig(hidden_irreps=IrrepsConfig(dim=8, max_degree=1, num_layers=1))
+        mod = config.build(metadata, 'f32')
+        ctx = Context(training=False)
+
+        for seed in range(3):
+            cg = jax.tree.map(
+                jnp.asarray, synthetic_batch(N_NODES, K, N_GRAPHS, NUM_SPECIES, seed=seed)
+            )
+            cg = to_f64(cg)
+            params = mod.init(jax.random.key(seed), cg, ctx=ctx)
+            params = to_f64(perturb(params, jax.random.key(seed + 100)))
+
+            def total_energy_fn(cg):
+                return mod.apply(params, cg, ctx=ctx)[..., 0] * cg.n_node
+
+            mask = np.asarray(cg.padding_mask)
+            # the model computes in 32 bits, so a smaller step only adds rounding error
+            fd = np.asarray(finite_difference_stress(total_energy_fn, cg, h=1e-3))[mask]
+            scale = np.max(np.abs(fd))
+            assert scale > 0
+
+            stresses = {
+                grad_mode: np.asarray(
+                    EFSWrapper(grad_mode=grad_mode)(mod.apply, params, cg, ctx=ctx).stress
+                )[mask]
+                for grad_mode in ('positions', 'edges')
+            }
+            np.testing.assert_allclose(stresses['positions'], fd, atol=1e-3 * scale)
+            np.testing.assert_allclose(stresses['edges'], fd, atol=1e-3 * scale)
+            np.testing.assert_allclose(stresses['edges'], stresses['positions'], atol=1e-10 * scale)